@@ -0,0 +1,329 @@
+"""
+Benchmarks ProQuest2Bepress against local stand-ins for Dropbox and SMTP.
+
+A synthetic corpus of ProQuest ETD zips is generated, run through the normal
+pipeline (unzip, combine_xmls, the XSLT, dropboxify and the result emails)
+and the time spent in every stage is reported together with the overall
+throughput and the peak memory use of the process.
+
+    python P2B_Bench.py --etds 50 --attachments 3 --attachment-size 2048 --workers 2
+
+Nothing in settings.conf, the upload directory or Dropbox is touched; all
+files are created in a temporary directory that is removed afterwards.
+"""
+import argparse
+import json
+import os
+import ProQuest2Bepress as P2B
+from P2B_Tests import StandInDropbox, StandInSmtp
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+
+# Filler text used to pad the abstract up to the requested XML size
+FILLER = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore. "
+
+ETD_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<DISS_submission publishing_option="0" embargo_code="0" third_party_search="N">
+<DISS_authorship><DISS_author type="primary">
+<DISS_name><DISS_surname>Author%(num)d</DISS_surname><DISS_fname>Bench</DISS_fname><DISS_middle/><DISS_suffix/></DISS_name>
+<DISS_contact type="current"><DISS_email>author%(num)d@example.com</DISS_email></DISS_contact>
+</DISS_author></DISS_authorship>
+<DISS_description page_count="100" type="doctoral" external_id="%(name)s">
+<DISS_title>Synthetic dissertation number %(num)d</DISS_title>
+<DISS_dates><DISS_comp_date>2014</DISS_comp_date><DISS_accept_date>01/01/2014</DISS_accept_date></DISS_dates>
+<DISS_degree>Ph.D.</DISS_degree>
+<DISS_institution><DISS_inst_code>0000</DISS_inst_code><DISS_inst_name>Benchmark University</DISS_inst_name></DISS_institution>
+</DISS_description>
+<DISS_content>
+<DISS_abstract>%(abstract)s</DISS_abstract>
+<DISS_binary type="PDF">%(name)s.pdf</DISS_binary>
+%(attachments)s
+</DISS_content>
+</DISS_submission>
+"""
+
+ATTACHMENT_XML = """<DISS_attachment><DISS_file_name>%s</DISS_file_name><DISS_file_category>dataset</DISS_file_category><DISS_file_descr/></DISS_attachment>"""
+
+# Stands in for dropbox_uploader.sh with --transport shell. Like the real script it
+# starts a new curl, and so a new connection, for every request, but against the
+# stand-in Dropbox. "list" is not needed without the upload cache and always fails.
+SHELL_UPLOADER = """#!/bin/sh
+case "$1" in
+upload)
+    exec curl -s -f -o /dev/null -H "Expect:" -X PUT --data-binary @"$2" "%(url)s/1/files_put/auto$3" ;;
+share)
+    url=$(curl -s -f "%(url)s/1/shares/auto$2" | sed -e 's/.*"url": "\\([^"]*\\)".*/\\1/') || exit 1
+    echo " > Share link: $url" ;;
+*)
+    exit 1 ;;
+esac
+"""
+
+
+def make_etd(path, num, xml_size, attachments, attachment_size, pdf_size):
+    """
+    Writes one synthetic ETD zip in the layout ProQuest delivers.
+    Parameters:
+        path: Where to write the zip
+        num: Number of the ETD, used in its name and metadata
+        xml_size: Approximate size in bytes of the _DATA.xml
+        attachments: Number of supplementary files besides the PDF
+        attachment_size: Size in bytes of each supplementary file
+        pdf_size: Size in bytes of the PDF
+    Returns:
+        (String) The ETD's name.
+    """
+    name = "Bench_%04d" % num
+    attachment_names = ["%s_data%d.dat" % (name, i) for i in range(attachments)]
+    paragraphs = max(1, xml_size // len(FILLER))
+    xml = ETD_XML % {'num': num, 'name': name, 'abstract': FILLER * paragraphs,
+                     'attachments': "\n".join(ATTACHMENT_XML % a for a in attachment_names)}
+    # Random content so that compression and the upload cache behave like real files
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as myzip:
+        myzip.writestr(name + "/" + name + "_DATA.xml", xml)
+        myzip.writestr(name + "/" + name + ".pdf", os.urandom(pdf_size))
+        for a in attachment_names:
+            myzip.writestr(name + "/" + a, os.urandom(attachment_size))
+    return name
+
+
+def make_corpus(folder, args):
+    """
+    Generates args.etds synthetic ETD zips in folder.
+    Returns:
+        (list) Paths to the zips.
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    paths = []
+    for num in range(args.etds):
+        path = os.path.join(folder, "Bench_%04d.zip" % num)
+        make_etd(path, num, args.xml_size * 1024, args.attachments,
+                 args.attachment_size * 1024, args.pdf_size * 1024)
+        paths.append(path)
+    return paths
+
+
+class SizeOnlyFiles(dict):
+    """
+    Stands in for StandInDropbox.files, keeping only a count of the bytes
+    received so that the stand-in does not inflate the peak RSS.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.bytes = 0
+
+    def __setitem__(self, key, value):
+        self.bytes += len(value)
+        dict.__setitem__(self, key, "")
+
+
+class StageTimer(object):
+    """
+    Records how long every call to a stage takes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = dict()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        """
+        Returns func wrapped so that each call is recorded under stage.
+        """
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.time() - start)
+        return timed
+
+    def summary(self):
+        """
+        Returns:
+            (dict) count, total, mean, p50, p95 and max in seconds for every stage.
+        """
+        result = dict()
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            result[stage] = {'count': len(samples),
+                             'total': sum(samples),
+                             'mean': sum(samples) / len(samples),
+                             'p50': samples[len(samples) // 2],
+                             'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                             'max': samples[-1]}
+        return result
+
+
+def instrument(timer):
+    """
+    Wraps the pipeline stages of ProQuest2Bepress so that timer sees every call.
+    """
+    for name in ('unzip', 'stream_etd', 'combine_xmls', 'dropboxify', 'upload_file', 'share_file',
+                 'email_success', 'email_success_attachments', 'email_failure'):
+        setattr(P2B, name, timer.wrap(name, getattr(P2B, name)))
+    get = P2B.xslt_cache.get
+    P2B.xslt_cache.get = lambda path: timer.wrap('xslt', get(path))
+
+
+def write_settings(work_dir, dropbox, args):
+    """
+    Writes a settings.conf that points every backend at the stand-ins.
+    """
+    credentials = os.path.join(work_dir, "dropbox_uploader")
+    with open(credentials, "w") as f:
+        f.write("APPKEY=key\nAPPSECRET=secret\nOAUTH_ACCESS_TOKEN=token\nOAUTH_ACCESS_TOKEN_SECRET=tsecret\n")
+    script = os.path.join(work_dir, "dropbox_uploader.sh")
+    with open(script, "w") as f:
+        f.write(SHELL_UPLOADER % {'url': dropbox.url})
+    os.chmod(script, 0755)
+    xslt_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "result.xsl")
+    with open(os.path.join(work_dir, "settings.conf"), "w") as f:
+        f.write("[time]\nsleep_time=1\n"
+                "[dirs]\nupload_dir=%s\ndropbox_dir=/Bench/\n"
+                "[xslt]\nxslt_path=%s\n"
+                "[smtp]\nsmtp_server=127.0.0.1\nsmtp_user=bench\nsmtp_password=bench\nsmtp_ssl=false\n"
+                "[email]\nBench=bench@example.com\n"
+                "[dropbox]\ntransport=%s\ndbuploader_path=%s\ndbuploader_config=%s\napi_url=%s\ncontent_url=%s\n"
+                "max_parallel_uploads=%d\n"
+                "[zip]\nstreaming=%s\nextract_workers=%d\n"
+                "[xml]\nstreaming=%s\n"
+                "[workers]\nmax_parallel_etds=%d\n"
+                "[limits]\ndisk_slots=%d\nnetwork_slots=%d\n"
+                % (os.path.join(work_dir, "upload"), xslt_path, args.transport, script, credentials, dropbox.url, dropbox.url,
+                   args.uploads, str(args.streaming).lower(), args.extract_workers, str(args.stream_xml).lower(), args.workers,
+                   args.disk_slots, args.network_slots))
+
+
+def run(args):
+    """
+    Generates the corpus, processes it and returns the results.
+    """
+    work_dir = tempfile.mkdtemp(prefix="p2b_bench_")
+    old_cwd = os.getcwd()
+    dropbox = StandInDropbox()
+    dropbox.files = SizeOnlyFiles()
+    smtp = StandInSmtp()
+    try:
+        folder = os.path.join(work_dir, "upload", "Bench")
+        print "Generating %d ETDs in %s..." % (args.etds, folder)
+        zips = make_corpus(folder, args)
+        corpus_bytes = sum(os.path.getsize(z) for z in zips)
+
+        write_settings(work_dir, dropbox, args)
+        os.chdir(work_dir)
+        P2B.load_config()
+        # The stand-in SMTP server does not do authentication
+        P2B.NOTIFIER = P2B.SmtpNotifier("127.0.0.1", smtp.port, use_ssl=False)
+        timer = StageTimer()
+        instrument(timer)
+
+        print "Processing..."
+        start = time.time()
+        pool = P2B.EtdWorkerPool(args.workers)
+        for path in zips:
+            pool.submit(folder + "/", path, "bench@example.com")
+        pool.join()
+        flush_start = time.time()
+        P2B.get_notifier().flush()
+        timer.record('smtp_flush', time.time() - flush_start)
+        elapsed = max(time.time() - start, 1e-6)
+        for _, _, seconds in pool.results:
+            timer.record('etd', seconds)
+
+        return {'etds': len(zips),
+                'failed': len([r for r in pool.results if not r[1]]),
+                'workers': args.workers,
+                'transport': args.transport,
+                'uploads': args.uploads,
+                'streaming': args.streaming,
+                'stream_xml': args.stream_xml,
+                'extract_workers': args.extract_workers,
+                'corpus_mb': corpus_bytes / 1048576.0,
+                'uploaded_mb': dropbox.files.bytes / 1048576.0,
+                'emails': len(smtp.messages),
+                'seconds': elapsed,
+                'etds_per_min': len(zips) * 60.0 / elapsed,
+                'mb_per_s': corpus_bytes / 1048576.0 / elapsed,
+                # ru_maxrss is in kilobytes on Linux
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                'stages': timer.summary()}
+    finally:
+        os.chdir(old_cwd)
+        if P2B.NOTIFIER != None:
+            P2B.NOTIFIER.close()
+        dropbox.stop()
+        smtp.stop()
+        if args.keep:
+            print "Kept files in %s" % work_dir
+        else:
+            shutil.rmtree(work_dir)
+
+
+def print_report(result):
+    print ""
+    print "%-26s %6s %10s %10s %10s %10s" % ("stage", "calls", "mean ms", "p50 ms", "p95 ms", "max ms")
+    for stage in sorted(result['stages']):
+        s = result['stages'][stage]
+        print "%-26s %6d %10.1f %10.1f %10.1f %10.1f" % (stage, s['count'], s['mean'] * 1000, s['p50'] * 1000,
+                                                        s['p95'] * 1000, s['max'] * 1000)
+    print ""
+    print "Processed %d ETDs (%d failed) in %.1f seconds with %d workers and %d parallel %s uploads" % (
+        result['etds'], result['failed'], result['seconds'], result['workers'], result['uploads'], result['transport'])
+    print "Corpus: %.1f MB, uploaded: %.1f MB, emails: %d" % (result['corpus_mb'], result['uploaded_mb'], result['emails'])
+    print "Throughput: %.1f ETDs/min, %.2f MB/s" % (result['etds_per_min'], result['mb_per_s'])
+    print "Peak RSS: %.1f MB" % result['peak_rss_mb']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark ProQuest2Bepress on a synthetic ETD corpus.")
+    parser.add_argument("--etds", type=int, default=20, help="number of ETDs to generate (default 20)")
+    parser.add_argument("--xml-size", type=int, default=16, help="size of each _DATA.xml in KB (default 16)")
+    parser.add_argument("--pdf-size", type=int, default=2048, help="size of each PDF in KB (default 2048)")
+    parser.add_argument("--attachments", type=int, default=2, help="supplementary files per ETD (default 2)")
+    parser.add_argument("--attachment-size", type=int, default=512, help="size of each supplementary file in KB (default 512)")
+    parser.add_argument("--workers", type=int, default=1, help="ETDs processed at the same time (default 1)")
+    parser.add_argument("--uploads", type=int, default=1, help="parallel uploads per ETD (default 1)")
+    parser.add_argument("--transport", choices=("http", "shell"), default="http",
+                        help="upload over pooled connections, or with one process per request like dropbox_uploader.sh (default http)")
+    parser.add_argument("--disk-slots", type=int, default=0, help="extractions allowed at once, 0 for no limit (default 0)")
+    parser.add_argument("--network-slots", type=int, default=0, help="uploads allowed at once across all ETDs, 0 for no limit (default 0)")
+    parser.add_argument("--extract-workers", type=int, default=1, help="threads extracting each zip (default 1)")
+    parser.add_argument("--streaming", action="store_true", help="process zips without extracting them")
+    parser.add_argument("--stream-xml", action="store_true", help="transform each DISS_submission on its own")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to FILE as JSON")
+    parser.add_argument("--corpus-only", metavar="DIR", help="only generate the corpus into DIR")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.corpus_only:
+        zips = make_corpus(args.corpus_only, args)
+        print "Wrote %d ETDs to %s" % (len(zips), args.corpus_only)
+        return 0
+    result = run(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if result['failed']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
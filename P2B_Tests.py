@@ -1,12 +1,28 @@
+import BaseHTTPServer
+import SocketServer
+import asyncore
+import contextlib
 from difflib import context_diff
+from email.mime.text import MIMEText
+import errno
 import glob
+import json
+import mailbox
 import os
 import ProQuest2Bepress as P2B
 import re
 import shutil
+import smtpd
 import subprocess
 import sys
+import tempfile
+import textwrap
+import threading
+import time
 import unittest
+import urlparse
+import zipfile
+import zlib
 
 
 # Pattern to match the fulltext-url element in xml
@@ -21,6 +37,1518 @@ def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
 
 
+class StandInDropboxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Minimal imitation of the Dropbox v1 upload and share API.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.requests.append(url.path)
+        if url.path.startswith("/1/files_put/"):
+            self.server.files[url.path[len("/1/files_put"):]] = data
+            self.reply(200, {"bytes": len(data)})
+        elif url.path == "/1/chunked_upload":
+            upload_id = params.get("upload_id", str(len(self.server.chunks)))
+            self.server.chunks[upload_id] = self.server.chunks.get(upload_id, "") + data
+            self.reply(200, {"upload_id": upload_id, "offset": len(self.server.chunks[upload_id])})
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append(url.path)
+        if url.path.startswith("/1/commit_chunked_upload/"):
+            self.server.files[url.path[len("/1/commit_chunked_upload"):]] = self.server.chunks.pop(params["upload_id"])
+            self.reply(200, {})
+        else:
+            self.reply(404, {"error": "not found"})
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        self.server.requests.append(url.path)
+        if url.path.startswith("/1/shares/"):
+            self.reply(200, {"url": "https://www.dropbox.com/s/x" + url.path[len("/1/shares"):] + "?dl=0"})
+        elif url.path.startswith("/1/metadata/"):
+            path = url.path[len("/1/metadata"):]
+            if path in self.server.files:
+                self.reply(200, {"path": path, "bytes": len(self.server.files[path]), "is_dir": False})
+            else:
+                self.reply(404, {"error": "Path '%s' not found" % path})
+        else:
+            self.reply(404, {"error": "not found"})
+
+
+class StandInDropbox(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP server used in place of Dropbox.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInDropboxHandler)
+        self.connections = 0
+        self.requests = []
+        self.files = dict()
+        self.chunks = dict()
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RecordingUploader(P2B.Uploader):
+    """
+    Keeps "uploaded" files in memory and records the order they arrived in.
+    The first failures uploads raise IOError, as a flaky connection would.
+    """
+
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.files = dict()
+        self.uploads = []
+        self.attempts = 0
+        self.active = 0
+        self.max_active = 0
+
+    def upload(self, local_path, remote_path):
+        with self.lock:
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise IOError("Connection reset by peer")
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with open(local_path, "rb") as f:
+            data = f.read()
+        with self.lock:
+            self.active -= 1
+            self.files[remote_path] = data
+            self.uploads.append(remote_path)
+
+    def share(self, remote_path):
+        return "https://www.dropbox.com/s/x%s?dl=0" % remote_path
+
+    def exists(self, remote_path):
+        return remote_path in self.files
+
+
+class TestUploadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = (P2B.UPLOADER, P2B.UPLOAD_RETRIES, P2B.RETRY_BACKOFF, P2B.DB_DIR, P2B.email_failure)
+        P2B.UPLOAD_RETRIES = 2
+        P2B.RETRY_BACKOFF = 0.05
+        P2B.DB_DIR = "/P2B"
+        self.sent = []
+        P2B.email_failure = lambda culprit, message, recipient=None: self.sent.append(culprit)
+
+    def tearDown(self):
+        P2B.UPLOADER, P2B.UPLOAD_RETRIES, P2B.RETRY_BACKOFF, P2B.DB_DIR, P2B.email_failure = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def files(self, count, folder=None):
+        folder = folder or self.tmp_dir
+        paths = []
+        for num in range(count):
+            paths.append(os.path.join(folder, "file%d.dat" % num))
+            with open(paths[-1], "w") as f:
+                f.write("data %d" % num)
+        return paths
+
+    def test_retry_with_backoff(self):
+        P2B.UPLOADER = RecordingUploader(failures=2)
+        scheduler = P2B.UploadScheduler(1)
+        scheduler.submit("file0.dat", self.files(1)[0], "/P2B/inst/etd/file0.dat")
+        start = time.time()
+        links = scheduler.wait()
+        # Waited 0.05 and then 0.1 seconds before the third attempt succeeded
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(P2B.UPLOADER.attempts, 3)
+        self.assertEqual(links, {"file0.dat": "https://www.dropbox.com/s/x/P2B/inst/etd/file0.dat?dl=1"})
+
+    def test_retries_exhausted(self):
+        P2B.UPLOADER = RecordingUploader(failures=3)
+        scheduler = P2B.UploadScheduler(1)
+        scheduler.submit("file0.dat", self.files(1)[0], "/P2B/inst/etd/file0.dat")
+        self.assertRaises(P2B.UploadError, scheduler.wait)
+        self.assertEqual(P2B.UPLOADER.attempts, 3)
+
+    def test_parallel_cap(self):
+        P2B.UPLOADER = RecordingUploader(delay=0.05)
+        scheduler = P2B.UploadScheduler(3)
+        for path in self.files(8):
+            scheduler.submit(os.path.basename(path), path, "/P2B/inst/etd/" + os.path.basename(path))
+        self.assertEqual(len(scheduler.wait()), 8)
+        self.assertEqual(P2B.UPLOADER.max_active, 3)
+
+    def test_output_uploaded_last(self):
+        P2B.UPLOADER = RecordingUploader(delay=0.01)
+        dirpath = os.path.join(self.tmp_dir, "inst", "Etd_0") + "/"
+        os.makedirs(dirpath)
+        resources = self.files(5, dirpath)
+        dom = P2B.ET.fromstring("<documents><document><fulltext-url>file0.dat</fulltext-url></document></documents>")
+        saved = P2B.MAX_PARALLEL_UPLOADS
+        P2B.MAX_PARALLEL_UPLOADS = 4
+        try:
+            output_path = P2B.dropboxify(dirpath, dom, resources, "admin@example.com")
+        finally:
+            P2B.MAX_PARALLEL_UPLOADS = saved
+        self.assertEqual(len(P2B.UPLOADER.uploads), 6)
+        self.assertEqual(P2B.UPLOADER.uploads[-1], "/P2B/inst/Etd_0/Etd_0_Output.xml")
+        with open(output_path) as f:
+            self.assertTrue("/P2B/inst/Etd_0/file0.dat?dl=1" in f.read())
+
+        # Nothing of an ETD whose resources fail is published
+        P2B.UPLOADER = RecordingUploader(failures=100)
+        self.assertRaises(P2B.MyException, P2B.dropboxify, dirpath, dom, resources, "admin@example.com")
+        self.assertEqual(P2B.UPLOADER.uploads, [])
+        self.assertEqual(self.sent, ["Etd_0.zip"])
+
+
+class TestShellUploader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # dropbox_uploader.sh pads the sizes to the widest one in the folder
+        self.script_path = os.path.join(self.tmp_dir, "dropbox_uploader.sh")
+        with open(self.script_path, "w") as f:
+            f.write("\n".join(["#!/bin/sh",
+                               "echo ' > Listing \"'$2'\"... DONE'",
+                               "echo ' [D] 0       Etd_0'",
+                               "echo ' [F] 1048576 Etd_0.pdf'",
+                               "echo ' [F] 2048    Etd_0_Output.xml'",
+                               "echo ' [F] 12      a b.dat'", ""]))
+        os.chmod(self.script_path, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_exists(self):
+        uploader = P2B.ShellUploader(self.script_path)
+        self.assertTrue(uploader.exists("/P2B/inst/Etd_0.pdf"))
+        self.assertTrue(uploader.exists("/P2B/inst//Etd_0_Output.xml"))
+        self.assertTrue(uploader.exists("/P2B/inst/a b.dat"))
+        self.assertFalse(uploader.exists("/P2B/inst/Etd_0"))
+        self.assertFalse(uploader.exists("/P2B/inst/Output.xml"))
+
+
+class TestHttpUploader(unittest.TestCase):
+
+    credentials = {"APPKEY": "key", "APPSECRET": "secret",
+                   "OAUTH_ACCESS_TOKEN": "token", "OAUTH_ACCESS_TOKEN_SECRET": "tsecret"}
+
+    def setUp(self):
+        self.server = StandInDropbox()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_upload_and_share_reuse_connection(self):
+        uploader = P2B.HttpUploader(self.credentials, api_url=self.server.url, content_url=self.server.url)
+        paths = [self.make_file("file%d.pdf" % i, 10000) for i in range(5)]
+        for path in paths:
+            uploader.upload(path, "/P2BTests//folder/etd/" + os.path.basename(path))
+            link = uploader.share("/P2BTests/folder/etd/" + os.path.basename(path))
+            self.assertTrue(link.endswith(os.path.basename(path) + "?dl=0"))
+        uploader.close()
+
+        for path in paths:
+            with open(path, "rb") as f:
+                self.assertEqual(self.server.files["/dropbox/P2BTests/folder/etd/" + os.path.basename(path)], f.read())
+        # Every request should have gone over the same keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    def test_exists(self):
+        uploader = P2B.HttpUploader(self.credentials, api_url=self.server.url, content_url=self.server.url)
+        uploader.upload(self.make_file("here.pdf", 100), "/P2BTests/here.pdf")
+        self.assertTrue(uploader.exists("/P2BTests/here.pdf"))
+        self.assertFalse(uploader.exists("/P2BTests/missing.pdf"))
+        uploader.close()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_chunked_upload(self):
+        uploader = P2B.HttpUploader(self.credentials, api_url=self.server.url, content_url=self.server.url, chunk_size=4000)
+        uploader.SIMPLE_UPLOAD_LIMIT = 0
+        path = self.make_file("big.pdf", 10000)
+        uploader.upload(path, "/P2BTests/big.pdf")
+        uploader.close()
+
+        with open(path, "rb") as f:
+            self.assertEqual(self.server.files["/dropbox/P2BTests/big.pdf"], f.read())
+        self.assertEqual(self.server.requests.count("/1/chunked_upload"), 3)
+        self.assertEqual(self.server.connections, 1)
+
+
+class TestStreamEtd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.sent = []
+        self.saved = P2B.email_failure
+        P2B.email_failure = lambda culprit, message, recipient=None: self.sent.append(culprit)
+
+    def tearDown(self):
+        P2B.email_failure = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def test_corrupt_zip(self):
+        path = os.path.join(self.tmp_dir, "bad.zip")
+        with open(path, "w") as f:
+            f.write("not a zip")
+        self.assertRaises(P2B.MyException, P2B.stream_etd, self.tmp_dir + "/", path, "admin@example.com")
+        self.assertEqual(self.sent, ["bad.zip"])
+        # Nothing is left behind to block the next attempt
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "bad")))
+
+    def test_resumed_zip_gone(self):
+        # Files written by an earlier attempt do not keep the working directory around
+        path = os.path.join(self.tmp_dir, "etd.zip")
+        os.makedirs(os.path.join(self.tmp_dir, "etd", "etd"))
+        with open(os.path.join(self.tmp_dir, "etd", "etd", "etd_DATA.xml"), "w") as f:
+            f.write("<DISS_submission/>")
+        job = P2B.EtdJob(path, os.path.join(self.tmp_dir, ".jobs"))
+        job.advance('extracted')
+        self.assertRaises(P2B.MyException, P2B.stream_etd, self.tmp_dir + "/", path, "admin@example.com", job)
+        self.assertEqual(self.sent, ["etd.zip"])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "etd")))
+
+
+class TestInotifyWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, "uploads")
+        self.folder = os.path.join(self.root, "inst")
+        os.makedirs(self.folder)
+        self.saved = (P2B.UPLOAD_DIR, P2B.WATCH_MODE, P2B.SLEEP_TIME)
+        P2B.UPLOAD_DIR = self.root + "/"
+        P2B.SLEEP_TIME = 1
+
+    def tearDown(self):
+        P2B.UPLOAD_DIR, P2B.WATCH_MODE, P2B.SLEEP_TIME = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def test_closed_zip(self):
+        watcher = P2B.InotifyWatcher(self.root)
+        try:
+            self.assertEqual(watcher.wait(0), None)
+            with open(os.path.join(self.folder, "etd.zip"), "w") as f:
+                f.write("zip")
+            self.assertEqual(watcher.wait(5), set([self.folder]))
+        finally:
+            watcher.close()
+
+    def test_renamed_zip(self):
+        # SFTP servers often write to a temporary name and rename when done
+        partial = os.path.join(self.tmp_dir, "etd.zip.part")
+        with open(partial, "w") as f:
+            f.write("zip")
+        watcher = P2B.InotifyWatcher(self.root)
+        try:
+            os.rename(partial, os.path.join(self.folder, "etd.zip"))
+            self.assertEqual(watcher.wait(5), set([self.folder]))
+        finally:
+            watcher.close()
+
+    def test_new_folder(self):
+        watcher = P2B.InotifyWatcher(self.root)
+        try:
+            os.mkdir(os.path.join(self.root, "new"))
+            # Everything is rescanned, and the new folder is watched from now on
+            self.assertEqual(watcher.wait(5), None)
+            with open(os.path.join(self.root, "new", "etd.zip"), "w") as f:
+                f.write("zip")
+            self.assertEqual(watcher.wait(5), set([os.path.join(self.root, "new")]))
+        finally:
+            watcher.close()
+
+    def test_fallback_to_polling(self):
+        import ctypes.util
+        find_library = ctypes.util.find_library
+        # As on a system without a C library ctypes can find, e.g. a minimal container
+        ctypes.util.find_library = lambda name: None
+        try:
+            P2B.WATCH_MODE = 'auto'
+            self.assertEqual(P2B.make_watcher(), None)
+            P2B.WATCH_MODE = 'inotify'
+            self.assertRaises(OSError, P2B.make_watcher)
+        finally:
+            ctypes.util.find_library = find_library
+        P2B.WATCH_MODE = 'poll'
+        self.assertEqual(P2B.make_watcher(), None)
+
+
+class TestFileLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.tmp_dir, ".ledger.log")
+        self.broken_path = os.path.join(self.tmp_dir, ".broken.txt")
+        self.seen_path = os.path.join(self.tmp_dir, ".seen.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def ledger(self):
+        return P2B.FileLedger(self.log_path, self.broken_path, self.seen_path)
+
+    def log_lines(self):
+        with open(self.log_path) as f:
+            return f.readlines()
+
+    def test_truncated_line(self):
+        ledger = self.ledger()
+        ledger.set_state("/uploads/inst/a.zip", 'processing')
+        ledger.set_state("/uploads/inst/a.zip", 'done')
+        ledger.set_state("/uploads/inst/b.zip", 'processing')
+        # A crash in the middle of writing b's final state
+        with open(self.log_path, "a") as f:
+            f.write('{"path": "/uploads/inst/b.zip", "sta')
+        ledger = self.ledger()
+        self.assertEqual(ledger.get("/uploads/inst/a.zip")['state'], 'done')
+        self.assertEqual(ledger.paths('processing'), ["/uploads/inst/b.zip"])
+
+    def test_compaction(self):
+        ledger = self.ledger()
+        for state in ('seen', 'processing', 'done'):
+            ledger.set_state("/uploads/inst/a.zip", state)
+        self.assertEqual(len(self.log_lines()), 3)
+        ledger.compact()
+        self.assertEqual([json.loads(line)['state'] for line in self.log_lines()], ['done'])
+        # Loading compacts too
+        ledger.set_state("/uploads/inst/a.zip", 'done')
+        self.ledger()
+        self.assertEqual(len(self.log_lines()), 1)
+
+    def test_legacy_seen_import(self):
+        with open(self.seen_path, "w") as f:
+            f.write("/uploads/inst/a.zip\n\n/uploads/inst/b.zip\n")
+        ledger = self.ledger()
+        self.assertEqual(sorted(ledger.paths('done')), ["/uploads/inst/a.zip", "/uploads/inst/b.zip"])
+        self.assertEqual(len(self.log_lines()), 2)
+        # Only imported when there is no ledger yet
+        with open(self.seen_path, "a") as f:
+            f.write("/uploads/inst/c.zip\n")
+        self.assertFalse("/uploads/inst/c.zip" in self.ledger())
+
+    def test_broken_reenabled(self):
+        ledger = self.ledger()
+        ledger.set_state("/uploads/inst/a.zip", 'broken')
+        ledger.set_state("/uploads/inst/b.zip", 'broken')
+        with open(self.broken_path) as f:
+            self.assertEqual(f.read(), "/uploads/inst/a.zip\n/uploads/inst/b.zip\n")
+        self.assertEqual(sorted(self.ledger().paths('broken')), ["/uploads/inst/a.zip", "/uploads/inst/b.zip"])
+
+        # The operator fixed a.zip and removed its line
+        with open(self.broken_path, "w") as f:
+            f.write("/uploads/inst/b.zip\n")
+        ledger = self.ledger()
+        self.assertFalse("/uploads/inst/a.zip" in ledger)
+        self.assertEqual(ledger.paths('broken'), ["/uploads/inst/b.zip"])
+        # A line added by hand marks that file broken
+        with open(self.broken_path, "a") as f:
+            f.write("/uploads/inst/c.zip\n")
+        self.assertEqual(self.ledger().get("/uploads/inst/c.zip")['state'], 'broken')
+
+
+class TestXsltCache(unittest.TestCase):
+
+    STYLESHEET = """<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+        <xsl:template match="/"><%s/></xsl:template>
+        </xsl:stylesheet>"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "result.xsl")
+        self.doc = P2B.ET.fromstring("<DISS_Documents/>")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, element, mtime):
+        with open(self.path, "w") as f:
+            f.write(self.STYLESHEET % element)
+        os.utime(self.path, (mtime, mtime))
+
+    def output(self, transform):
+        return transform(self.doc).getroot().tag
+
+    def test_edit_invalidates(self):
+        cache = P2B.XsltCache()
+        self.write("first", 1000)
+        transform = cache.get(self.path)
+        self.assertEqual(self.output(transform), "first")
+        self.assertTrue(cache.get(self.path) is transform)
+        # Saved again without changes: re-read, but not recompiled
+        self.write("first", 2000)
+        self.assertTrue(cache.get(self.path) is transform)
+        # Same size, new contents
+        self.write("other", 3000)
+        self.assertEqual(self.output(cache.get(self.path)), "other")
+
+    def test_per_thread(self):
+        cache = P2B.XsltCache()
+        self.write("first", 1000)
+        transforms = [cache.get(self.path)]
+        t = threading.Thread(target=lambda: transforms.append(cache.get(self.path)))
+        t.start()
+        t.join()
+        self.assertFalse(transforms[0] is transforms[1])
+
+    def test_stylesheet_for(self):
+        path = os.path.join(self.tmp_dir, "settings.conf")
+        with open(path, "w") as f:
+            f.write("[xslt]\nxslt_path=result.xsl\ninst1=inst1.xsl\ninst2=\n")
+        saved = (P2B.config, P2B.XSLT_PATH)
+        P2B.config = P2B.Settings(path).parser
+        P2B.XSLT_PATH = "result.xsl"
+        try:
+            self.assertEqual(P2B.stylesheet_for("inst1"), "inst1.xsl")
+            # An empty line, or none at all, means the default stylesheet
+            self.assertEqual(P2B.stylesheet_for("inst2"), "result.xsl")
+            self.assertEqual(P2B.stylesheet_for("inst3"), "result.xsl")
+        finally:
+            P2B.config, P2B.XSLT_PATH = saved
+
+
+class CopyingUploader(P2B.Uploader):
+    """
+    Puts "uploaded" files into a local directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload(self, local_path, remote_path):
+        path = os.path.join(self.root, remote_path.lstrip("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copy(local_path, path)
+
+
+class FailingUploader(P2B.Uploader):
+
+    def upload(self, local_path, remote_path):
+        raise IOError("Dropbox is down")
+
+
+class TestAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_path = os.path.join(self.tmp_dir, ".aggregate.json")
+        self.sent = []
+        self.saved = (P2B.UPLOADER, P2B.email_batch_success, P2B.DB_DIR, P2B.UPLOAD_RETRIES, P2B.RETRY_BACKOFF,
+                      P2B.STREAM_XML)
+        P2B.UPLOADER = CopyingUploader(os.path.join(self.tmp_dir, "out"))
+        P2B.email_batch_success = lambda upload_folder, batch_fname, etds, attachments, recipient=None: \
+            self.sent.append((upload_folder, etds, attachments, recipient))
+        P2B.DB_DIR = "/P2B"
+        P2B.UPLOAD_RETRIES = 0
+        P2B.RETRY_BACKOFF = 0
+        P2B.STREAM_XML = False
+
+    def tearDown(self):
+        (P2B.UPLOADER, P2B.email_batch_success, P2B.DB_DIR, P2B.UPLOAD_RETRIES, P2B.RETRY_BACKOFF,
+         P2B.STREAM_XML) = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, aggregator, num, attachments=[]):
+        dirname = "Etd_%d" % num
+        os.makedirs(os.path.join(self.tmp_dir, "inst", dirname))
+        output_path = os.path.join(self.tmp_dir, "inst", dirname, dirname + "_Output.xml")
+        with open(output_path, "w") as f:
+            f.write("<documents><document><title>%s</title></document></documents>" % dirname)
+        aggregator.add("inst", output_path, dirname, attachments, "admin@example.com")
+
+    def batch_titles(self):
+        remote = os.path.join(self.tmp_dir, "out", "P2B", "inst")
+        batches = os.listdir(remote)
+        self.assertEqual(len(batches), 1)
+        self.assertTrue(batches[0].startswith("inst_Batch_") and batches[0].endswith("_Etd_0.xml"))
+        return [t.text for t in P2B.ET.parse(os.path.join(remote, batches[0])).getroot().iter("title")]
+
+    def test_count_flush(self):
+        for streaming in (False, True):
+            P2B.STREAM_XML = streaming
+            aggregator = P2B.Aggregator(3, 3600, self.state_path)
+            self.add(aggregator, 0)
+            self.add(aggregator, 1, ["Etd_1/data.dat"])
+            self.assertEqual(self.sent, [])
+            self.add(aggregator, 2)
+            self.assertEqual(self.sent, [("inst", ["Etd_0", "Etd_1", "Etd_2"], ["Etd_1/data.dat"], "admin@example.com")])
+            self.assertEqual(self.batch_titles(), ["Etd_0", "Etd_1", "Etd_2"])
+            self.assertEqual(aggregator.next_deadline(), None)
+            with open(self.state_path) as f:
+                self.assertEqual(json.load(f), {})
+            shutil.rmtree(os.path.join(self.tmp_dir, "inst"))
+            shutil.rmtree(os.path.join(self.tmp_dir, "out"))
+            del self.sent[:]
+
+    def test_age_flush(self):
+        aggregator = P2B.Aggregator(10, 60, self.state_path)
+        self.add(aggregator, 0)
+        self.add(aggregator, 1)
+        self.assertTrue(59 < aggregator.next_deadline() <= 60)
+        aggregator.flush_due()
+        self.assertEqual(self.sent, [])
+        # The oldest ETD decides when the folder is due
+        aggregator.pending["inst"][0]['time'] -= 61
+        self.assertEqual(aggregator.next_deadline(), 0)
+        aggregator.flush_due()
+        self.assertEqual([etds for _, etds, _, _ in self.sent], [["Etd_0", "Etd_1"]])
+        self.assertEqual(self.batch_titles(), ["Etd_0", "Etd_1"])
+
+    def test_failed_upload(self):
+        P2B.UPLOADER = FailingUploader()
+        aggregator = P2B.Aggregator(2, 3600, self.state_path)
+        self.add(aggregator, 0)
+        self.add(aggregator, 1)
+        self.assertEqual(self.sent, [])
+        self.assertEqual([etd['dirname'] for etd in aggregator.pending["inst"]], ["Etd_0", "Etd_1"])
+
+        # Still waiting after a restart
+        P2B.UPLOADER = CopyingUploader(os.path.join(self.tmp_dir, "out"))
+        aggregator = P2B.Aggregator(2, 3600, self.state_path)
+        self.assertEqual([etd['dirname'] for etd in aggregator.pending["inst"]], ["Etd_0", "Etd_1"])
+        aggregator.flush_all()
+        self.assertEqual([etds for _, etds, _, _ in self.sent], [["Etd_0", "Etd_1"]])
+        self.assertEqual(self.batch_titles(), ["Etd_0", "Etd_1"])
+        self.assertEqual(P2B.Aggregator(2, 3600, self.state_path).pending, {})
+
+
+class StandInSmtp(smtpd.SMTPServer):
+    """
+    A local SMTP server that keeps every message it receives.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.05, "use_poll": True})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def stop(self):
+        self.close()
+        asyncore.close_all()
+        self.thread.join()
+
+
+class TestSmtpNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInSmtp()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def message(self, subject, body):
+        msg = MIMEText(body, 'plain')
+        msg['Subject'] = subject
+        return msg
+
+    def test_messages_share_connection(self):
+        notifier = P2B.SmtpNotifier("127.0.0.1", self.server.port, use_ssl=False)
+        for i in range(3):
+            notifier.send("admin@example.com", self.message("Message %d" % i, "Body %d" % i))
+        notifier.flush()
+        notifier.close()
+
+        self.assertEqual(len(self.server.messages), 3)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_digest(self):
+        notifier = P2B.SmtpNotifier("127.0.0.1", self.server.port, use_ssl=False, digest_interval=3600)
+        for i in range(3):
+            notifier.send("admin@example.com", self.message("Message %d" % i, "Body %d" % i))
+        notifier.send("other@example.com", self.message("Message 3", "Body 3"))
+        notifier.flush()
+        notifier.close()
+
+        self.assertEqual(len(self.server.messages), 2)
+        rcpttos, data = [m for m in self.server.messages if m[0] == ["admin@example.com"]][0]
+        self.assertTrue("digest: 3 results" in data)
+        for i in range(3):
+            self.assertTrue("Body %d" % i in data)
+
+
+class TestUploadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, ".upload_cache.json")
+        self.pdf_path = os.path.join(self.tmp_dir, "etd.pdf")
+        self.write("pdf")
+        self.saved = (P2B.UPLOADER, P2B.UPLOAD_CACHE, P2B.UPLOAD_RETRIES)
+        P2B.UPLOADER = RecordingUploader()
+        P2B.UPLOAD_RETRIES = 0
+
+    def tearDown(self):
+        P2B.UPLOADER, P2B.UPLOAD_CACHE, P2B.UPLOAD_RETRIES = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, data):
+        with open(self.pdf_path, "w") as f:
+            f.write(data)
+
+    def upload(self):
+        scheduler = P2B.UploadScheduler(1)
+        scheduler.submit("etd.pdf", self.pdf_path, "/P2B/inst/etd/etd.pdf")
+        links = scheduler.wait()
+        P2B.UPLOAD_CACHE.save()
+        return links
+
+    def test_unchanged_skipped(self):
+        P2B.UPLOAD_CACHE = P2B.UploadCache(self.cache_path)
+        links = self.upload()
+        # Resent by ProQuest, e.g. after a restart
+        P2B.UPLOAD_CACHE = P2B.UploadCache(self.cache_path)
+        self.assertEqual(self.upload(), links)
+        self.assertEqual(len(P2B.UPLOADER.uploads), 1)
+        # A corrected PDF under the same name is sent again
+        self.write("fixed pdf")
+        self.assertEqual(self.upload(), links)
+        self.assertEqual(len(P2B.UPLOADER.uploads), 2)
+        self.assertEqual(P2B.UPLOADER.files["/P2B/inst/etd/etd.pdf"], "fixed pdf")
+
+    def test_eviction(self):
+        cache = P2B.UploadCache(self.cache_path, max_entries=2)
+        for num in range(3):
+            cache.store("/P2B/inst/etd/%d.dat" % num, "sha%d" % num, 10, "link%d" % num)
+            cache.entries["/P2B/inst/etd/%d.dat" % num]['used'] = 1000 + num
+        # Using the oldest entry keeps it over the next one
+        self.assertEqual(cache.lookup("/P2B/inst/etd/0.dat", "sha0"), "link0")
+        cache.save()
+        cache = P2B.UploadCache(self.cache_path, max_entries=2)
+        self.assertEqual(sorted(cache.entries), ["/P2B/inst/etd/0.dat", "/P2B/inst/etd/2.dat"])
+        self.assertEqual(cache.lookup("/P2B/inst/etd/1.dat", "sha1"), None)
+
+    def test_verify_miss(self):
+        P2B.UPLOAD_CACHE = P2B.UploadCache(self.cache_path, verify=True)
+        links = self.upload()
+        self.upload()
+        self.assertEqual(len(P2B.UPLOADER.uploads), 1)
+        # Someone deleted it from Dropbox
+        del P2B.UPLOADER.files["/P2B/inst/etd/etd.pdf"]
+        self.assertEqual(self.upload(), links)
+        self.assertEqual(len(P2B.UPLOADER.uploads), 2)
+        self.assertTrue("/P2B/inst/etd/etd.pdf" in P2B.UPLOADER.files)
+
+
+class TestEtdJob(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.jobs_dir)
+
+    def test_resume(self):
+        job = P2B.EtdJob("/uploads/inst/etd.zip", self.jobs_dir)
+        self.assertFalse(job.resumed)
+        job.advance('extracted')
+        job.set_total(3)
+        job.record_upload("etd.pdf", "https://example.com/etd.pdf?dl=1")
+
+        job = P2B.EtdJob("/uploads/inst/etd.zip", self.jobs_dir)
+        self.assertTrue(job.resumed)
+        self.assertTrue(job.reached('extracted'))
+        self.assertFalse(job.reached('transformed'))
+        self.assertEqual(job.links, {"etd.pdf": "https://example.com/etd.pdf?dl=1"})
+
+        # Stages never move backwards
+        job.advance('notified')
+        job.advance('uploading')
+        self.assertEqual(job.stage, 'notified')
+
+        job.finish()
+        self.assertEqual(os.listdir(self.jobs_dir), [])
+
+    def test_restart(self):
+        job = P2B.EtdJob("/uploads/inst/etd.zip", self.jobs_dir)
+        job.advance('transformed')
+        job.record_upload("etd.pdf", "https://example.com/etd.pdf?dl=1")
+        job.restart()
+        job = P2B.EtdJob("/uploads/inst/etd.zip", self.jobs_dir)
+        self.assertFalse(job.reached('extracted'))
+        # Finished uploads are not repeated
+        self.assertEqual(job.links, {"etd.pdf": "https://example.com/etd.pdf?dl=1"})
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_stages_and_export(self):
+        textfile = os.path.join(self.tmp_dir, "p2b.prom")
+        log_path = os.path.join(self.tmp_dir, "metrics.log")
+        metrics = P2B.Metrics(textfile, log_path)
+        metrics.start_etd("etd1")
+        with metrics.stage('upload', 100):
+            pass
+        with metrics.stage('upload', 50):
+            pass
+        try:
+            with metrics.stage('share'):
+                raise IOError("connection reset")
+        except IOError:
+            pass
+        metrics.finish_etd('done')
+
+        with open(textfile) as f:
+            text = f.read()
+        self.assertTrue('p2b_stage_calls_total{stage="upload"} 2' in text)
+        self.assertTrue('p2b_stage_bytes_total{stage="upload"} 150' in text)
+        self.assertTrue('p2b_stage_errors_total{stage="share"} 1' in text)
+        self.assertTrue('p2b_etds_total{result="done"} 1' in text)
+
+        with open(log_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['event'] for r in records], ['stage', 'stage', 'stage', 'etd'])
+        self.assertEqual(records[0]['etd'], "etd1")
+        self.assertEqual(sorted(records[-1]['stages'].keys()), ['share', 'upload'])
+
+
+class TestStreamedDocument(unittest.TestCase):
+
+    submission = "<DISS_submission><DISS_description><DISS_title>Title %d</DISS_title></DISS_description>"\
+                 "<DISS_content><DISS_binary>etd%d.pdf</DISS_binary>"\
+                 "<DISS_attachment><DISS_file_name>data%d.csv</DISS_file_name></DISS_attachment>"\
+                 "</DISS_content></DISS_submission>"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xml_path = os.path.join(self.tmp_dir, "etd_DATA.xml")
+        with open(self.xml_path, "w") as f:
+            f.write("<DISS_Documents>" + "".join(self.submission % (i, i, i) for i in range(3)) + "</DISS_Documents>")
+        self.transform = P2B.XsltCache().get(os.path.join(os.path.dirname(os.path.abspath(__file__)), "result.xsl"))
+        self.link_map = dict(("etd%d.pdf" % i, "https://example.com/etd%d.pdf?dl=1" % i) for i in range(3))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_in_memory(self):
+        output_path = os.path.join(self.tmp_dir, "etd_Output.xml")
+        streamed = P2B.StreamedDocument([self.xml_path], self.transform)
+        streamed.write(output_path, self.link_map)
+
+        in_memory = self.transform(P2B.ET.parse(self.xml_path))
+        P2B.rewrite_links(in_memory, self.link_map)
+        parser = P2B.ET.XMLParser(remove_blank_text=True)
+        self.assertEqual(P2B.ET.tostring(P2B.ET.parse(output_path, parser), method="c14n"),
+                         P2B.ET.tostring(P2B.ET.fromstring(P2B.ET.tostring(in_memory), parser), method="c14n"))
+
+    def test_unmatched_link(self):
+        del self.link_map["etd1.pdf"]
+        streamed = P2B.StreamedDocument([self.xml_path], self.transform)
+        self.assertRaises(KeyError, streamed.write, os.path.join(self.tmp_dir, "etd_Output.xml"), self.link_map)
+
+    def test_finished_submissions_dropped(self):
+        self.assertEqual(P2B.collect_references([self.xml_path]),
+                         [("DISS_binary", "etd0.pdf"), ("DISS_file_name", "data0.csv"),
+                          ("DISS_binary", "etd1.pdf"), ("DISS_file_name", "data1.csv"),
+                          ("DISS_binary", "etd2.pdf"), ("DISS_file_name", "data2.csv")])
+        for element in P2B.iter_elements([self.xml_path], ("DISS_binary", "DISS_file_name")):
+            pass
+        # Only the submission being read is still in the tree
+        root = element.getroottree().getroot()
+        self.assertEqual(len(root), 1)
+        self.assertEqual(len(root[0]), 1)
+
+
+class TestResourceIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.file_dir = "/uploads/inst/etd/"
+        self.resources = [self.file_dir + "etd/etd.pdf",
+                          self.file_dir + "etd/supplements/Data.CSV",
+                          self.file_dir + "etd/a/notes.txt",
+                          self.file_dir + "etd/b/notes.txt"]
+        self.index = P2B.ResourceIndex(self.file_dir, self.resources)
+
+    def test_resolve(self):
+        self.assertEqual(self.index.resolve("etd.pdf"), self.resources[0])
+        self.assertEqual(self.index.resolve("./etd/etd.pdf"), self.resources[0])
+        self.assertEqual(self.index.resolve("supplements/Data.CSV"), self.resources[1])
+        self.assertEqual(self.index.resolve("data.csv"), self.resources[1])
+        self.assertEqual(self.index.resolve("b/notes.txt"), self.resources[3])
+        # Ambiguous and missing references do not resolve
+        self.assertEqual(self.index.resolve("notes.txt"), None)
+        self.assertEqual(self.index.resolve("missing.pdf"), None)
+
+    def test_validate_and_link_map(self):
+        self.assertEqual(self.index.validate(["etd.pdf", "DATA.csv", "notes.txt", "gone.zip"]), ["notes.txt", "gone.zip"])
+        self.assertEqual(self.index.name(self.resources[0]), "etd.pdf")
+        self.assertEqual(self.index.name(self.resources[2]), "a/notes.txt")
+
+        links = {"etd.pdf": "https://example.com/etd.pdf?dl=1", "Data.CSV": "https://example.com/Data.CSV?dl=1"}
+        link_map = self.index.link_map(links)
+        self.assertEqual(link_map["etd.pdf"], links["etd.pdf"])
+        self.assertEqual(link_map["DATA.csv"], links["Data.CSV"])
+
+    def test_checked_before_extracting(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, "etd.zip")
+        with zipfile.ZipFile(path, 'w') as myzip:
+            myzip.writestr("etd/etd_DATA.xml", "<DISS_submission><DISS_content><DISS_binary>etd.pdf</DISS_binary>"
+                           "<DISS_attachment><DISS_file_name>Data.csv</DISS_file_name></DISS_attachment>"
+                           "</DISS_content></DISS_submission>")
+            myzip.writestr("etd/etd.pdf", "pdf")
+        sent = []
+        extracted = []
+        saved = (P2B.email_failure, P2B.extract_zip)
+        P2B.email_failure = lambda culprit, message, recipient=None: sent.append(message)
+        P2B.extract_zip = lambda *args: extracted.append(args)
+        try:
+            self.assertRaises(P2B.MyException, P2B.unzip, tmp_dir + "/", path, "admin@example.com")
+            self.assertRaises(P2B.MyException, P2B.stream_etd, tmp_dir + "/", path, "admin@example.com")
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, "etd")))
+        finally:
+            P2B.email_failure, P2B.extract_zip = saved
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(extracted, [])
+        self.assertEqual(len(sent), 2)
+        self.assertTrue("\nData.csv\n" in sent[0])
+
+
+class TestResourceSlots(unittest.TestCase):
+
+    def test_slots_are_bounded(self):
+        slots = P2B.ResourceSlots({'network': 2, 'disk': 0})
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def use():
+            with slots.slot('network'):
+                with lock:
+                    state['active'] += 1
+                    state['peak'] = max(state['peak'], state['active'])
+                time.sleep(0.05)
+                with lock:
+                    state['active'] -= 1
+
+        threads = [threading.Thread(target=use) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state['peak'], 2)
+        # Unlimited resources do not block
+        with slots.slot('disk'):
+            with slots.slot('disk'):
+                pass
+
+
+class TestSettings(unittest.TestCase):
+
+    SETTINGS = textwrap.dedent("""\
+        [time]
+        sleep_time = 30
+        [dirs]
+        upload_dir = /tmp/uploads
+        dropbox_dir = /P2B
+        [xslt]
+        xslt_path = ProQuest2Bepress.xsl
+        [smtp]
+        smtp_server = smtp.example.com
+        smtp_user = user
+        smtp_password = secret
+        [dropbox]
+        transport = http
+        [admission]
+        max_in_flight = 100
+        """)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "settings.conf")
+        self.saved = (P2B.SETTINGS, P2B.config, P2B.BYTE_BUDGET, P2B.DB_DIR)
+
+    def tearDown(self):
+        P2B.SETTINGS, P2B.config, P2B.BYTE_BUDGET, P2B.DB_DIR = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text):
+        with open(self.path, "w") as f:
+            f.write(text)
+
+    def test_typed_values(self):
+        self.write(self.SETTINGS)
+        settings = P2B.Settings(self.path)
+        settings.check()
+        self.assertEqual(settings.sleep_time, 30)
+        self.assertEqual(settings.upload_dir, "/tmp/uploads/")
+        self.assertEqual(settings.max_in_flight, 100 * 1024 * 1024)
+        self.assertEqual(settings.stability_enabled, True)
+        self.assertEqual(settings.smtp_port, 465)
+        self.assertEqual(settings.chunk_size, 4 * 1024 * 1024)
+        self.assertEqual(settings.lease_time, 600)
+        self.assertEqual(settings.poll_interval, 5)
+
+    def test_reports_every_problem(self):
+        self.write("[time]\nsleep_time = soon\n[watcher]\nmode = magic\n[cache]\nenabled = maybe\n")
+        settings = P2B.Settings(self.path)
+        self.assertRaises(P2B.ConfigError, settings.check)
+        self.assertTrue("Missing option in [dirs]: upload_dir" in settings.errors)
+        self.assertTrue("Missing option in [dropbox]: dbuploader_path" in settings.errors)
+        self.assertTrue("Invalid whole number in [time]: sleep_time = soon" in settings.errors)
+        self.assertTrue("Unknown mode in [watcher]: magic" in settings.errors)
+        self.assertTrue("Invalid true/false value in [cache]: enabled = maybe" in settings.errors)
+
+    def test_transport_options(self):
+        # Checked up front rather than when the notifier, uploader or cluster workers are first built
+        self.write(self.SETTINGS.replace("secret", "secret\nsmtp_port = ssl\ndigest_interval = 1h")
+                   .replace("transport = http", "transport = http\nchunk_size = 0")
+                   + "[cluster]\nlease_time = 10m\npoll_interval = -1\n")
+        settings = P2B.Settings(self.path)
+        self.assertEqual(settings.errors, ["Invalid whole number in [smtp]: smtp_port = ssl",
+                                           "Invalid whole number in [smtp]: digest_interval = 1h",
+                                           "Invalid whole number in [cluster]: lease_time = 10m",
+                                           "chunk_size in [dropbox] must be more than 0",
+                                           "poll_interval in [cluster] must be more than 0"])
+        self.write(self.SETTINGS.replace("secret", "secret\nsmtp_port = 587\nsmtp_ssl = false\ndigest_interval = 60")
+                   .replace("transport = http", "transport = http\nchunk_size = 0.5"))
+        settings = P2B.Settings(self.path)
+        settings.check()
+        notifier = P2B.make_notifier(settings)
+        self.assertEqual((notifier.port, notifier.use_ssl, notifier.digest_interval), (587, False, 60))
+        notifier.close()
+        self.assertEqual(settings.chunk_size, 512 * 1024)
+
+    def test_reload(self):
+        self.write(self.SETTINGS)
+        P2B.apply_settings(P2B.Settings(self.path))
+        P2B.DB_DIR = "/P2B/"
+        budget = P2B.BYTE_BUDGET
+
+        # A broken file leaves everything as it was
+        self.write(self.SETTINGS.replace("sleep_time = 30", "sleep_time ="))
+        self.assertFalse(P2B.reload_config(self.path))
+        self.assertEqual(P2B.SLEEP_TIME, 30)
+
+        new = self.SETTINGS.replace("sleep_time = 30", "sleep_time = 5").replace("max_in_flight = 100", "max_in_flight = 200")
+        new = new.replace("smtp.example.com", "mail.example.com").replace("/P2B", "/Bepress")
+        self.write(new)
+        self.assertEqual(P2B.Settings(self.path).restart_changes(P2B.SETTINGS), ["[dirs] dropbox_dir", "[smtp]"])
+        self.assertTrue(P2B.reload_config(self.path))
+        self.assertEqual(P2B.SLEEP_TIME, 5)
+        # ETDs being uploaded keep writing to the folder their links point into
+        self.assertEqual(P2B.DB_DIR, "/P2B/")
+        # ETDs holding part of the budget keep it across the reload
+        self.assertTrue(P2B.BYTE_BUDGET is budget)
+        self.assertEqual(budget.limit, 200 * 1024 * 1024)
+
+    def test_lazy_module(self):
+        module = P2B.LazyModule("colorsys")
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertTrue(module._module is sys.modules["colorsys"])
+        # Importing the script pulls in none of the heavy modules
+        script = "import sys, ProQuest2Bepress; print sorted(set(%r) & set(sys.modules))" % \
+                 (["lxml.etree", "smtplib", "httplib", "sqlite3", "ctypes"],)
+        output = subprocess.check_output([sys.executable, "-c", script],
+                                         cwd=os.path.dirname(os.path.abspath(P2B.__file__)))
+        self.assertEqual(output.strip(), "[]")
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def job(self, folder, name, size):
+        folder = os.path.join(self.tmp_dir, folder) + "/"
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(folder + name, "wb") as f:
+            f.write("x" * size)
+        return (folder, folder + name, "admin@example.com")
+
+    def names(self, queue, count):
+        return [os.path.basename(queue.get()[1]) for _ in range(count)]
+
+    def test_fair_share(self):
+        queue = P2B.FairQueue({'big': 1, 'vip': 2})
+        for i in range(6):
+            queue.put(self.job("big", "big%d.zip" % i, 10 + i))
+        queue.put(self.job("small", "small0.zip", 10))
+        queue.put(self.job("small", "small1.zip", 10))
+        for i in range(4):
+            queue.put(self.job("vip", "vip%d.zip" % i, 10 + i))
+        # Each round gives vip two ETDs and the others one, smallest zip first
+        self.assertEqual(self.names(queue, 8), ["big0.zip", "small0.zip", "vip0.zip", "vip1.zip",
+                                                "small1.zip", "big1.zip", "vip2.zip", "vip3.zip"])
+        self.assertEqual(queue.state(), [("big", 4, 54, 1, 2), ("small", 0, 0, 1.0, 2), ("vip", 0, 0, 2, 4)])
+
+    def test_smallest_first(self):
+        queue = P2B.FairQueue({})
+        queue.put(self.job("inst", "large.zip", 500))
+        queue.put(self.job("inst", "tiny.zip", 5))
+        queue.put(None)
+        queue.put(self.job("inst", "medium.zip", 50))
+        self.assertEqual(self.names(queue, 3), ["tiny.zip", "medium.zip", "large.zip"])
+        self.assertEqual(queue.get(), None)
+
+    def test_idle_folder_does_not_catch_up(self):
+        queue = P2B.FairQueue({})
+        for i in range(4):
+            queue.put(self.job("busy", "busy%d.zip" % i, 10))
+        self.assertEqual(self.names(queue, 2), ["busy0.zip", "busy1.zip"])
+        # late starts level with busy's last ETD, not with credit for the time it was idle
+        queue.put(self.job("late", "late0.zip", 10))
+        queue.put(self.job("late", "late1.zip", 10))
+        self.assertEqual(self.names(queue, 4), ["late0.zip", "busy2.zip", "late1.zip", "busy3.zip"])
+
+    def test_worker_survives_errors(self):
+        saved = P2B.process_etd
+
+        def process_etd(folder, path, recipient):
+            if path.endswith("bad.zip"):
+                raise IOError("No space left on device")
+            return True
+        P2B.process_etd = process_etd
+        try:
+            pool = P2B.EtdWorkerPool(1)
+            pool.jobs.weights = {}
+            pool.submit(*self.job("inst", "bad.zip", 10))
+            pool.submit(*self.job("inst", "good.zip", 20))
+            pool.join()
+        finally:
+            P2B.process_etd = saved
+        self.assertEqual([(os.path.basename(path), ok) for path, ok, _ in pool.results],
+                         [("bad.zip", False), ("good.zip", True)])
+
+
+class TestOfflineSinks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_local_uploader(self):
+        local_path = os.path.join(self.tmp_dir, "a.pdf")
+        with open(local_path, "wb") as f:
+            f.write("pdf")
+        uploader = P2B.LocalUploader(os.path.join(self.tmp_dir, "out"))
+        uploader.upload(local_path, "/P2B//inst/etd/a.pdf")
+        with open(local_path, "rb") as f:
+            uploader.upload_fileobj(f, 3, "/P2B/inst/etd/b c.pdf")
+        self.assertTrue(uploader.exists("/P2B/inst/etd/a.pdf"))
+        with open(os.path.join(self.tmp_dir, "out", "P2B", "inst", "etd", "b c.pdf")) as f:
+            self.assertEqual(f.read(), "pdf")
+        self.assertEqual(uploader.share("/P2B/inst/etd/b c.pdf"),
+                         "file://" + os.path.join(self.tmp_dir, "out") + "/P2B/inst/etd/b%20c.pdf")
+        uploader = P2B.LocalUploader(os.path.join(self.tmp_dir, "out"), "http://localhost/etds/")
+        self.assertEqual(uploader.share("/P2B/inst/etd/a.pdf"), "http://localhost/etds/P2B/inst/etd/a.pdf")
+
+    def test_log_notifier(self):
+        mbox_path = os.path.join(self.tmp_dir, "mail.mbox")
+        notifier = P2B.LogNotifier(mbox_path)
+        for subject in ("one", "two"):
+            msg = MIMEText("From the start of a line\n")
+            msg['Subject'] = subject
+            msg['From'] = "pi@localhost"
+            notifier.send("admin@example.com", msg)
+        self.assertEqual([m['Subject'] for m in mailbox.mbox(mbox_path)], ["one", "two"])
+
+    def test_transports_need_their_options(self):
+        path = os.path.join(self.tmp_dir, "settings.conf")
+        with open(path, "w") as f:
+            f.write("[time]\nsleep_time=1\n[dirs]\nupload_dir=/tmp\ndropbox_dir=/P2B\n[xslt]\nxslt_path=result.xsl\n")
+        self.assertEqual(P2B.Settings(path).errors, ["Missing option in [dropbox]: dbuploader_path",
+                                                     "Missing option in [smtp]: smtp_server",
+                                                     "Missing option in [smtp]: smtp_user",
+                                                     "Missing option in [smtp]: smtp_password"])
+        settings = P2B.Settings(path, [('dropbox', 'transport', 'local'), ('smtp', 'transport', 'log')])
+        self.assertEqual(settings.errors, ["Missing option in [dropbox]: local_dir"])
+        args = P2B.parse_args(["process", "--dry-run", "etds/"])
+        settings = P2B.Settings(path, P2B.config_overrides(args))
+        self.assertEqual(settings.errors, [])
+        self.assertEqual(settings.jobs_dir, ".jobs-null")
+
+    def write_settings(self, extra=""):
+        with open(os.path.join(self.tmp_dir, "settings.conf"), "w") as f:
+            f.write("[time]\nsleep_time=1\n[dirs]\nupload_dir=%s\ndropbox_dir=/P2B\n[xslt]\nxslt_path=%s\n"
+                    "[email]\ninst=admin@example.com\n[smtp]\ntransport=log\nlog_path=mail.mbox\n%s"
+                    % (self.tmp_dir, os.path.join(os.path.dirname(os.path.abspath(__file__)), "result.xsl"), extra))
+
+    def process(self, *args):
+        """
+        Runs the process command in tmp_dir and returns its output.
+        """
+        script = os.path.abspath(P2B.__file__).replace(".pyc", ".py")
+        command = subprocess.Popen([sys.executable, script, "process"] + list(args), cwd=self.tmp_dir,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return command.communicate()[0]
+
+    def test_offline_process(self):
+        # The whole pipeline without Dropbox or a mail server
+        from P2B_Bench import make_etd
+        os.makedirs(os.path.join(self.tmp_dir, "archive", "inst"))
+        for num in range(2):
+            make_etd(os.path.join(self.tmp_dir, "archive", "inst", "Bench_%04d.zip" % num), num, 1024, 1, 1024, 2048)
+        self.write_settings()
+        output = self.process("archive", "--sink-dir", "out", "--output-dir", "work")
+        self.assertTrue("2 succeeded, 0 failed" in output)
+        remote = os.path.join(self.tmp_dir, "out", "P2B", "inst", "Bench_0001")
+        self.assertEqual(sorted(os.listdir(remote)), ["Bench_0001.pdf", "Bench_0001_Output.xml", "Bench_0001_data0.dat"])
+        with open(os.path.join(remote, "Bench_0001_Output.xml")) as f:
+            self.assertTrue("<fulltext-url>file://%s/Bench_0001.pdf</fulltext-url>" % remote in f.read())
+        self.assertEqual(len(open(os.path.join(self.tmp_dir, "mail.mbox")).read().split("\nFrom pi@localhost ")), 2)
+
+    def test_concurrent_recipients(self):
+        # ETDs from different folders processed at the same time only tell their own institution
+        from P2B_Bench import make_etd
+        for num in range(6):
+            inst = "inst%d" % (num % 2)
+            if not os.path.isdir(os.path.join(self.tmp_dir, "archive", inst)):
+                os.makedirs(os.path.join(self.tmp_dir, "archive", inst))
+            make_etd(os.path.join(self.tmp_dir, "archive", inst, "Bench_%04d.zip" % num), num, 1024, 0, 0, 2048)
+        with open(os.path.join(self.tmp_dir, "archive", "inst1", "bad.zip"), "w") as f:
+            f.write("not a zip")
+        self.write_settings("[workers]\nmax_parallel_etds=4\n[email]\ninst0=zero@example.com\ninst1=one@example.com\n")
+        self.assertTrue("6 succeeded, 1 failed" in self.process("archive", "--sink-dir", "out"))
+        sent = sorted((m['To'], m['Subject']) for m in mailbox.mbox(os.path.join(self.tmp_dir, "mail.mbox")))
+        self.assertEqual(sent, [("one@example.com", "Bench_0001 is ready for upload"),
+                                ("one@example.com", "Bench_0003 is ready for upload"),
+                                ("one@example.com", "Bench_0005 is ready for upload"),
+                                ("one@example.com", "Processing of bad.zip FAILED!"),
+                                ("zero@example.com", "Bench_0000 is ready for upload"),
+                                ("zero@example.com", "Bench_0002 is ready for upload"),
+                                ("zero@example.com", "Bench_0004 is ready for upload")])
+
+    def test_process_twice(self):
+        # Working directories left next to the zips, or by an earlier run, are not in the way
+        from P2B_Bench import make_etd
+        archive = os.path.join(self.tmp_dir, "archive", "inst")
+        os.makedirs(os.path.join(archive, "Bench_0000"))
+        for num in range(2):
+            make_etd(os.path.join(archive, "Bench_%04d.zip" % num), num, 1024, 1, 1024, 2048)
+        self.write_settings()
+        self.assertTrue("2 succeeded, 0 failed" in self.process("archive", "--sink-dir", "out"))
+        # A job that was extracted by an interrupted run into a directory that is gone now
+        job = P2B.EtdJob(os.path.join(archive, "Bench_0001.zip"), os.path.join(self.tmp_dir, ".jobs-local"))
+        job.advance('extracted')
+        output = self.process("archive", "--sink-dir", "out")
+        self.assertTrue("Resuming" in output)
+        self.assertTrue("2 succeeded, 0 failed" in output)
+        self.assertEqual(sorted(os.listdir(archive)), ["Bench_0000", "Bench_0000.zip", "Bench_0001.zip"])
+
+    def test_broken_then_reenabled(self):
+        from P2B_Bench import make_etd
+        archive = os.path.join(self.tmp_dir, "archive", "inst")
+        os.makedirs(archive)
+        zip_path = os.path.join(archive, "Bench_0000.zip")
+        make_etd(zip_path, 0, 1024, 0, 0, 2048)
+        self.write_settings("[dropbox]\nupload_retries=0\n")
+        # Uploads fail because the sink is a file
+        open(os.path.join(self.tmp_dir, "out"), "w").close()
+        output = self.process("archive", "--sink-dir", "out", "--output-dir", "work", "--record")
+        self.assertTrue("0 succeeded, 1 failed" in output)
+        with open(os.path.join(self.tmp_dir, ".broken.txt")) as f:
+            self.assertEqual(f.read(), os.path.abspath(zip_path) + "\n")
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "work", "inst", "Bench_0000")))
+
+        # The operator fixes the problem and removes the line from .broken.txt
+        os.remove(os.path.join(self.tmp_dir, "out"))
+        open(os.path.join(self.tmp_dir, ".broken.txt"), "w").close()
+        output = self.process("archive", "--sink-dir", "out", "--output-dir", "work", "--record")
+        self.assertTrue("1 succeeded, 0 failed" in output)
+        self.assertEqual(P2B.FileLedger(os.path.join(self.tmp_dir, ".ledger.log"), os.path.join(self.tmp_dir, ".broken.txt"),
+                                        os.path.join(self.tmp_dir, ".seen.txt")).get(os.path.abspath(zip_path))['state'], 'done')
+
+    def test_admission(self):
+        from P2B_Bench import make_etd
+        archive = os.path.join(self.tmp_dir, "archive", "inst")
+        os.makedirs(archive)
+        make_etd(os.path.join(archive, "Bench_0000.zip"), 0, 1024, 0, 0, 64 * 1024)
+        # A PDF over extract_threshold is uploaded straight from the zip
+        self.write_settings("[admission]\nextract_threshold=0.01\n")
+        output = self.process("archive", "--sink-dir", "out", "--output-dir", "work")
+        self.assertTrue("Uploading 1 large files straight from the zip" in output)
+        self.assertTrue("1 succeeded, 0 failed" in output)
+        self.assertEqual(os.path.getsize(os.path.join(self.tmp_dir, "out", "P2B", "inst", "Bench_0000", "Bench_0000.pdf")),
+                         64 * 1024)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "work", "inst", "Bench_0000", "Bench_0000", "Bench_0000.pdf")))
+
+        # One that unpacks to more than max_etd_size is turned away
+        self.write_settings("[admission]\nmax_etd_size=0.05\n")
+        output = self.process("archive", "--dry-run")
+        self.assertTrue("Bench_0000.zip is too large to process (0.1 MB unpacked)" in output)
+        self.assertTrue("0 succeeded, 1 failed" in output)
+
+    def test_dry_run_leaves_archive_alone(self):
+        from P2B_Bench import make_etd
+        archive = os.path.join(self.tmp_dir, "archive", "inst")
+        os.makedirs(archive)
+        make_etd(os.path.join(archive, "Bench_0000.zip"), 0, 1024, 1, 1024, 2048)
+        self.write_settings()
+        for args in (["--dry-run"], ["--sink", "null"], ["--sink-dir", "out"]):
+            self.assertTrue("1 succeeded, 0 failed" in self.process("archive", *args))
+            self.assertEqual(os.listdir(archive), ["Bench_0000.zip"])
+
+    def test_streamed_corrupt_zip(self):
+        os.makedirs(os.path.join(self.tmp_dir, "archive", "inst"))
+        with open(os.path.join(self.tmp_dir, "archive", "inst", "bad.zip"), "w") as f:
+            f.write("not a zip")
+        self.write_settings("[zip]\nstreaming=true\n")
+        output = self.process("archive", "--dry-run", "--output-dir", "work")
+        self.assertTrue("0 succeeded, 1 failed" in output)
+        self.assertEqual([m['Subject'] for m in mailbox.mbox(os.path.join(self.tmp_dir, "mail.mbox"))],
+                         ["Processing of bad.zip FAILED!"])
+        # Nothing is left behind to block the next attempt
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "work", "inst", "bad")))
+
+
+class TestExtractZip(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.tmp_dir, "etd.zip")
+        self.contents = dict(("etd/sub%d/file%d.dat" % (i % 2, i), os.urandom(2000) * (i + 1)) for i in range(6))
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as myzip:
+            for name, data in sorted(self.contents.items()):
+                myzip.writestr(name, data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def infos(self):
+        with contextlib.closing(zipfile.ZipFile(self.zip_path)) as myzip:
+            return myzip.infolist()
+
+    def test_io_errors_reported(self):
+        sent = []
+        saved = (P2B.email_failure, P2B.extract_zip)
+        P2B.email_failure = lambda culprit, message, recipient=None: sent.append(message)
+
+        def extract_zip(*args):
+            raise IOError(errno.ENOSPC, "No space left on device")
+        P2B.extract_zip = extract_zip
+        try:
+            self.assertRaises(P2B.MyException, P2B.unzip, self.tmp_dir + "/", self.zip_path)
+            self.assertRaises(P2B.MyException, P2B.unzip, self.tmp_dir + "/", os.path.join(self.tmp_dir, "gone.zip"))
+        finally:
+            P2B.email_failure, P2B.extract_zip = saved
+        self.assertTrue("No space left on device" in sent[0])
+        self.assertTrue("no such file" in sent[1])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "etd")))
+
+    def test_parallel_extract(self):
+        out = os.path.join(self.tmp_dir, "out")
+        infos = self.infos()
+        nbytes = P2B.extract_zip(self.zip_path, out, infos[1:], infos[:1], workers=4)
+        self.assertEqual(nbytes, sum(len(data) for data in self.contents.values()))
+        self.assertFalse(os.path.exists(os.path.join(out, infos[0].filename)))
+        for info in infos[1:]:
+            with open(os.path.join(out, info.filename), "rb") as f:
+                self.assertEqual(f.read(), self.contents[info.filename])
+
+    def test_corrupt_member(self):
+        infos = self.infos()
+        # Flip a byte in the data of the largest member
+        info = max(infos, key=lambda i: i.file_size)
+        with open(self.zip_path, "r+b") as f:
+            f.seek(info.header_offset + 30 + len(info.filename) + info.compress_size // 2)
+            byte = f.read(1)
+            f.seek(-1, 1)
+            f.write(chr(ord(byte) ^ 0xff))
+        self.assertRaises((zipfile.BadZipfile, zlib.error), P2B.extract_zip, self.zip_path, None, [], infos, 3)
+
+
+class TestByteBudget(unittest.TestCase):
+
+    def test_waits_for_room(self):
+        budget = P2B.ByteBudget(100)
+        budget.acquire(60)
+        admitted = threading.Event()
+
+        def second():
+            budget.acquire(60)
+            admitted.set()
+
+        t = threading.Thread(target=second)
+        t.start()
+        self.assertFalse(admitted.wait(0.1))
+        budget.release(60)
+        self.assertTrue(admitted.wait(1))
+        t.join()
+        budget.release(60)
+
+    def test_oversized_runs_alone(self):
+        budget = P2B.ByteBudget(100)
+        budget.acquire(500)
+        self.assertEqual(budget.in_flight, 500)
+        budget.release(500)
+
+
+class TestAdmission(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.tmp_dir, "etd.zip")
+        with zipfile.ZipFile(self.zip_path, 'w', zipfile.ZIP_DEFLATED) as myzip:
+            myzip.writestr("etd/", "")
+            myzip.writestr("etd/etd_DATA.xml", "<DISS_submission><DISS_binary>etd.pdf</DISS_binary></DISS_submission>")
+            myzip.writestr("etd/etd.pdf", "pdf" * 2000)
+        self.size = 6000 + len("<DISS_submission><DISS_binary>etd.pdf</DISS_binary></DISS_submission>")
+        self.saved = P2B.SPILL_THRESHOLD
+
+    def tearDown(self):
+        P2B.SPILL_THRESHOLD = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def test_zip_contents(self):
+        # Sized from the central directory by unpacked size, not the size of the zip
+        P2B.SPILL_THRESHOLD = 0
+        self.assertEqual(P2B.zip_contents(self.zip_path), (self.size, []))
+        P2B.SPILL_THRESHOLD = 1000
+        self.assertEqual(P2B.zip_contents(self.zip_path), (self.size, ["etd/etd.pdf"]))
+        # unzip reports these
+        self.assertEqual(P2B.zip_contents(os.path.join(self.tmp_dir, "missing.zip")), (0, []))
+        with open(os.path.join(self.tmp_dir, "bad.zip"), "w") as f:
+            f.write("not a zip")
+        self.assertEqual(P2B.zip_contents(os.path.join(self.tmp_dir, "bad.zip")), (0, []))
+
+    def test_spilled_members_stay_in_zip(self):
+        P2B.SPILL_THRESHOLD = 1000
+        working_dir = P2B.unzip(self.tmp_dir + "/", self.zip_path)
+        self.assertEqual(os.listdir(os.path.join(working_dir, "etd")), ["etd_DATA.xml"])
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "queue.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_each_job_claimed_once(self):
+        node_a = P2B.JobQueue(self.db_path, "a")
+        node_b = P2B.JobQueue(self.db_path, "b")
+        self.assertTrue(node_a.enqueue("/uploads/inst/etd.zip", "/uploads/inst/", "admin@example.com"))
+        self.assertFalse(node_b.enqueue("/uploads/inst/etd.zip", "/uploads/inst/", "admin@example.com"))
+        self.assertTrue("/uploads/inst/etd.zip" in node_b)
+
+        self.assertEqual(node_a.claim(), ("/uploads/inst/", "/uploads/inst/etd.zip", "admin@example.com"))
+        self.assertEqual(node_b.claim(), None)
+        node_a.set_state("/uploads/inst/etd.zip", 'done')
+        self.assertEqual(node_b.paths('done'), ["/uploads/inst/etd.zip"])
+        self.assertEqual(node_b.claim(), None)
+
+    def test_expired_lease_is_reclaimed(self):
+        node_a = P2B.JobQueue(self.db_path, "a", lease_time=0)
+        node_b = P2B.JobQueue(self.db_path, "b")
+        node_a.enqueue("/uploads/inst/etd.zip", "/uploads/inst/", "admin@example.com")
+        self.assertNotEqual(node_a.claim(), None)
+        time.sleep(0.01)
+        self.assertNotEqual(node_b.claim(), None)
+
+        # The node that lost its lease cannot record the outcome
+        node_a.set_state("/uploads/inst/etd.zip", 'broken')
+        self.assertEqual(node_b.paths('processing'), ["/uploads/inst/etd.zip"])
+        node_b.set_state("/uploads/inst/etd.zip", 'broken')
+        self.assertEqual(node_b.paths('broken'), ["/uploads/inst/etd.zip"])
+
+        # Removing it from .broken.txt queues it again
+        open(os.path.join(self.tmp_dir, ".broken.txt"), "w").close()
+        node_b.requeue_fixed()
+        self.assertEqual(node_a.paths('queued'), ["/uploads/inst/etd.zip"])
+
+
+class TestUploadStability(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "etd.zip")
+        with zipfile.ZipFile(self.path, 'w') as myzip:
+            myzip.writestr("etd/etd_DATA.xml", "<DISS_submission/>")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_settle_time(self):
+        stability = P2B.UploadStability(settle_time=3600)
+        self.assertFalse(stability.ready(self.path))
+        self.assertTrue(stability.next_deadline() > 3500)
+
+        stability = P2B.UploadStability(settle_time=0)
+        self.assertTrue(stability.ready(self.path))
+        self.assertEqual(stability.next_deadline(), None)
+
+    def test_partial_zip(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:len(data) // 2])
+        stability = P2B.UploadStability(settle_time=0)
+        self.assertFalse(stability.ready(self.path))
+        with open(self.path, "wb") as f:
+            f.write(data)
+        self.assertTrue(stability.ready(self.path))
+
+    def test_marker(self):
+        stability = P2B.UploadStability(settle_time=0, marker_suffix=".done")
+        self.assertEqual(P2B.poll_uploaddir(self.folder, set(), stability), None)
+        open(self.path + ".done", "w").close()
+        self.assertEqual(P2B.poll_uploaddir(self.folder, set(), stability), [self.path])
+
+
 class TestFileMethods(unittest.TestCase):
 
     # Called before each test is run.
@@ -106,6 +1634,8 @@ class TestTransformationMethods(unittest.TestCase):
 
     # Called after each test finishes
     def tearDown(self):
+        # Emails are sent in the background; make sure they have gone out
+        P2B.get_notifier().flush()
         rm_files = glob.glob(P2B.UPLOAD_DIR + "*")
         for f in rm_files:
             if os.path.isfile(f):
@@ -179,4 +1709,50 @@ if __name__ == '__main__':
         suite = unittest.TestLoader().loadTestsFromTestCase(TestFileMethods)
         unittest.TextTestRunner(verbosity=2).run(suite)
         suite = unittest.TestLoader().loadTestsFromTestCase(TestTransformationMethods)
-        unittest.TextTestRunner(verbosity=2).run(suite)
\ No newline at end of file
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestUploadScheduler)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestHttpUploader)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStreamEtd)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestInotifyWatcher)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFileLedger)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestXsltCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAggregator)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSmtpNotifier)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestShellUploader)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestUploadCache)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestEtdJob)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestUploadStability)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMetrics)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestStreamedDocument)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestResourceIndex)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestResourceSlots)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestJobQueue)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestByteBudget)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestAdmission)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSettings)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFairQueue)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestOfflineSinks)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestExtractZip)
+    unittest.TextTestRunner(verbosity=2).run(suite)
\ No newline at end of file
@@ -1,21 +1,31 @@
 import ConfigParser
+import Queue
+import argparse
+import atexit
 import contextlib
-import lxml.etree as ET
+import errno
+import hashlib
+import heapq
+import json
 import os
+import random
 import re
-import smtplib
+import select
+import shutil
+import signal
+import socket
+import struct
 import subprocess
 import sys
-import textwrap
+import tempfile
+import threading
 import time
+import urlparse
 import zipfile
-
-from email import encoders
-from email.message import Message
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import zlib
 
 config = None
+SETTINGS = None
 SLEEP_TIME = None
 UPLOAD_DIR = None
 DB_DIR = None
@@ -24,22 +34,86 @@ RESULT_EMAIL = None
 SMTP_SERVER = None
 SMTP_USER = None
 SMTP_PASSWORD = None
+NOTIFIER = None
 DBUPLOADER_PATH = None
+MAX_PARALLEL_ETDS = None
+MAX_PARALLEL_UPLOADS = None
+UPLOAD_RETRIES = None
+RETRY_BACKOFF = None
+UPLOADER = None
+STREAM_ZIPS = None
+DEBUG_EXTRACT = None
+EXTRACT_WORKERS = 1
+VERIFY_ZIPS = True
+WATCH_MODE = None
+RESCAN_INTERVAL = None
+AGGREGATOR = None
+UPLOAD_CACHE = None
+STABILITY = None
+STREAM_XML = None
+JOBS_DIR = ".jobs"
+CLUSTER_QUEUE = None
+MAX_ETD_BYTES = None
+SPILL_THRESHOLD = None
+BYTE_BUDGET = None
+
+# The FileLedger used by the listener, if one is running
+LEDGER = None
+
+# Set by SIGHUP to make the listener reload settings.conf
+RELOAD_REQUESTED = threading.Event()
 
 # Pattern for shared links returned by dropbox_uploader.sh
 # Captures the URL
 share_link_pattern = re.compile(r' > Share link: (.*)\n')
-# Pattern for fulltext links in transformed xml
-# Captures the URL
-fulltext_pattern = re.compile(r'<fulltext-url>(.*)</fulltext-url>')
-# Pattern for xml header (e.g. <?xml version="1.0" encoding="UTF-8"?>)
-xml_header_pattern = re.compile(r'<\?xml(.+?)\?>')
-# Pattern for attachments
-attachment_pattern = re.compile(r'<DISS_file_name>(.*)</DISS_file_name>')
+# Pattern for files in a directory listing from dropbox_uploader.sh
+# Captures the file name
+listing_file_pattern = re.compile(r'^ \[F\] +\d+ +(.*)$', re.MULTILINE)
 
 class MyException(Exception):
     pass
 
+
+class LazyModule(object):
+    """
+    Stands in for a module that is slow to import and only needed by some
+    commands. The module is imported the first time one of its attributes
+    is used, so the batch command and config checks start quickly.
+    """
+
+    def __init__(self, name):
+        """
+        Parameters:
+            name: Full dotted name of the module, e.g. "lxml.etree"
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module == None:
+            __import__(self._name)
+            self.__dict__['_module'] = sys.modules[self._name]
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+# Only needed once there is an ETD to process, an email to send or an upload to make
+ET = LazyModule("lxml.etree")
+smtplib = LazyModule("smtplib")
+httplib = LazyModule("httplib")
+urllib = LazyModule("urllib")
+# Only needed by the listener's inotify watcher and cluster queue
+ctypes = LazyModule("ctypes")
+ctypes_util = LazyModule("ctypes.util")
+sqlite3 = LazyModule("sqlite3")
+
 # Python 2.6's subprocess module does not have check_call
 # We will add it here
 if "check_output" not in dir( subprocess ):
@@ -67,6 +141,19 @@ def listdir_fullpath(d):
     return [os.path.join(d, f) for f in os.listdir(d)]
 
 
+def get_option(section, option, default):
+    """
+    Returns an optional config value, or default if it is missing or empty.
+    Parameters:
+        section: The config section to look in.
+        option: The name of the option.
+        default: Value returned when the option is not set.
+    """
+    if (not config.has_option(section, option)) or (config.get(section, option) == ''):
+        return default
+    return config.get(section, option)
+
+
 def add_slash(m):
     """
     Helper function that appends a / if one does not exist.
@@ -79,40 +166,682 @@ def add_slash(m):
         return m
 
 
-def unzip(folder, path):
+class Metrics(object):
+    """
+    Collects how long each stage of the pipeline takes, how many bytes it
+    handled and how many ETDs are waiting, so slowness can be pinned on
+    Dropbox, the disk or the XSLT instead of guessed at.
+    Totals are written as a Prometheus textfile (for node_exporter's textfile
+    collector) and every stage and finished ETD is appended to a JSON log.
+    """
+
+    def __init__(self, textfile=None, log_path=None):
+        """
+        Parameters:
+            textfile: Path of the Prometheus textfile to write, or None
+            log_path: Path of the JSON-lines log to append to, or None
+        """
+        self.textfile = textfile
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # stage -> [calls, errors, seconds, bytes]
+        self.stages = dict()
+        # result -> count
+        self.etds = dict()
+        self.etd_seconds = 0.0
+        self.gauges = {'queue_depth': 0, 'etds_in_progress': 0}
+        # folder -> (ETDs waiting, bytes waiting, weight, ETDs started)
+        self.folders = dict()
+        # ETD name -> {stage: seconds} for the ETDs being processed
+        self.running = dict()
+
+    def current_etd(self):
+        """
+        Returns the name of the ETD this thread is working on, or None.
+        """
+        return getattr(self.local, 'etd', None)
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0, etd=None):
+        """
+        Times the enclosed block as one call of stage name.
+        Parameters:
+            name: The stage, e.g. extract, combine, xslt, upload, share, email
+            nbytes: Bytes handled by this call
+            etd: ETD the work is for (defaults to the one this thread is working on)
+        """
+        start = time.time()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record(name, time.time() - start, nbytes, ok, etd or self.current_etd())
+
+    def record(self, name, seconds, nbytes=0, ok=True, etd=None):
+        """
+        Records one call of a stage.
+        """
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += 0 if ok else 1
+            totals[2] += seconds
+            totals[3] += nbytes
+            if etd in self.running:
+                self.running[etd][name] = self.running[etd].get(name, 0.0) + seconds
+        self.log({'event': 'stage', 'etd': etd, 'stage': name, 'seconds': round(seconds, 6),
+                  'bytes': nbytes, 'ok': ok})
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def set_folders(self, state):
+        """
+        Records the queue of each upload folder, as returned by FairQueue.state.
+        """
+        with self.lock:
+            for name, waiting, nbytes, weight, started in state:
+                self.folders[name] = (waiting, nbytes, weight, started)
+
+    def start_etd(self, name):
+        """
+        Marks the start of an ETD on this thread.
+        """
+        self.local.etd = name
+        self.local.start = time.time()
+        with self.lock:
+            self.running[name] = dict()
+            self.gauges['etds_in_progress'] += 1
+
+    def finish_etd(self, result):
+        """
+        Marks the end of this thread's ETD, logs its stage timings and updates the textfile.
+        Parameters:
+            result: done or broken
+        """
+        name = self.local.etd
+        seconds = time.time() - self.local.start
+        self.local.etd = None
+        with self.lock:
+            stages = self.running.pop(name, dict())
+            self.etds[result] = self.etds.get(result, 0) + 1
+            self.etd_seconds += seconds
+            self.gauges['etds_in_progress'] -= 1
+        self.log({'event': 'etd', 'etd': name, 'result': result, 'seconds': round(seconds, 6),
+                  'stages': dict((k, round(v, 6)) for k, v in stages.items())})
+        self.write_textfile()
+
+    def log(self, record):
+        """
+        Appends one record to the JSON log.
+        """
+        if self.log_path == None:
+            return
+        record['time'] = time.time()
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            with open(self.log_path, "a") as f:
+                f.write(line)
+
+    def render(self):
+        """
+        Returns:
+            (String) All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            families = [('p2b_stage_calls_total', 'Calls of each pipeline stage.', 'counter', 0),
+                        ('p2b_stage_errors_total', 'Failed calls of each pipeline stage.', 'counter', 1),
+                        ('p2b_stage_seconds_total', 'Time spent in each pipeline stage.', 'counter', 2),
+                        ('p2b_stage_bytes_total', 'Bytes handled by each pipeline stage.', 'counter', 3)]
+            for metric, help_text, metric_type, index in families:
+                lines.append("# HELP %s %s" % (metric, help_text))
+                lines.append("# TYPE %s %s" % (metric, metric_type))
+                for name in sorted(self.stages):
+                    lines.append('%s{stage="%s"} %s' % (metric, name, self.stages[name][index]))
+            lines.append("# HELP p2b_etds_total ETDs finished, by result.")
+            lines.append("# TYPE p2b_etds_total counter")
+            for result in sorted(self.etds):
+                lines.append('p2b_etds_total{result="%s"} %d' % (result, self.etds[result]))
+            lines.append("# HELP p2b_etd_seconds_total Time spent processing ETDs from start to finish.")
+            lines.append("# TYPE p2b_etd_seconds_total counter")
+            lines.append("p2b_etd_seconds_total %s" % self.etd_seconds)
+            for name in sorted(self.gauges):
+                lines.append("# TYPE p2b_%s gauge" % name)
+                lines.append("p2b_%s %s" % (name, self.gauges[name]))
+            families = [('p2b_folder_queue_depth', 'ETDs waiting, by upload folder.', 'gauge', 0),
+                        ('p2b_folder_queue_bytes', 'Size of the zips waiting, by upload folder.', 'gauge', 1),
+                        ('p2b_folder_weight', 'Share of the workers given to each upload folder.', 'gauge', 2),
+                        ('p2b_folder_started_total', 'ETDs started, by upload folder.', 'counter', 3)]
+            for metric, help_text, metric_type, index in families:
+                if not self.folders:
+                    break
+                lines.append("# HELP %s %s" % (metric, help_text))
+                lines.append("# TYPE %s %s" % (metric, metric_type))
+                for name in sorted(self.folders):
+                    lines.append('%s{folder="%s"} %s' % (metric, name, self.folders[name][index]))
+        lines.append("# TYPE p2b_last_update_timestamp_seconds gauge")
+        lines.append("p2b_last_update_timestamp_seconds %s" % time.time())
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self):
+        """
+        Atomically replaces the Prometheus textfile, if one is configured.
+        """
+        if self.textfile == None:
+            return
+        tmp_path = self.textfile + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.rename(tmp_path, self.textfile)
+
+# Replaced by load_config with one that exports to the configured files
+METRICS = Metrics()
+
+
+class ResourceSlots(object):
+    """
+    Caps how many threads may use each shared resource (disk, network, smtp)
+    at once, across all the ETDs being processed. With more ETD workers than
+    disk slots, some ETDs extract and transform while others upload, which
+    keeps the network link busy without thrashing the disk.
+    Time spent waiting for a slot is recorded as the wait_<resource> stage.
+    """
+
+    def __init__(self, limits=None):
+        """
+        Parameters:
+            limits: Number of slots by resource name. Resources that are
+                    missing or set to 0 are not limited.
+        """
+        self.semaphores = dict()
+        for name, count in (limits or dict()).items():
+            if count > 0:
+                self.semaphores[name] = threading.BoundedSemaphore(count)
+
+    @contextlib.contextmanager
+    def slot(self, name):
+        """
+        Holds one slot of resource name for the enclosed block.
+        """
+        semaphore = self.semaphores.get(name)
+        if semaphore == None:
+            yield
+            return
+        start = time.time()
+        semaphore.acquire()
+        METRICS.record('wait_' + name, time.time() - start)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+# Replaced by load_config with the configured limits
+LIMITS = ResourceSlots()
+
+
+class ByteBudget(object):
+    """
+    Limits the total unpacked size of the ETDs being processed at once.
+    An ETD that would take the total over the budget waits until others
+    finish, so a burst of large packages is worked through a few at a time
+    instead of filling the disk. An ETD larger than the whole budget is
+    still let in once nothing else is in flight.
+    """
+
+    def __init__(self, limit):
+        """
+        Parameters:
+            limit: Budget in bytes
+        """
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        """
+        Blocks until nbytes fit in the budget, then takes them.
+        """
+        start = time.time()
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + nbytes > self.limit:
+                self.condition.wait()
+            self.in_flight += nbytes
+            METRICS.set_gauge('in_flight_bytes', self.in_flight)
+        METRICS.record('wait_budget', time.time() - start)
+
+    def release(self, nbytes):
+        """
+        Returns nbytes to the budget.
+        """
+        with self.condition:
+            self.in_flight -= nbytes
+            METRICS.set_gauge('in_flight_bytes', self.in_flight)
+            self.condition.notify_all()
+
+    def set_limit(self, limit):
+        """
+        Changes the budget, waking any ETDs that now fit.
+        """
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class EtdJob(object):
+    """
+    The persisted progress of one ETD through the pipeline, so that a restart
+    resumes where processing stopped instead of starting over.
+    Stages are completed in order:
+        received, extracted, combined, transformed, uploading, output-uploaded, notified
+    While uploading, the share link of every finished resource is saved, so
+    only the files that were still missing get uploaded after a restart.
+    Combining and transforming happen in memory and are cheap, so they are
+    redone on resume; extraction and uploads are not.
+    """
+
+    STAGES = ('received', 'extracted', 'combined', 'transformed', 'uploading', 'output-uploaded', 'notified')
+
+    def __init__(self, zip_path, jobs_dir=".jobs"):
+        """
+        Loads the job for zip_path, or starts a new one at the received stage.
+        Parameters:
+            zip_path: Full path to the .zip file
+            jobs_dir: Directory job files are kept in
+        """
+        if not os.path.isdir(jobs_dir):
+            os.makedirs(jobs_dir)
+        self.path = os.path.join(jobs_dir, hashlib.sha1(zip_path).hexdigest() + ".json")
+        self.lock = threading.Lock()
+        self.resumed = os.path.exists(self.path)
+        self.data = {'zip': zip_path, 'stage': 'received', 'links': dict(), 'total': None, 'time': time.time()}
+        if self.resumed:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        else:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    @property
+    def stage(self):
+        return self.data['stage']
+
+    @property
+    def links(self):
+        """
+        Share links of the resources uploaded so far, by file name.
+        """
+        return dict(self.data['links'])
+
+    def reached(self, stage):
+        """
+        Returns True if stage has already been completed.
+        """
+        return self.STAGES.index(self.data['stage']) >= self.STAGES.index(stage)
+
+    def advance(self, stage):
+        """
+        Records that stage has been completed.
+        """
+        with self.lock:
+            if self.STAGES.index(stage) > self.STAGES.index(self.data['stage']):
+                self.data['stage'] = stage
+                self.data['time'] = time.time()
+                self._save()
+
+    def set_total(self, total):
+        """
+        Records how many resources the ETD has to upload.
+        """
+        with self.lock:
+            self.data['total'] = total
+            self._save()
+
+    def record_upload(self, name, link):
+        """
+        Records that one resource has been uploaded and shared.
+        """
+        with self.lock:
+            self.data['links'][name] = link
+            self._save()
+
+    def describe(self):
+        """
+        Returns a short description of the job's progress, e.g. "uploaded 3 of 5".
+        """
+        if self.data['stage'] == 'uploading' or (self.data['stage'] == 'transformed' and self.data['links']):
+            return "uploaded %d of %s" % (len(self.data['links']), self.data['total'])
+        return self.data['stage']
+
+    def restart(self):
+        """
+        Goes back to the received stage, e.g. because the working directory the
+        job was extracted to is gone. The uploads recorded so far are kept.
+        """
+        with self.lock:
+            self.data['stage'] = 'received'
+            self.data['time'] = time.time()
+            self._save()
+
+    def finish(self):
+        """
+        Removes the job once the ETD is completely done (or given up on).
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def make_working_dir(folder, path, recipient=None):
     """
+    Creates the directory an ETD is processed in.
     Parameters:
         folder: Path to specific upload folder
         path: Full path to .zip file
+        recipient: Address to send failure reports to (defaults to RESULT_EMAIL)
     Returns:
-        (String) Path to unzipped directory.
+        (String) Path to the new directory.
     """
     filename = os.path.basename(os.path.normpath(path))
     working_dir = os.path.join(folder, os.path.splitext(filename)[0])
     try:
         os.mkdir(working_dir)
-    except OSError as e:
+    except OSError:
         print path + ": " + "That directory already exists! Possible unclean runthrough?"
         print "Sending error report..."
         error_msg = "Tried to extract %s but %s already exists! This means that the script has already tried processing "\
-                    "this file. The script has likely forgotten what files it has seen (check  that .seen.txt and .broken.txt exist)"\
+                    "this file. The script has likely forgotten what files it has seen (check  that .ledger.log and .broken.txt exist)"\
                     % (filename, working_dir)
-        email_failure(filename, error_msg)
+        email_failure(filename, error_msg, recipient)
         raise MyException("Unclean runthrough")
+    return working_dir
+
+
+def zip_contents(path):
+    """
+    Reads a zip's central directory without extracting anything.
+    Parameters:
+        path: Full path to .zip file
+    Returns:
+        (int, list) The total unpacked size of the zip and the names of the
+        members larger than SPILL_THRESHOLD, which are left in the zip.
+        (0, []) if the zip cannot be read; unzip reports that.
+    """
+    try:
+        with contextlib.closing(zipfile.ZipFile(path, 'r')) as archive:
+            infos = archive.infolist()
+    except (IOError, zipfile.BadZipfile, zipfile.LargeZipFile):
+        return 0, []
+    spilled = []
+    if SPILL_THRESHOLD:
+        spilled = [i.filename for i in infos if i.file_size > SPILL_THRESHOLD and not i.filename.endswith("/")]
+    return sum([i.file_size for i in infos]), spilled
+
+
+def extract_zip(path, working_dir, extract, verify=(), workers=1):
+    """
+    Extracts members of a zip and checks the CRCs of others without writing
+    them out, spread over several threads. zlib lets go of the GIL while it
+    inflates, so the threads use several cores. Each thread opens its own
+    handle on the archive, since one ZipFile cannot be read from several
+    threads at once, and takes the largest member left so that no thread
+    ends up alone with a big PDF. A corrupt member stops the others early.
+    Parameters:
+        path: Full path to .zip file
+        working_dir: Directory to extract into
+        extract: ZipInfos of the members to extract
+        verify: ZipInfos of the members to only check
+        workers: Number of threads to use
+    Returns:
+        (int) Bytes decompressed.
+    Raises:
+        zipfile.BadZipfile or zlib.error if a member is corrupt.
+    """
+    work = sorted([(info, True) for info in extract] + [(info, False) for info in verify],
+                  key=lambda item: item[0].file_size)
+    total = sum([info.file_size for info, _ in work])
+    lock = threading.Lock()
+    errors = []
+
+    def run():
+        try:
+            with contextlib.closing(zipfile.ZipFile(path, 'r')) as archive:
+                while True:
+                    with lock:
+                        if errors or not work:
+                            return
+                        info, write = work.pop()
+                    if not write:
+                        # Reading to the end makes ZipExtFile compare the CRC
+                        with contextlib.closing(archive.open(info)) as f:
+                            while f.read(1024 * 1024):
+                                pass
+                        continue
+                    try:
+                        archive.extract(info, working_dir)
+                    except OSError as e:
+                        # Another thread created the same folder between the check and makedirs
+                        if e.errno != errno.EEXIST:
+                            raise
+                        archive.extract(info, working_dir)
+        except Exception as e:
+            with lock:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run, name="unzip-%d" % i) for i in range(max(1, min(workers, len(work))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return total
+
+
+def unzip(folder, path, recipient=None, job=None):
+    """
+    Parameters:
+        folder: Path to specific upload folder
+        path: Full path to .zip file
+        recipient: Address to send failure reports to (defaults to RESULT_EMAIL)
+        job: The EtdJob tracking this ETD, if any
+    Returns:
+        (String) Path to unzipped directory.
+    Members larger than SPILL_THRESHOLD are not extracted; they are uploaded
+    straight from the zip instead.
+    """
+    filename = os.path.basename(os.path.normpath(path))
+    if job != None and job.reached('extracted'):
+        print "%s was already extracted, resuming" % filename
+        return add_slash(os.path.join(folder, os.path.splitext(filename)[0]))
+    working_dir = make_working_dir(folder, path, recipient)
 
     try:
         with contextlib.closing(zipfile.ZipFile(path, 'r')) as myzip:
-            myzip.extractall(working_dir)
+            members = myzip.infolist()
+            missing = find_missing_references(myzip)
+        if missing:
+            # Nothing is extracted from a package that could not be published anyway
+            shutil.rmtree(working_dir, True)
+            reject_unmatched(filename, missing, recipient)
+        with LIMITS.slot('disk'):
+            with METRICS.stage('extract', os.path.getsize(path)):
+                spilled = []
+                if SPILL_THRESHOLD:
+                    spilled = [i for i in members if i.file_size > SPILL_THRESHOLD]
+                    members = [i for i in members if i.file_size <= SPILL_THRESHOLD]
+                if not VERIFY_ZIPS:
+                    spilled = []
+                # Large members stay in the zip but are checked now, before anything is uploaded
+                start = time.time()
+                nbytes = extract_zip(path, working_dir, members, spilled, EXTRACT_WORKERS)
+                elapsed = max(time.time() - start, 1e-6)
+        print "Extracted %s: %.1f MB in %.2f seconds (%.1f MB/s)" % (filename, nbytes / 1048576.0, elapsed, nbytes / 1048576.0 / elapsed)
+        if job != None:
+            job.advance('extracted')
         return add_slash(working_dir)
     except IOError as e:
+        shutil.rmtree(working_dir, True)
+        if e.errno != errno.ENOENT:
+            # e.g. the disk filled up while extracting
+            print path + ": " + "Could not extract the zip! (%s)" % e
+            print "Sending error report..."
+            email_failure(filename, "Tried to extract %s but failed: %s\nNothing was uploaded." % (filename, e), recipient)
+            raise MyException("Extraction failed")
+        print path + ": " + "No such file in upload directory!"
+        print "Sending error report..."
+        email_failure(filename, "Tried to extract %s but there was no such file in %s!" % (filename, folder), recipient)
+        raise MyException("File missing")
+    except (zipfile.BadZipfile, zlib.error) as e:
+        print path + ": " + "The zip is corrupt! (%s)" % e
+        print "Sending error report..."
+        shutil.rmtree(working_dir, True)
+        email_failure(filename, "Tried to extract %s but it is corrupt: %s\nNothing was uploaded." % (filename, e), recipient)
+        raise MyException("Corrupt zip")
+
+
+def find_missing_references(archive):
+    """
+    Checks the files an ETD's xml refers to against the zip's central
+    directory, so that an incomplete package is turned away before it is
+    extracted. transform_files checks again against what was extracted.
+    Parameters:
+        archive: The open zipfile.ZipFile of the ETD
+    Returns:
+        (list) The references that match no member (or more than one).
+    """
+    xmls = []
+    resource_files = []
+    for info in archive.infolist():
+        if info.filename.endswith("/"):
+            continue
+        if os.path.splitext(info.filename)[1] != ".xml":
+            resource_files += [ZipMember(archive, info)]
+        else:
+            xmls += [ZipMember(archive, info)]
+    index = ResourceIndex(None, resource_files)
+    return index.validate([text for _, text in collect_references(xmls)])
+
+
+def reject_unmatched(filename, missing, recipient=None):
+    """
+    Reports files the xml refers to that are not in the ETD.
+    Parameters:
+        filename: Name of the .zip file
+        missing: The references that could not be matched
+        recipient: Address to send the report to (defaults to RESULT_EMAIL)
+    Raises:
+        MyException, always.
+    """
+    print "Unmatched file!"
+    print "Sending error report..."
+    error_msg = "These files are referenced in the xml but could not be found in the zip:\n"\
+                "%s\n"\
+                "Nothing was uploaded to Dropbox." % "\n".join(missing)
+    email_failure(filename, error_msg, recipient)
+    raise MyException("Unmatched file")
+
+
+class ZipMember(object):
+    """
+    A resource file that is read straight out of the ETD zip instead of from disk.
+    """
+
+    def __init__(self, archive, info):
+        """
+        Parameters:
+            archive: The open zipfile.ZipFile containing the member
+            info: The member's zipfile.ZipInfo
+        """
+        self.archive = archive
+        self.info = info
+        self.size = info.file_size
+
+    def open(self):
+        """
+        Opens the member for reading. Each call gets its own handle on the
+        archive, so members can be read from several threads at once.
+        """
+        return self.archive.open(self.info)
+
+    def __str__(self):
+        return self.info.filename
+
+
+def stream_etd(folder, path, recipient=None, job=None):
+    """
+    Processes an ETD zip without extracting it. XML members are parsed from the
+    archive and resource members are streamed from it into Dropbox. Only the
+    finished xml is written to the working directory, unless DEBUG_EXTRACT is set.
+    Parameters:
+        folder: Path to specific upload folder
+        path: Full path to .zip file
+        recipient: Address to send results to (defaults to RESULT_EMAIL)
+        job: The EtdJob tracking this ETD, if any
+    """
+    filename = os.path.basename(os.path.normpath(path))
+    if job != None and job.reached('extracted'):
+        working_dir = os.path.join(folder, os.path.splitext(filename)[0])
+    else:
+        working_dir = make_working_dir(folder, path, recipient)
+
+    try:
+        archive = zipfile.ZipFile(path, 'r')
+    except IOError as e:
+        shutil.rmtree(working_dir, True)
+        if e.errno != errno.ENOENT:
+            print path + ": " + "Could not read the zip! (%s)" % e
+            print "Sending error report..."
+            email_failure(filename, "Tried to read %s but failed: %s\nNothing was uploaded." % (filename, e), recipient)
+            raise MyException("Extraction failed")
         print path + ": " + "No such file in upload directory!"
         print "Sending error report..."
-        os.rmdir(working_dir)
-        email_failure(filename, "Tried to extract %s but there was no such file in %s!" % (filename, folder))
+        email_failure(filename, "Tried to extract %s but there was no such file in %s!" % (filename, folder), recipient)
         raise MyException("File missing")
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        print path + ": " + "The zip is corrupt! (%s)" % e
+        print "Sending error report..."
+        shutil.rmtree(working_dir, True)
+        email_failure(filename, "Tried to extract %s but it is corrupt: %s\nNothing was uploaded." % (filename, e), recipient)
+        raise MyException("Corrupt zip")
 
+    with contextlib.closing(archive):
+        if not (job != None and job.reached('extracted')):
+            missing = find_missing_references(archive)
+            if missing:
+                shutil.rmtree(working_dir, True)
+                reject_unmatched(filename, missing, recipient)
+            extract = []
+            verify = archive.infolist()
+            if DEBUG_EXTRACT:
+                extract, verify = verify, []
+            elif not VERIFY_ZIPS:
+                verify = []
+            try:
+                with LIMITS.slot('disk'):
+                    # Check every member before the first one is streamed into Dropbox
+                    extract_zip(path, working_dir, extract, verify, EXTRACT_WORKERS)
+            except (zipfile.BadZipfile, zlib.error) as e:
+                print path + ": " + "The zip is corrupt! (%s)" % e
+                print "Sending error report..."
+                shutil.rmtree(working_dir, True)
+                email_failure(filename, "Tried to extract %s but it is corrupt: %s\nNothing was uploaded." % (filename, e), recipient)
+                raise MyException("Corrupt zip")
+        if job != None:
+            job.advance('extracted')
+        transform_files(add_slash(working_dir), recipient, archive, job)
 
-def transform_files(file_dir):
+
+def transform_files(file_dir, recipient=None, archive=None, job=None, spilled=None):
     """
     Transforms an unzipped ProQuest etd directory by:
         1) Combining all xml data
@@ -120,365 +849,3035 @@ def transform_files(file_dir):
         3) Uploading resource files to Dropbox and inserting links into the xml.
     Parameters:
         file_dir: The full path to the unzipped ProQuest etd directory.
+        recipient: Address to send results to (defaults to RESULT_EMAIL)
+        archive: An open zipfile.ZipFile to read the etd from instead of file_dir
+        job: The EtdJob tracking this ETD, if any
+        spilled: Names of the only members to read from archive; the rest were extracted to file_dir
     """
     xmls = []
     resource_files = []
-    for dirpath, _, files in os.walk(file_dir):
-        for filen in files:
-            filepath = os.path.join(dirpath, filen)
-            if os.path.splitext(filepath)[1] != ".xml":
-                resource_files += [filepath]
+    if archive == None or spilled != None:
+        for dirpath, _, files in os.walk(file_dir):
+            for filen in files:
+                filepath = os.path.join(dirpath, filen)
+                if os.path.splitext(filepath)[1] != ".xml":
+                    resource_files += [filepath]
+                else:
+                    xmls += [filepath]
+    if archive != None:
+        for info in archive.infolist():
+            if info.filename.endswith("/"):
+                continue
+            if spilled != None and info.filename not in spilled:
+                continue
+            if os.path.splitext(info.filename)[1] != ".xml":
+                resource_files += [ZipMember(archive, info)]
             else:
-                xmls += [filepath]
+                xmls += [ZipMember(archive, info)]
 
     if len(xmls) > 1:
         print "More than one xml file"
 
     dirname = file_dir.split("/")[-2]
-    working_dir = file_dir
 
-    print "Combining XMLs..."
-    combine_xmls(file_dir, xmls)
+    index = ResourceIndex(file_dir, resource_files)
+    transform = xslt_cache.get(stylesheet_for(file_dir.split("/")[-3]))
+    if STREAM_XML:
+        # Submissions are combined and transformed one at a time while the output is written
+        references = collect_references(xmls)
+        newdom = StreamedDocument(xmls, transform)
+    else:
+        print "Combining XMLs..."
+        with METRICS.stage('combine'):
+            dom = combine_xmls(xmls)
+        references = [(e.tag, e.text.strip()) for e in dom.iter("DISS_binary", "DISS_file_name")
+                      if e.text and e.text.strip()]
+        if job != None:
+            job.advance('combined')
+
+        print "Transforming using XSLT..."
+        with METRICS.stage('xslt'):
+            newdom = transform(dom)
+    if job != None:
+        job.advance('transformed')
 
-    print "Transforming using XSLT..."
-    dom = ET.parse(working_dir + "Combined.xml")
-    xslt = ET.parse(XSLT_PATH)
-    transform = ET.XSLT(xslt)
-    newdom = transform(dom)
-    result = ET.tostring(newdom, pretty_print=True)
-    with open(working_dir + "Transformed.xml", "wb") as f:
-        f.write(result)
+    # Check that every file the xml refers to is in the package before uploading anything
+    missing = index.validate([text for _, text in references])
+    if missing:
+        reject_unmatched(dirname + ".zip", missing, recipient)
 
     print "Uploading files and inserting links..."
-    dropboxify(file_dir, working_dir + "Transformed.xml", resource_files)
+    output_path = dropboxify(file_dir, newdom, resource_files, recipient, upload_output=(AGGREGATOR == None), job=job,
+                             index=index)
 
-    if len(resource_files) <= 1:
-        email_success(dirname)
-    else:
-        attachments = []
-        for xml in xmls:
-            with open(xml) as f:
-                xml_text = f.read()
-                atts = re.findall(attachment_pattern, xml_text)
-                if len(atts) > 0:
-                    attachments += re.findall(attachment_pattern, xml_text)
-        email_success_attachments(dirname, attachments)
-    
-
-def combine_xmls(dirpath, xmls):
-    """
-    Creates a ombined xml document by:
-        1) Writing the necessary xml headers and root tags
-        2) Stripping the header from all input documnets
-        3) Concatenating the resulting files
-    Parameters:
-        dirpath: Full path to unzipped etd directory
-        xmls: List containing full paths to each xml file
-    Side-Effects:
-        Writes combined xmls to Combined.xml
-    """
-    dirname = os.path.basename(os.path.normpath(dirpath))
-    with open(dirpath + "/Combined.xml", "ab+") as f:
-        f.write("""<?xml version="1.0" encoding="UTF-8"?>\r\n""")
-        f.write("""<?xml-stylesheet type="text/xsl" href="result.xsl"?>\r\n""")
-        f.write("""<DISS_Documents>""")
-        for xml in xmls:
-            with open(xml, "rb") as xmlf:
-                xml_text = xmlf.read()
-                stripped_xml_text = re.sub(xml_header_pattern, "", xml_text)
-                f.write(stripped_xml_text)
-        f.write("""</DISS_Documents>""")
+    attachments = []
+    if len(resource_files) > 1:
+        attachments = [text for tag, text in references if tag == "DISS_file_name"]
 
+    if job != None and job.reached('notified'):
+        pass
+    elif AGGREGATOR != None:
+        # The output will be merged with other ETDs from this folder and announced later
+        AGGREGATOR.add(file_dir.split("/")[-3], output_path, dirname, attachments, recipient)
+    elif len(resource_files) <= 1:
+        email_success(dirname, recipient)
+    else:
+        email_success_attachments(dirname, attachments, recipient)
+    if job != None:
+        job.advance('notified')
 
-#A mapping of resource document names to Dropbox URLs
-link_map = dict()
 
-def replace_link(m):
+class XsltCache(object):
     """
-    Takes a <fulltext-url> tag and replaces the relative URL with the appropriate Dropbox link.
-    Parameters:
-        m: The sting containing the full tag.
+    Keeps compiled XSLT stylesheets for the life of the process.
+    A stylesheet is re-read when its mtime or size changes and recompiled only
+    if its contents actually differ. Compiled transforms are kept per thread,
+    so worker threads never share one.
     """
-    inner_link = m.group(1)
-    try:
-        new_link = link_map[inner_link]
-    except Exception as e:
-        print "Unmatched file!"
-        print "Sending error report..."
-        error_msg = "A file referenced in the xml could not be mapped to a Dropbox url.\n"\
-                    "Full error:\n"\
-                    "%s" % (e)
-        raise MyException("Unmatched file")
 
-    return "<fulltext-url>" + new_link + "</fulltext-url>"
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> ((mtime, size), sha1 of contents, contents)
+        self.sources = dict()
+        self.local = threading.local()
 
+    def get(self, path):
+        """
+        Returns the compiled transform for the stylesheet at path.
+        Parameters:
+            path: Path to the .xsl file
+        """
+        st = os.stat(path)
+        stat_key = (st.st_mtime, st.st_size)
+        with self.lock:
+            source = self.sources.get(path)
+            if source == None or source[0] != stat_key:
+                with open(path, "rb") as f:
+                    data = f.read()
+                source = (stat_key, hashlib.sha1(data).hexdigest(), data)
+                self.sources[path] = source
+        _, digest, data = source
 
-def dropboxify(dirpath, xml, resource_files):
-    """
-    Converts a combined xml document into one ready for Bepress uploading by:
-        1) Uploading resources to dropbox
-        2) Generating Dropbox share links
-        3) Inserting links into the xml
-    Parameters:
-        dirpath: Full path to unzipped ProQuest ETD directory
-        xml: Path to the combined xml file
-        resource_files: A list containing full paths to all resource files (.pdf, etc.)
-    Side-Effects:
-        Writes completed xml to Output.xml
-    """
-    global link_map
-    link_map = dict()
+        compiled = getattr(self.local, "compiled", None)
+        if compiled == None:
+            compiled = self.local.compiled = dict()
+        if path not in compiled or compiled[path][0] != digest:
+            # base_url lets xsl:include and xsl:import resolve relative to the stylesheet
+            compiled[path] = (digest, ET.XSLT(ET.fromstring(data, base_url=path)))
+        return compiled[path][1]
 
-    # Base name of unzipped ETD directory
-    dirname = os.path.basename(os.path.normpath(dirpath))
 
-    # Upload all the resource files to dropbox and generate links for each
-    # The resulting generated links get added to the link_map
-    for fpath in resource_files:
-        upload_folder = dirpath.split("/")[-3]
-        fname = os.path.basename(fpath)
-        try:
-            subprocess.check_call([DBUPLOADER_PATH, "upload", fpath, DB_DIR + "/" + upload_folder + "/" + dirname + "/" + fname])
-            output = subprocess.check_output([DBUPLOADER_PATH, "share", DB_DIR + "/" + upload_folder + "/" + dirname + "/" + fname])
-            match = re.search(share_link_pattern, output)
-            if match != None:
-                share_link = match.group(1)
-                share_link = share_link[:-1] + "1"
-                #print fname + ": " + share_link
-                link_map[fname] = share_link
-        except Exception as e:
-            print e
-            print "Error uploading to dropbox!"
-            print "Sending error report..."
-            error_msg = "There was a problem uploading %s to Dropbox.\n"\
-                        "Full error follows:\n"\
-                        "%s" % (fname, e)
-            email_failure(dirname + ".zip", error_msg)
-            raise MyException("Dropbox upload error")
+xslt_cache = XsltCache()
 
-    # Where we want to put the resulting files
-    working_dir = dirpath
-    # Base name of original xml
-    xml_basename = os.path.basename(xml)
-    # Name of our finished xml file
-    finished_fname = dirname + "_Output.xml"
 
-    # Write out the finished xml file
-    with open(xml, "rb") as f:
-        xmlf = open(working_dir + finished_fname, "w+b")
-        xml_text = f.read()
-        new_xml_text = re.sub(fulltext_pattern, replace_link, xml_text)
-        xmlf.write(new_xml_text)
-        xmlf.close()
-    
-    # Upload finished xml
-    try:
-        subprocess.check_call([DBUPLOADER_PATH, "upload", working_dir + finished_fname, DB_DIR + "/" + upload_folder + "/" + dirname + "/" + finished_fname])
-    except Exception as e:
-        print e
-        print "Error uploading to dropbox!"
-        print "Sending error report..."
-        error_msg = "There was a problem uploading %s+_Output.xml to Dropbox.\n"\
-                    "Full error follows:\n"\
-                    "%s" % (dirname, e)
-        email_failure(dirname + ".zip", error_msg)
-        raise MyException("Dropbox upload error")
+def stylesheet_for(upload_folder):
+    """
+    Picks the stylesheet for an upload folder. A folder can have its own
+    stylesheet by adding a line for it in [xslt], just like in [email].
+    Parameters:
+        upload_folder: Name of the upload folder the ETD arrived in
+    """
+    return get_option('xslt', upload_folder, XSLT_PATH)
 
 
-def email_success(dirname):
+def combine_xmls(xmls):
     """
-    Email administrator a success message.
+    Creates a combined xml document in memory by parsing each input document
+    and appending its root element to a single DISS_Documents root.
     Parameters:
-        dirname: Name of unzipped ProQuest ETD directory
+        xmls: List containing full paths (or ZipMembers) for each xml file
+    Returns:
+        (ElementTree) The combined document.
     """
-    # Set up multipart message
-    msg = MIMEMultipart()
-    msg['Subject'] = '%s is ready for upload' % dirname
-    msg['To'] = RESULT_EMAIL
-    msg['From'] = "pi@localhost"
-    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+    root = ET.Element("DISS_Documents")
+    for xml in xmls:
+        with contextlib.closing(open_resource(xml)) as f:
+            root.append(ET.parse(f).getroot())
+    return ET.ElementTree(root)
 
-    # Create and add body
-    body = "%s/Output.xml is ready to be uploaded." % dirname
-    part1 = MIMEText(body, 'plain')
-    msg.attach(part1)
 
-    # Send the email using SMTP
-    s = smtplib.SMTP_SSL(SMTP_SERVER, 465)
-    s.login(SMTP_USER, SMTP_PASSWORD)
-    s.sendmail("pi@localhost", RESULT_EMAIL, msg.as_string())
-    s.quit()
+def iter_elements(sources, tag):
+    """
+    Parses xml files incrementally and yields their tag elements one at a time.
+    Each element is cleared once the caller moves on, and everything parsed
+    before it is dropped at every level of the tree, so memory use does not
+    grow with the size of the files even when the elements are nested inside
+    others (e.g. the DISS_binary of each DISS_submission).
+    libxml2's limit on the size of a single text node is lifted, since some
+    abstracts exceed it.
+    Parameters:
+        sources: List containing full paths (or ZipMembers) for each xml file
+        tag: Name of the elements to yield
+    """
+    for source in sources:
+        with contextlib.closing(open_resource(source)) as f:
+            for _, element in ET.iterparse(f, events=('end',), tag=tag, huge_tree=True):
+                yield element
+                element.clear()
+                for node in [element] + list(element.iterancestors()):
+                    while node.getprevious() is not None:
+                        del node.getparent()[0]
 
 
-def email_success_attachments(dirname, attachments):
+def read_root(source):
     """
-    Email administrator a success message with need for manual attachments.
+    Returns an empty copy (tag, attributes and namespaces) of the root element
+    of an xml file, without reading the rest of it.
     Parameters:
-        dirname: Name of unzipped ProQuest ETD directory
+        source: A full path or a ZipMember
     """
-    # Set up multipart message
-    msg = MIMEMultipart()
-    msg['Subject'] = '%s requires manual intervention' % dirname
-    msg['To'] = RESULT_EMAIL
-    msg['From'] = "pi@localhost"
-    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+    with contextlib.closing(open_resource(source)) as f:
+        for _, element in ET.iterparse(f, events=('start',)):
+            return ET.Element(element.tag, dict(element.attrib), nsmap=element.nsmap)
 
-    # Create and add body
-    body = "%s/Output.xml is ready to be uploaded.\n" % dirname
-    body += "Additionally the following files will need to be manually attached: \n"
-    for att in attachments:
-        body += os.path.basename(att) + "\n"
-    part1 = MIMEText(body, 'plain')
-    msg.attach(part1)
 
-    # Send the email using SMTP
-    s = smtplib.SMTP_SSL(SMTP_SERVER, 465)
-    s.login(SMTP_USER, SMTP_PASSWORD)
-    s.sendmail("pi@localhost", RESULT_EMAIL, msg.as_string())
-    s.quit()
+def write_documents(path, root, elements):
+    """
+    Writes elements below a copy of root to path one element at a time.
+    Each element repeats the namespace declarations it uses, otherwise the
+    result is the same as serializing the whole tree at once.
+    Parameters:
+        path: File to write
+        root: Element whose tag, attributes and namespaces the output root gets
+        elements: Iterable of elements to write below the root
+    """
+    with ET.xmlfile(path, encoding="UTF-8") as xf:
+        xf.write_declaration()
+        with xf.element(root.tag, dict(root.attrib), nsmap=root.nsmap):
+            xf.write("\n")
+            for element in elements:
+                xf.write(element, pretty_print=True)
 
 
-def email_failure(culprit, message):
+class StreamedDocument(object):
     """
-    Email administrator a failure message.
-    Parameters:
-        culprit: Name of file that resulted in an error
-        message: Full message detailing error
+    Takes the place of the transformed document when [xml] streaming is on.
+    Instead of combining every DISS_submission into one tree, each submission
+    is parsed, transformed, linked and written out on its own, so memory use
+    stays flat however large or numerous the submissions are.
+    This requires an XSLT that handles each DISS_submission independently,
+    as result.xsl does.
     """
-    # Set up multipart message
-    msg = MIMEMultipart()
-    msg['Subject'] = 'Processing of %s FAILED!' % culprit
-    msg['To'] = RESULT_EMAIL
-    msg['From'] = "pi@localhost"
-    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
 
-    # Create part from passed in message
-    part1 = MIMEText(message, 'plain')
-    msg.attach(part1)
+    def __init__(self, xmls, transform):
+        """
+        Parameters:
+            xmls: List containing full paths (or ZipMembers) for each xml file
+            transform: The compiled XSLT
+        """
+        self.xmls = xmls
+        self.transform = transform
 
-    # Send the email using SMTP
-    s = smtplib.SMTP_SSL(SMTP_SERVER, 465)
-    s.login(SMTP_USER, SMTP_PASSWORD)
-    s.sendmail("pi@localhost", RESULT_EMAIL, msg.as_string())
-    s.quit()
+    def documents(self, link_map):
+        """
+        Yields the transformed elements of each submission with their links inserted.
+        """
+        for submission in iter_elements(self.xmls, "DISS_submission"):
+            # Moving the submission under its own root detaches it from the file being parsed
+            combined = ET.Element("DISS_Documents")
+            combined.append(submission)
+            with METRICS.stage('xslt'):
+                result = self.transform(ET.ElementTree(combined)).getroot()
+            rewrite_links(result, link_map)
+            for document in result:
+                yield document
 
+    def write(self, path, link_map):
+        """
+        Streams the finished xml to path.
+        Raises:
+            KeyError naming the first file that has no Dropbox link.
+        """
+        # The root the XSLT produces, taken from a run over no submissions at all
+        root = self.transform(ET.ElementTree(ET.Element("DISS_Documents"))).getroot()
+        write_documents(path, root, self.documents(link_map))
 
-def poll_uploaddir(folder, seen_files):
+
+def open_resource(resource):
     """
-    Checks for new files in the upload dir.
+    Opens a resource file for reading, whether it is on disk or inside a zip.
     Parameters:
-        seen_files: A list of already seen filepaths
+        resource: A full path or a ZipMember
     """
-    before = dict ([(f, None) for f in seen_files if os.path.isfile(f)])
-    after = dict ([(f, None) for f in listdir_fullpath(folder) if os.path.isfile(f)])
-    added = [f for f in after if not f in before]
-    if added: 
-        print "Added: ", ", ".join (added)
-        return added
-    return None
+    if isinstance(resource, ZipMember):
+        return resource.open()
+    return open(resource, "rb")
 
 
-def load_config():
+def resource_size(resource):
     """
-    Loads options from settings.conf into global variables.
+    Returns the size in bytes of a resource file on disk or inside a zip.
+    Parameters:
+        resource: A full path or a ZipMember
     """
-    global SLEEP_TIME
-    global UPLOAD_DIR
-    global DB_DIR
-    global XSLT_PATH
-    #global RESULT_EMAIL
-    global SMTP_USER
-    global SMTP_PASSWORD
-    global SMTP_SERVER
-    global DBUPLOADER_PATH
+    if isinstance(resource, ZipMember):
+        return resource.size
+    return os.path.getsize(resource)
 
-    global config
-    config = ConfigParser.ConfigParser()
-    config.read('settings.conf')
-
-    # Check that all options are present
-    time_options = ['sleep_time']
-    for option in time_options:
-        if (not config.has_option('time', option)) or (config.get('time', option) == ''):
-            print "Missing option in [time]: %s" % option
-            sys.exit()
-    dirs_options = ['upload_dir', 'dropbox_dir']
-    for option in dirs_options:
-        if (not config.has_option('dirs', option)) or (config.get('dirs', option) == ''):
-            print "Missing option in [dirs]: %s" % option
-            sys.exit()
-    xslt_options = ['xslt_path']
-    for option in xslt_options:
-        if (not config.has_option('xslt', option)) or (config.get('xslt', option) == ''):
-            print "Missing option in [xslt]: %s" % option
-            sys.exit()
-    smtp_options = ['smtp_server', 'smtp_user', 'smtp_password']
-    for option in smtp_options:
-        if (not config.has_option('smtp', option)) or (config.get('smtp', option) == ''):
-            print "Missing option in [smtp]: %s" % option
-            sys.exit()
-    dropbox_options = ['dbuploader_path']
-    for option in dropbox_options:
-        if (not config.has_option('dropbox', option)) or (config.get('dropbox', option) == ''):
-            print "Missing option in [dropbox]: %s" % option
-            sys.exit()
-
-    SLEEP_TIME = int(config.get('time', 'sleep_time'))
-    UPLOAD_DIR = add_slash(config.get('dirs', 'upload_dir'))
-    DB_DIR = add_slash(config.get('dirs', 'dropbox_dir'))
-    XSLT_PATH = config.get('xslt', 'xslt_path')
-    #RESULT_EMAIL = config.get('email', 'recipient_address')
-    SMTP_SERVER = config.get('smtp', 'smtp_server')
-    SMTP_USER = config.get('smtp', 'smtp_user')
-    SMTP_PASSWORD = config.get('smtp', 'smtp_password')
-    DBUPLOADER_PATH = config.get('dropbox', 'dbuploader_path')
 
+def rewrite_links(dom, link_map):
+    """
+    Replaces the relative URL in every <fulltext-url> element with the appropriate Dropbox link.
+    Parameters:
+        dom: The transformed document, modified in place
+        link_map: A mapping of resource document names to Dropbox URLs
+    Raises:
+        KeyError naming the first file that has no Dropbox link.
+    """
+    for element in dom.iter("fulltext-url"):
+        if element.text and element.text.strip():
+            element.text = link_map[element.text.strip()]
 
-def run_listener():
-    seen_files_f = open(".seen.txt", "a+")
-    seen_files = [line.strip() for line in seen_files_f.readlines()]
-    with open(".broken.txt", "r") as b:
-        seen_files += [line.strip() for line in b.readlines()]
+
+def collect_references(xmls):
+    """
+    Reads the file names an ETD's xml refers to, without keeping the documents in memory.
+    Parameters:
+        xmls: List containing full paths (or ZipMembers) for each xml file
+    Returns:
+        (list) (tag, file name) for every DISS_binary and DISS_file_name, in document order.
+    """
+    return [(e.tag, e.text.strip()) for e in iter_elements(xmls, ("DISS_binary", "DISS_file_name"))
+            if e.text and e.text.strip()]
+
+
+class ResourceIndex(object):
+    """
+    Finds the resource file that a DISS_binary or DISS_file_name refers to.
+    References may be a bare file name or a path inside the ETD, in any case;
+    every trailing part of each file's path is indexed as written and in lower
+    case, and only unambiguous matches are accepted.
+    Built once per ETD so that every reference can be checked before anything
+    is uploaded, and the links can then be filled in with plain lookups.
+    """
+
+    def __init__(self, file_dir, resource_files):
+        """
+        Parameters:
+            file_dir: The full path to the unzipped ProQuest etd directory
+            resource_files: A list containing full paths (or ZipMembers) for all resource files
+        """
+        self.resources = resource_files
+        self.paths = dict()
+        self.index = dict()
+        for resource in resource_files:
+            if isinstance(resource, ZipMember):
+                path = str(resource)
+            else:
+                path = os.path.relpath(resource, file_dir)
+            path = path.replace(os.sep, "/")
+            self.paths[resource] = path
+            parts = path.split("/")
+            for i in range(len(parts)):
+                suffix = "/".join(parts[i:])
+                for key in set([suffix, suffix.lower()]):
+                    self.index.setdefault(key, set()).add(resource)
+
+        # Resources are uploaded under their file name unless another resource shares it
+        names = dict()
+        for resource, path in self.paths.items():
+            names.setdefault(os.path.basename(path), []).append(resource)
+        self.names = dict()
+        for name, resources in names.items():
+            for resource in resources:
+                if len(resources) == 1:
+                    self.names[resource] = name
+                else:
+                    # Drop the top-level directory every ETD zip has
+                    self.names[resource] = self.paths[resource].split("/", 1)[-1]
+        # Reference -> resource, filled in by validate()
+        self.resolved = dict()
+
+    def name(self, resource):
+        """
+        Returns the name resource is uploaded and linked under.
+        """
+        return self.names[resource]
+
+    def resolve(self, reference):
+        """
+        Returns the resource reference refers to, or None if there is no single match.
+        """
+        reference = reference.strip().replace("\\", "/")
+        while reference.startswith("./"):
+            reference = reference[2:]
+        reference = reference.lstrip("/")
+        for key in (reference, reference.lower()):
+            matches = self.index.get(key, set())
+            if len(matches) == 1:
+                return list(matches)[0]
+        return None
+
+    def validate(self, references):
+        """
+        Resolves every reference up front.
+        Parameters:
+            references: File names taken from the xml
+        Returns:
+            (list) The references that match no resource (or more than one).
+        """
+        missing = []
+        for reference in references:
+            resource = self.resolve(reference)
+            if resource == None:
+                missing.append(reference)
+            else:
+                self.resolved[reference] = resource
+        return missing
+
+    def link_map(self, links):
+        """
+        Maps every validated reference to its Dropbox link, so that links can
+        be inserted with one lookup per element.
+        Parameters:
+            links: Dropbox links by resource name (see name())
+        """
+        link_map = dict(links)
+        for reference, resource in self.resolved.items():
+            if self.names[resource] in links:
+                link_map[reference] = links[self.names[resource]]
+        return link_map
+
+
+class TransportError(Exception):
+    """
+    Raised by an Uploader when Dropbox rejects a request.
+    """
+    pass
+
+
+class Uploader(object):
+    """
+    Interface for the transports used to put files into Dropbox.
+    Implementations must be safe to call from several threads at once.
+    """
+
+    def upload(self, local_path, remote_path):
+        """
+        Uploads a single file.
+        Parameters:
+            local_path: Full path to the file to upload
+            remote_path: Destination path in Dropbox
+        """
+        raise NotImplementedError
+
+    def upload_fileobj(self, f, size, remote_path):
+        """
+        Uploads the contents of an open file. The file is only read forwards.
+        Parameters:
+            f: File-like object to read from
+            size: Number of bytes to read from f
+            remote_path: Destination path in Dropbox
+        """
+        raise NotImplementedError
+
+    def share(self, remote_path):
+        """
+        Requests a share link for a file already in Dropbox.
+        Parameters:
+            remote_path: Path of the file in Dropbox
+        Returns:
+            (String) The share link as returned by Dropbox, or None.
+        """
+        raise NotImplementedError
+
+    def exists(self, remote_path):
+        """
+        Checks whether a file is present in Dropbox.
+        Parameters:
+            remote_path: Path of the file in Dropbox
+        Returns:
+            (bool) True if the file exists.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases any resources held by the transport.
+        """
+        pass
+
+
+class ShellUploader(Uploader):
+    """
+    Transport that runs dropbox_uploader.sh once per request.
+    """
+
+    def __init__(self, script_path):
+        """
+        Parameters:
+            script_path: Full path to dropbox_uploader.sh
+        """
+        self.script_path = script_path
+
+    def upload(self, local_path, remote_path):
+        subprocess.check_call([self.script_path, "upload", local_path, remote_path])
+
+    def upload_fileobj(self, f, size, remote_path):
+        # dropbox_uploader.sh can only read from disk, so spool the stream to a temp file
+        with tempfile.NamedTemporaryFile(suffix="_" + os.path.basename(remote_path)) as tmp:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                tmp.write(data)
+            tmp.flush()
+            self.upload(tmp.name, remote_path)
+
+    def share(self, remote_path):
+        output = subprocess.check_output([self.script_path, "share", remote_path])
+        match = re.search(share_link_pattern, output)
+        if match == None:
+            return None
+        return match.group(1)
+
+    def exists(self, remote_path):
+        # dropbox_uploader.sh can only list directories, so look for the file in its parent
+        parent, fname = os.path.split(re.sub("/+", "/", remote_path))
+        try:
+            output = subprocess.check_output([self.script_path, "list", parent])
+        except subprocess.CalledProcessError:
+            return False
+        return fname in re.findall(listing_file_pattern, output)
+
+
+class FileSlice(object):
+    """
+    A read-only window onto part of an open file, used as an HTTP request body
+    so that chunks are streamed straight from disk instead of copied to temp files.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ""
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def read_dbuploader_config(path):
+    """
+    Reads the KEY=VALUE credentials file written by dropbox_uploader.sh.
+    Parameters:
+        path: Path to the file (usually ~/.dropbox_uploader)
+    Returns:
+        (dict) The settings found in the file.
+    """
+    settings = dict()
+    with open(os.path.expanduser(path)) as f:
+        for line in f:
+            if "=" in line:
+                key, value = line.strip().split("=", 1)
+                settings[key] = value
+    return settings
+
+
+class HttpUploader(Uploader):
+    """
+    Transport that talks to the Dropbox API directly over persistent HTTP connections.
+    Each thread keeps its own keep-alive connection per host, and file bodies are
+    streamed from disk. Files larger than SIMPLE_UPLOAD_LIMIT are sent in
+    chunk_size pieces through the chunked upload API.
+    """
+
+    # Largest file Dropbox accepts through files_put (same limit as dropbox_uploader.sh)
+    SIMPLE_UPLOAD_LIMIT = 157286000
+
+    def __init__(self, credentials, api_url="https://api.dropbox.com", content_url="https://api-content.dropbox.com",
+                 chunk_size=4 * 1024 * 1024, timeout=60):
+        """
+        Parameters:
+            credentials: dict with APPKEY, APPSECRET, OAUTH_ACCESS_TOKEN, OAUTH_ACCESS_TOKEN_SECRET
+                         and optionally ACCESS_LEVEL, as written by dropbox_uploader.sh
+            api_url: Base URL for metadata and share requests
+            content_url: Base URL for uploads
+            chunk_size: Size in bytes of each piece of a chunked upload
+            timeout: Socket timeout in seconds
+        """
+        self.credentials = credentials
+        self.access_level = credentials.get("ACCESS_LEVEL") or "dropbox"
+        self.api_url = urlparse.urlsplit(api_url)
+        self.content_url = urlparse.urlsplit(content_url)
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self, url):
+        conns = getattr(self.local, "conns", None)
+        if conns is None:
+            conns = self.local.conns = dict()
+        key = (url.scheme, url.netloc)
+        if key not in conns:
+            if url.scheme == "https":
+                conns[key] = httplib.HTTPSConnection(url.netloc, timeout=self.timeout)
+            else:
+                conns[key] = httplib.HTTPConnection(url.netloc, timeout=self.timeout)
+        return conns[key]
+
+    def _drop_connection(self, url):
+        conns = getattr(self.local, "conns", dict())
+        conn = conns.pop((url.scheme, url.netloc), None)
+        if conn != None:
+            conn.close()
+
+    def _auth_params(self):
+        c = self.credentials
+        return [("oauth_consumer_key", c["APPKEY"]),
+                ("oauth_token", c["OAUTH_ACCESS_TOKEN"]),
+                ("oauth_signature_method", "PLAINTEXT"),
+                ("oauth_signature", c["APPSECRET"] + "&" + c["OAUTH_ACCESS_TOKEN_SECRET"]),
+                ("oauth_timestamp", str(int(time.time()))),
+                ("oauth_nonce", str(random.randint(0, 1 << 30)))]
+
+    def _request(self, method, url, path, params=(), body=None, headers=None):
+        """
+        Sends one request on this thread's connection to url and returns the decoded JSON reply.
+        """
+        query = urllib.urlencode(list(params) + self._auth_params())
+        target = url.path.rstrip("/") + path + "?" + query
+        conn = self._connection(url)
+        try:
+            conn.request(method, target, body, headers or dict())
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, IOError):
+            # The server may have closed the keep-alive connection; start a fresh one next time.
+            self._drop_connection(url)
+            raise
+        if response.status != 200:
+            raise TransportError("%s %s returned HTTP %d: %s" % (method, path, response.status, data))
+        return json.loads(data) if data else dict()
+
+    def _remote(self, remote_path):
+        return "/" + self.access_level + "/" + urllib.quote(re.sub("/+", "/", remote_path).lstrip("/"))
+
+    def upload(self, local_path, remote_path):
+        with open(local_path, "rb") as f:
+            self.upload_fileobj(f, os.path.getsize(local_path), remote_path)
+
+    def upload_fileobj(self, f, size, remote_path):
+        if size <= self.SIMPLE_UPLOAD_LIMIT:
+            self._request("PUT", self.content_url, "/1/files_put" + self._remote(remote_path),
+                          body=FileSlice(f, size), headers={"Content-Length": str(size)})
+            return
+        upload_id = None
+        offset = 0
+        while offset < size:
+            length = min(self.chunk_size, size - offset)
+            params = []
+            if upload_id != None:
+                params = [("upload_id", upload_id), ("offset", str(offset))]
+            reply = self._request("PUT", self.content_url, "/1/chunked_upload", params,
+                                  body=FileSlice(f, length), headers={"Content-Length": str(length)})
+            upload_id = reply["upload_id"]
+            if int(reply["offset"]) != offset + length:
+                # The stream cannot be rewound, so let the caller retry the whole file
+                raise TransportError("Dropbox expected offset %s but %d bytes were sent" % (reply["offset"], offset + length))
+            offset += length
+        self._request("POST", self.content_url, "/1/commit_chunked_upload" + self._remote(remote_path),
+                      [("upload_id", upload_id)], body="", headers={"Content-Length": "0"})
+
+    def share(self, remote_path):
+        reply = self._request("GET", self.api_url, "/1/shares" + self._remote(remote_path), [("short_url", "false")])
+        return reply.get("url")
+
+    def exists(self, remote_path):
+        try:
+            reply = self._request("GET", self.api_url, "/1/metadata" + self._remote(remote_path))
+        except TransportError:
+            return False
+        return not reply.get("is_deleted", False)
+
+    def close(self):
+        for conn in getattr(self.local, "conns", dict()).values():
+            conn.close()
+        self.local = threading.local()
+
+
+class LocalUploader(Uploader):
+    """
+    Writes files into a local directory, laid out as they would be in Dropbox,
+    for offline runs whose output is checked or profiled rather than published.
+    Share links are file:// URLs, or link_prefix followed by the Dropbox path.
+    """
+
+    def __init__(self, root, link_prefix=None):
+        """
+        Parameters:
+            root: Directory that stands in for the root of the Dropbox
+            link_prefix: Start of the share links, e.g. http://localhost/etds/
+        """
+        self.root = os.path.abspath(root)
+        self.link_prefix = link_prefix
+
+    def _path(self, remote_path):
+        return os.path.join(self.root, re.sub("/+", "/", remote_path).lstrip("/"))
+
+    def _create(self, remote_path):
+        path = self._path(remote_path)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            # Another thread may have just created it
+            if e.errno != errno.EEXIST:
+                raise
+        return path
+
+    def upload(self, local_path, remote_path):
+        shutil.copyfile(local_path, self._create(remote_path))
+
+    def upload_fileobj(self, f, size, remote_path):
+        with open(self._create(remote_path), "wb") as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+
+    def share(self, remote_path):
+        if self.link_prefix != None:
+            return self.link_prefix + urllib.quote(re.sub("/+", "/", remote_path).lstrip("/"))
+        return "file://" + urllib.quote(self._path(remote_path))
+
+    def exists(self, remote_path):
+        return os.path.isfile(self._path(remote_path))
+
+
+class NullUploader(Uploader):
+    """
+    Discards every file, for dry runs and for profiling everything but the
+    network. Share links are null:// followed by the Dropbox path.
+    """
+
+    def upload(self, local_path, remote_path):
+        pass
+
+    def upload_fileobj(self, f, size, remote_path):
+        pass
+
+    def share(self, remote_path):
+        return "null://" + urllib.quote(re.sub("/+", "/", remote_path))
+
+    def exists(self, remote_path):
+        return False
+
+
+def make_uploader(settings):
+    """
+    Creates the Uploader selected by [dropbox] transport in settings.conf.
+    Parameters:
+        settings: A Settings without errors
+    """
+    transport = settings.dropbox_transport
+    if transport == 'shell':
+        return ShellUploader(settings.dbuploader_path)
+    elif transport == 'http':
+        credentials = read_dbuploader_config(settings.dbuploader_config)
+        return HttpUploader(credentials, api_url=settings.api_url, content_url=settings.content_url,
+                            chunk_size=settings.chunk_size)
+    elif transport == 'local':
+        return LocalUploader(settings.local_dir, settings.link_prefix)
+    return NullUploader()
+
+
+def get_uploader():
+    """
+    Returns the configured Uploader, falling back to dropbox_uploader.sh.
+    """
+    if UPLOADER == None:
+        return ShellUploader(DBUPLOADER_PATH)
+    return UPLOADER
+
+
+def upload_file(local_path, remote_path):
+    """
+    Uploads a single file to Dropbox.
+    Parameters:
+        local_path: Full path to the file to upload, or a ZipMember to stream from its archive
+        remote_path: Destination path in Dropbox
+    """
+    if isinstance(local_path, ZipMember):
+        with contextlib.closing(local_path.open()) as f:
+            get_uploader().upload_fileobj(f, local_path.size, remote_path)
+    else:
+        get_uploader().upload(local_path, remote_path)
+
+
+def share_file(remote_path):
+    """
+    Requests a direct download share link for a file already in Dropbox.
+    Parameters:
+        remote_path: Path of the file in Dropbox
+    Returns:
+        (String) The share link, or None if none was returned.
+    """
+    share_link = get_uploader().share(remote_path)
+    if share_link == None or not share_link.endswith("dl=0"):
+        return share_link
+    # Dropbox links open a preview page unless dl=1
+    return share_link[:-1] + "1"
+
+
+def file_digest(resource):
+    """
+    Returns the SHA-1 of a resource file on disk or inside a zip.
+    Parameters:
+        resource: A full path or a ZipMember
+    """
+    sha = hashlib.sha1()
+    with contextlib.closing(open_resource(resource)) as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+    return sha.hexdigest()
+
+
+class UploadCache(object):
+    """
+    Remembers which files are already in Dropbox and their share links, keyed
+    by Dropbox path and content hash, so unchanged files are not sent again
+    when ProQuest resends an ETD. The least recently used entries are evicted
+    once there are more than max_entries.
+    """
+
+    def __init__(self, path=".upload_cache.json", max_entries=10000, verify=False):
+        """
+        Parameters:
+            path: File the cache is saved in
+            max_entries: Largest number of files remembered
+            verify: Whether to check that a file is still in Dropbox before skipping it
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.verify = verify
+        self.lock = threading.Lock()
+        # remote path -> {'sha1', 'size', 'link', 'used'}
+        self.entries = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, remote_path, digest):
+        """
+        Returns the share link of a previous upload of the same content to the same path, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(remote_path)
+            if entry == None or entry['sha1'] != digest:
+                return None
+            entry['used'] = time.time()
+            return entry['link']
+
+    def store(self, remote_path, digest, size, link):
+        """
+        Remembers an upload.
+        """
+        with self.lock:
+            self.entries[remote_path] = {'sha1': digest, 'size': size, 'link': link, 'used': time.time()}
+
+    def forget(self, remote_path):
+        """
+        Drops the entry for a file that turned out to be missing from Dropbox.
+        """
+        with self.lock:
+            self.entries.pop(remote_path, None)
+
+    def save(self):
+        """
+        Evicts the least recently used entries beyond max_entries and writes the cache to disk.
+        """
+        with self.lock:
+            if len(self.entries) > self.max_entries:
+                by_age = sorted(self.entries.items(), key=lambda item: item[1]['used'])
+                for remote_path, _ in by_age[:len(self.entries) - self.max_entries]:
+                    del self.entries[remote_path]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.rename(tmp_path, self.path)
+
+
+def with_retries(func, *args):
+    """
+    Calls func(*args), retrying up to UPLOAD_RETRIES times with exponential backoff.
+    Parameters:
+        func: The function to call
+        args: Arguments passed to func
+    Returns:
+        Whatever func returns.
+    """
+    delay = RETRY_BACKOFF
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt >= UPLOAD_RETRIES:
+                raise
+            attempt += 1
+            print "%s failed (%s), retrying in %s seconds (%d/%d)..." % (func.__name__, e, delay, attempt, UPLOAD_RETRIES)
+            time.sleep(delay)
+            delay *= 2
+
+
+class UploadError(Exception):
+    """
+    Raised by UploadScheduler.wait() when a file could not be uploaded or shared.
+    """
+
+    def __init__(self, name, error):
+        Exception.__init__(self, "%s: %s" % (name, error))
+        self.name = name
+        self.error = error
+
+
+class UploadScheduler(object):
+    """
+    Uploads files and requests their share links on a bounded number of threads.
+    Each file is uploaded and then shared by the same worker, so a share link is
+    never requested for a file that is not in Dropbox yet.
+    """
+
+    def __init__(self, max_parallel, on_done=None):
+        """
+        Parameters:
+            max_parallel: Maximum number of files in flight at once.
+            on_done: Called as on_done(name, share_link) as each file finishes
+        """
+        self.max_parallel = max(1, max_parallel)
+        self.on_done = on_done
+        # Upload threads report their timings against the ETD that started them
+        self.etd = METRICS.current_etd()
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.links = dict()
+        self.errors = []
+
+    def submit(self, name, local_path, remote_path):
+        """
+        Queues a file to be uploaded and shared.
+        Parameters:
+            name: Key the share link will be stored under
+            local_path: Full path to the file to upload, or a ZipMember
+            remote_path: Destination path in Dropbox
+        """
+        self.tasks.put((name, local_path, remote_path))
+
+    def _work(self):
+        while True:
+            try:
+                name, local_path, remote_path = self.tasks.get_nowait()
+            except Queue.Empty:
+                return
+            # Once something has failed the whole ETD will be rejected, so skip the rest.
+            if self.errors:
+                continue
+            try:
+                share_link = None
+                if UPLOAD_CACHE != None:
+                    digest = file_digest(local_path)
+                    share_link = UPLOAD_CACHE.lookup(remote_path, digest)
+                    if share_link != None and UPLOAD_CACHE.verify and not with_retries(get_uploader().exists, remote_path):
+                        UPLOAD_CACHE.forget(remote_path)
+                        share_link = None
+                    if share_link != None:
+                        print "%s is unchanged, skipping upload" % name
+                        METRICS.record('upload_skipped', 0, resource_size(local_path), etd=self.etd)
+                if share_link == None:
+                    with LIMITS.slot('network'):
+                        with METRICS.stage('upload', resource_size(local_path), self.etd):
+                            with_retries(upload_file, local_path, remote_path)
+                        with METRICS.stage('share', etd=self.etd):
+                            share_link = with_retries(share_file, remote_path)
+                    if UPLOAD_CACHE != None and share_link != None:
+                        UPLOAD_CACHE.store(remote_path, digest, resource_size(local_path), share_link)
+                with self.lock:
+                    if share_link != None:
+                        self.links[name] = share_link
+                if share_link != None and self.on_done != None:
+                    self.on_done(name, share_link)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(UploadError(name, e))
+
+    def wait(self):
+        """
+        Runs every queued task and waits for them to finish.
+        Returns:
+            (dict) A mapping of names to share links.
+        Raises:
+            UploadError for the first file that could not be uploaded.
+        """
+        threads = []
+        for _ in range(min(self.max_parallel, self.tasks.qsize())):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.links
+
+
+def dropboxify(dirpath, dom, resource_files, recipient=None, upload_output=True, job=None, index=None):
+    """
+    Converts a transformed xml document into one ready for Bepress uploading by:
+        1) Uploading resources to dropbox
+        2) Generating Dropbox share links
+        3) Inserting links into the xml
+    Parameters:
+        dirpath: Full path to unzipped ProQuest ETD directory
+        dom: The transformed xml document, or a StreamedDocument. Links are inserted into it in place.
+        resource_files: A list containing full paths (or ZipMembers) for all resource files (.pdf, etc.)
+        recipient: Address to send failure reports to (defaults to RESULT_EMAIL)
+        upload_output: Whether to upload the finished xml to Dropbox as well
+        job: The EtdJob tracking this ETD, if any. Resources it already has links for are not uploaded again.
+        index: A validated ResourceIndex for resource_files, used to name uploads and match links
+    Side-Effects:
+        Writes completed xml to <dirname>_Output.xml
+    Returns:
+        (String) Full path to the finished xml file.
+    """
+    # A mapping of resource document names to Dropbox URLs.
+    # Kept local so that concurrent ETDs do not share links.
+    link_map = dict()
+
+    # Base name of unzipped ETD directory
+    dirname = os.path.basename(os.path.normpath(dirpath))
+
+    upload_folder = dirpath.split("/")[-3]
+
+    # Upload all the resource files to dropbox and generate links for each
+    # The resulting generated links get added to the link_map
+    scheduler = UploadScheduler(MAX_PARALLEL_UPLOADS, job.record_upload if job != None else None)
+    if job != None:
+        link_map.update(job.links)
+        job.set_total(len(resource_files))
+    for fpath in resource_files:
+        if index != None:
+            fname = index.name(fpath)
+        else:
+            fname = os.path.basename(str(fpath))
+        if fname in link_map:
+            continue
+        scheduler.submit(fname, fpath, DB_DIR + "/" + upload_folder + "/" + dirname + "/" + fname)
+    try:
+        link_map.update(scheduler.wait())
+    except UploadError as e:
+        if UPLOAD_CACHE != None:
+            UPLOAD_CACHE.save()
+        print e.error
+        print "Error uploading to dropbox!"
+        print "Sending error report..."
+        error_msg = "There was a problem uploading %s to Dropbox.\n"\
+                    "Full error follows:\n"\
+                    "%s" % (e.name, e.error)
+        email_failure(dirname + ".zip", error_msg, recipient)
+        raise MyException("Dropbox upload error")
+    if UPLOAD_CACHE != None:
+        UPLOAD_CACHE.save()
+    if job != None:
+        job.advance('uploading')
+    if index != None:
+        link_map = index.link_map(link_map)
+
+    # Where we want to put the resulting files
+    working_dir = dirpath
+    # Name of our finished xml file
+    finished_fname = dirname + "_Output.xml"
+
+    try:
+        if isinstance(dom, StreamedDocument):
+            print "Streaming XMLs through XSLT..."
+            dom.write(working_dir + finished_fname, link_map)
+        else:
+            rewrite_links(dom, link_map)
+            # Write out the finished xml file
+            with open(working_dir + finished_fname, "wb") as f:
+                f.write(ET.tostring(dom, pretty_print=True))
+    except KeyError as e:
+        print "Unmatched file!"
+        print "Sending error report..."
+        error_msg = "A file referenced in the xml could not be mapped to a Dropbox url.\n"\
+                    "Full error:\n"\
+                    "%s" % (e)
+        email_failure(dirname + ".zip", error_msg, recipient)
+        raise MyException("Unmatched file")
+
+    if not upload_output or (job != None and job.reached('output-uploaded')):
+        return working_dir + finished_fname
+
+    # Upload finished xml. This only happens once every resource is in Dropbox.
+    try:
+        with LIMITS.slot('network'):
+            with METRICS.stage('upload_output', os.path.getsize(working_dir + finished_fname)):
+                with_retries(upload_file, working_dir + finished_fname, DB_DIR + "/" + upload_folder + "/" + dirname + "/" + finished_fname)
+    except Exception as e:
+        print e
+        print "Error uploading to dropbox!"
+        print "Sending error report..."
+        error_msg = "There was a problem uploading %s+_Output.xml to Dropbox.\n"\
+                    "Full error follows:\n"\
+                    "%s" % (dirname, e)
+        email_failure(dirname + ".zip", error_msg, recipient)
+        raise MyException("Dropbox upload error")
+    if job != None:
+        job.advance('output-uploaded')
+
+    return working_dir + finished_fname
+
+
+class Notifier(object):
+    """
+    Interface for the ways results are reported to the people uploading ETDs.
+    Implementations must be safe to call from several threads at once.
+    """
+
+    def send(self, recipient, msg):
+        """
+        Delivers a message, possibly in the background.
+        Parameters:
+            recipient: Address to send to
+            msg: The email.message.Message to send
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Waits until every message handed to send has been delivered.
+        """
+        pass
+
+    def close(self):
+        """
+        Delivers anything still pending and releases any resources held.
+        """
+        pass
+
+
+class SmtpNotifier(Notifier):
+    """
+    Sends email from a background thread over a single SMTP connection that is
+    kept open between messages and reopened if the server drops it.
+    In digest mode, messages for each recipient are collected and sent as one
+    message every digest_interval seconds.
+    """
+
+    # Close the connection after this many idle seconds, before the server does
+    IDLE_TIMEOUT = 60
+    # Queued by close() to stop the thread
+    STOP = "stop"
+
+    def __init__(self, server, port=465, user=None, password=None, use_ssl=True, sender="pi@localhost", digest_interval=0):
+        """
+        Parameters:
+            server: SMTP server hostname
+            port: SMTP server port
+            user: User to log in as, or None to skip logging in
+            password: Password for user
+            use_ssl: Whether to connect with SMTP over SSL
+            sender: Envelope and From address
+            digest_interval: Seconds between digests, or 0 to send every message right away
+        """
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_ssl = use_ssl
+        self.sender = sender
+        self.digest_interval = digest_interval
+        self.conn = None
+        self.last_used = 0
+        self.queue = Queue.Queue()
+        # recipient -> (time the first message arrived, list of messages)
+        self.digests = dict()
+        self.thread = threading.Thread(target=self._run, name="smtp-notifier")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, recipient, msg):
+        """
+        Queues a message for delivery.
+        Parameters:
+            recipient: Address to send to
+            msg: The email.message.Message to send
+        """
+        self.queue.put((recipient, msg))
+
+    def flush(self):
+        """
+        Sends every queued message and pending digest, and waits until that is done.
+        """
+        self.queue.put(None)
+        self.queue.join()
+
+    def close(self):
+        """
+        Sends everything still pending, then closes the connection and stops the thread.
+        """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(self.STOP)
+        self.thread.join()
+
+    def _timeout(self):
+        timeouts = []
+        if self.digests:
+            oldest = min([first for first, _ in self.digests.values()])
+            timeouts.append(oldest + self.digest_interval - time.time())
+        if self.conn != None:
+            timeouts.append(self.last_used + self.IDLE_TIMEOUT - time.time())
+        if not timeouts:
+            return None
+        return max(0, min(timeouts))
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._timeout())
+            except Queue.Empty:
+                item = False
+            if item is self.STOP:
+                try:
+                    self._send_digests(force=True)
+                    if self.conn != None:
+                        self._disconnect()
+                except Exception as e:
+                    print "Error sending email: %s" % e
+                self.queue.task_done()
+                return
+            try:
+                if item == None:
+                    self._send_digests(force=True)
+                elif item:
+                    recipient, msg = item
+                    if self.digest_interval > 0:
+                        self.digests.setdefault(recipient, (time.time(), []))[1].append(msg)
+                    else:
+                        self._deliver(recipient, msg)
+                self._send_digests()
+                if self.conn != None and time.time() - self.last_used >= self.IDLE_TIMEOUT:
+                    self._disconnect()
+            except Exception as e:
+                # A mail problem must never stop the notifier
+                print "Error sending email: %s" % e
+            finally:
+                if item != False:
+                    self.queue.task_done()
+
+    def _send_digests(self, force=False):
+        for recipient, (first, msgs) in self.digests.items():
+            if force or time.time() - first >= self.digest_interval:
+                del self.digests[recipient]
+                self._deliver(recipient, self._digest(recipient, msgs))
+
+    def _digest(self, recipient, msgs):
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        msg = MIMEMultipart()
+        msg['Subject'] = 'ProQuest2Bepress digest: %d results' % len(msgs)
+        msg['To'] = recipient
+        msg['From'] = self.sender
+        msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+        body = ""
+        for m in msgs:
+            body += "=== %s ===\n" % m['Subject']
+            for part in m.walk():
+                if part.get_content_type() == "text/plain":
+                    body += part.get_payload(decode=True).rstrip("\n") + "\n"
+            body += "\n"
+        msg.attach(MIMEText(body, 'plain'))
+        return msg
+
+    def _connect(self):
+        if self.use_ssl:
+            conn = smtplib.SMTP_SSL(self.server, self.port)
+        else:
+            conn = smtplib.SMTP(self.server, self.port)
+        if self.user:
+            conn.login(self.user, self.password)
+        self.conn = conn
+
+    def _disconnect(self):
+        try:
+            self.conn.quit()
+        except (smtplib.SMTPException, socket.error):
+            pass
+        self.conn = None
+
+    def _deliver(self, recipient, msg):
+        text = msg.as_string()
+        with LIMITS.slot('smtp'):
+            with METRICS.stage('email', len(text)):
+                self._sendmail(recipient, text)
+
+    def _sendmail(self, recipient, text):
+        for attempt in range(2):
+            if self.conn == None:
+                self._connect()
+            try:
+                self.conn.sendmail(self.sender, recipient, text)
+                self.last_used = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # The server closed our idle connection; reconnect and try once more
+                self.conn = None
+                if attempt == 1:
+                    raise
+
+
+class LogNotifier(Notifier):
+    """
+    Writes messages to an mbox file instead of sending them, or prints the
+    recipient and subject of each one if no file is given. For dry runs and
+    offline transforms.
+    """
+
+    def __init__(self, path=None):
+        """
+        Parameters:
+            path: The mbox file to append to, or None to print to stdout
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def send(self, recipient, msg):
+        if self.path == None:
+            print "Email to %s: %s" % (recipient, msg['Subject'])
+            return
+        from email.generator import Generator
+        msg.set_unixfrom("From %s %s" % (msg['From'], time.asctime()))
+        with self.lock:
+            with open(self.path, "a") as f:
+                Generator(f, mangle_from_=True).flatten(msg, unixfrom=True)
+                f.write("\n")
+
+
+class NullNotifier(Notifier):
+    """
+    Drops every message.
+    """
+
+    def send(self, recipient, msg):
+        pass
+
+
+def make_notifier(settings):
+    """
+    Creates the notifier selected by [smtp] transport in settings.conf.
+    Parameters:
+        settings: A Settings without errors
+    """
+    transport = settings.smtp_transport
+    if transport == 'log':
+        return LogNotifier(settings.smtp_log_path)
+    elif transport == 'null':
+        return NullNotifier()
+    return SmtpNotifier(SMTP_SERVER, settings.smtp_port, SMTP_USER, SMTP_PASSWORD,
+                        use_ssl=settings.smtp_ssl, digest_interval=settings.digest_interval)
+
+
+def get_notifier():
+    """
+    Returns the notifier used to send email, creating it from the [smtp] settings if needed.
+    """
+    global NOTIFIER
+    if NOTIFIER == None:
+        NOTIFIER = make_notifier(SETTINGS)
+        # Deliver anything still queued before the interpreter shuts the thread down
+        atexit.register(NOTIFIER.close)
+    return NOTIFIER
+
+
+def email_success(dirname, recipient=None):
+    """
+    Email administrator a success message.
+    Parameters:
+        dirname: Name of unzipped ProQuest ETD directory
+        recipient: Address to send to (defaults to RESULT_EMAIL)
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    recipient = recipient or RESULT_EMAIL
+    # Set up multipart message
+    msg = MIMEMultipart()
+    msg['Subject'] = '%s is ready for upload' % dirname
+    msg['To'] = recipient
+    msg['From'] = "pi@localhost"
+    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+
+    # Create and add body
+    body = "%s/Output.xml is ready to be uploaded." % dirname
+    part1 = MIMEText(body, 'plain')
+    msg.attach(part1)
+
+    # Hand the email to the notifier, which sends it in the background
+    get_notifier().send(recipient, msg)
+
+
+def email_success_attachments(dirname, attachments, recipient=None):
+    """
+    Email administrator a success message with need for manual attachments.
+    Parameters:
+        dirname: Name of unzipped ProQuest ETD directory
+        attachments: Names of the files that need to be attached by hand
+        recipient: Address to send to (defaults to RESULT_EMAIL)
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    recipient = recipient or RESULT_EMAIL
+    # Set up multipart message
+    msg = MIMEMultipart()
+    msg['Subject'] = '%s requires manual intervention' % dirname
+    msg['To'] = recipient
+    msg['From'] = "pi@localhost"
+    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+
+    # Create and add body
+    body = "%s/Output.xml is ready to be uploaded.\n" % dirname
+    body += "Additionally the following files will need to be manually attached: \n"
+    for att in attachments:
+        body += os.path.basename(att) + "\n"
+    part1 = MIMEText(body, 'plain')
+    msg.attach(part1)
+
+    # Hand the email to the notifier, which sends it in the background
+    get_notifier().send(recipient, msg)
+
+
+def email_failure(culprit, message, recipient=None):
+    """
+    Email administrator a failure message.
+    Parameters:
+        culprit: Name of file that resulted in an error
+        message: Full message detailing error
+        recipient: Address to send to (defaults to RESULT_EMAIL)
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    recipient = recipient or RESULT_EMAIL
+    # Set up multipart message
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Processing of %s FAILED!' % culprit
+    msg['To'] = recipient
+    msg['From'] = "pi@localhost"
+    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+
+    # Create part from passed in message
+    part1 = MIMEText(message, 'plain')
+    msg.attach(part1)
+
+    # Hand the email to the notifier, which sends it in the background
+    get_notifier().send(recipient, msg)
+
+
+def email_batch_success(upload_folder, batch_fname, etds, attachments, recipient=None):
+    """
+    Email administrator that a merged batch of ETDs is ready.
+    Parameters:
+        upload_folder: Name of the upload folder the ETDs arrived in
+        batch_fname: Name of the merged xml file
+        etds: Names of the ETDs included in the batch
+        attachments: Names of the files that need to be attached by hand
+        recipient: Address to send to (defaults to RESULT_EMAIL)
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    recipient = recipient or RESULT_EMAIL
+    # Set up multipart message
+    msg = MIMEMultipart()
+    if attachments:
+        msg['Subject'] = '%d ETDs from %s are ready for upload and require manual intervention' % (len(etds), upload_folder)
+    else:
+        msg['Subject'] = '%d ETDs from %s are ready for upload' % (len(etds), upload_folder)
+    msg['To'] = recipient
+    msg['From'] = "pi@localhost"
+    msg.preamble = 'You will not see this in a MIME-aware mail reader.\n'
+
+    # Create and add body
+    body = "%s/%s is ready to be uploaded.\n" % (upload_folder, batch_fname)
+    body += "It contains the following ETDs: \n"
+    for etd in etds:
+        body += etd + "\n"
+    if attachments:
+        body += "\nAdditionally the following files will need to be manually attached: \n"
+        for att in attachments:
+            body += os.path.basename(att) + "\n"
+    part1 = MIMEText(body, 'plain')
+    msg.attach(part1)
+
+    # Hand the email to the notifier, which sends it in the background
+    get_notifier().send(recipient, msg)
+
+
+class Aggregator(object):
+    """
+    Collects finished ETDs per upload folder and merges them into a single
+    Bepress import file once max_documents have arrived or the oldest has been
+    waiting max_age seconds. The merged file is uploaded once and announced in
+    one email. Pending ETDs are saved to a state file so a restart does not lose them.
+    """
+
+    def __init__(self, max_documents, max_age, state_path=".aggregate.json"):
+        """
+        Parameters:
+            max_documents: Flush a folder once it has this many ETDs waiting
+            max_age: Flush a folder once its oldest ETD has waited this many seconds
+            state_path: File pending ETDs are saved in
+        """
+        self.max_documents = max_documents
+        self.max_age = max_age
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        # upload folder -> list of pending ETD dicts
+        self.pending = dict()
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                self.pending = json.load(f)
+
+    def _save(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.pending, f)
+        os.rename(tmp_path, self.state_path)
+
+    def add(self, upload_folder, output_path, dirname, attachments, recipient):
+        """
+        Queues a finished ETD for the next merged file of its folder.
+        Parameters:
+            upload_folder: Name of the upload folder the ETD arrived in
+            output_path: Full path to the ETD's _Output.xml
+            dirname: Name of the ETD
+            attachments: Names of the files that need to be attached by hand
+            recipient: Address to send the batch email to
+        """
+        with self.lock:
+            self.pending.setdefault(upload_folder, []).append({
+                'output_path': output_path, 'dirname': dirname, 'attachments': attachments,
+                'recipient': recipient, 'time': time.time()})
+            self._save()
+            full = len(self.pending[upload_folder]) >= self.max_documents
+        if full:
+            self.flush(upload_folder)
+
+    def next_deadline(self):
+        """
+        Returns the number of seconds until some folder is due to be flushed, or None.
+        """
+        with self.lock:
+            oldest = [etds[0]['time'] for etds in self.pending.values() if etds]
+        if not oldest:
+            return None
+        return max(0, min(oldest) + self.max_age - time.time())
+
+    def flush_due(self):
+        """
+        Flushes every folder whose oldest ETD has waited max_age seconds.
+        """
+        with self.lock:
+            due = [folder for folder, etds in self.pending.items()
+                   if etds and time.time() - etds[0]['time'] >= self.max_age]
+        for folder in due:
+            self.flush(folder)
+
+    def flush_all(self):
+        """
+        Flushes every folder that has ETDs waiting.
+        """
+        with self.lock:
+            folders = [folder for folder, etds in self.pending.items() if etds]
+        for folder in folders:
+            self.flush(folder)
+
+    def flush(self, upload_folder):
+        """
+        Merges, uploads and announces the ETDs waiting for upload_folder.
+        If that fails they are put back and retried on the next flush.
+        Parameters:
+            upload_folder: Name of the upload folder to flush
+        """
+        with self.lock:
+            etds = self.pending.pop(upload_folder, [])
+            self._save()
+        if not etds:
+            return
+
+        recipient = etds[-1]['recipient']
+        # Named after its first ETD as well, since an ETD is only ever in one batch
+        batch_fname = "%s_Batch_%s_%s.xml" % (upload_folder, time.strftime("%Y%m%d-%H%M%S"), etds[0]['dirname'])
+        # Keep the batch file next to the ETD working directories
+        batch_path = os.path.join(os.path.dirname(os.path.dirname(etds[0]['output_path'])), batch_fname)
+        try:
+            outputs = [etd['output_path'] for etd in etds]
+            if STREAM_XML:
+                # Copy the documents across one at a time instead of building the whole batch in memory
+                write_documents(batch_path, read_root(outputs[0]), iter_elements(outputs, "document"))
+            else:
+                merged = None
+                parser = ET.XMLParser(remove_blank_text=True)
+                for output in outputs:
+                    documents = ET.parse(output, parser).getroot()
+                    if merged == None:
+                        merged = documents
+                    else:
+                        for document in documents:
+                            merged.append(document)
+                with open(batch_path, "wb") as f:
+                    f.write(ET.tostring(merged, pretty_print=True))
+            with LIMITS.slot('network'):
+                with_retries(upload_file, batch_path, DB_DIR + "/" + upload_folder + "/" + batch_fname)
+        except Exception as e:
+            print e
+            print "Error creating batch for %s! It will be retried." % upload_folder
+            with self.lock:
+                self.pending[upload_folder] = etds + self.pending.get(upload_folder, [])
+                self._save()
+            return
+
+        attachments = []
+        for etd in etds:
+            attachments += etd['attachments']
+        email_batch_success(upload_folder, batch_fname, [etd['dirname'] for etd in etds], attachments, recipient)
+
+
+class FileLedger(object):
+    """
+    Remembers every file the listener has seen and what became of it.
+    Entries are kept in a dict for constant-time lookups and persisted to an
+    append-only log of JSON lines, which is compacted when it grows too long.
+    Each entry records the file's state, when it last changed and the size and
+    mtime the file had at that moment.
+    """
+
+    STATES = ('seen', 'processing', 'done', 'broken')
+
+    def __init__(self, path=".ledger.log", broken_path=".broken.txt", legacy_seen_path=".seen.txt"):
+        """
+        Parameters:
+            path: The ledger's log file.
+            broken_path: Human-editable list of broken zips. Removing a line
+                         from it lets that zip be processed again after a restart.
+            legacy_seen_path: .seen.txt from older versions, imported on first run.
+        """
+        self.path = path
+        self.broken_path = broken_path
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.log_lines = 0
+
+        broken_listed = set()
+        if os.path.exists(broken_path):
+            with open(broken_path) as b:
+                broken_listed = set([line.strip() for line in b if line.strip()])
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    self.log_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    # Paths come back as unicode; keep them as the byte strings os.listdir returns
+                    entry['path'] = entry['path'].encode('utf-8')
+                    self.entries[entry['path']] = entry
+            # Entries the operator removed from .broken.txt get another chance
+            for entry in self.entries.values():
+                if entry['state'] == 'broken' and entry['path'] not in broken_listed:
+                    del self.entries[entry['path']]
+        else:
+            if os.path.exists(legacy_seen_path):
+                with open(legacy_seen_path) as f:
+                    for line in f:
+                        if line.strip():
+                            self.entries[line.strip()] = self._entry(line.strip(), 'done')
+        for broken in broken_listed:
+            if self.entries.get(broken, dict()).get('state') != 'broken':
+                self.entries[broken] = self._entry(broken, 'broken')
+
+        self.compact()
+
+    def _entry(self, path, state):
+        entry = {'path': path, 'state': state, 'time': time.time(), 'size': None, 'mtime': None}
+        try:
+            st = os.stat(path)
+            entry['size'] = st.st_size
+            entry['mtime'] = st.st_mtime
+        except OSError:
+            pass
+        return entry
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, path):
+        """
+        Returns the entry recorded for path, or None.
+        """
+        return self.entries.get(path)
+
+    def paths(self, state):
+        """
+        Returns every path currently in the given state.
+        """
+        with self.lock:
+            return [e['path'] for e in self.entries.values() if e['state'] == state]
+
+    def set_state(self, path, state):
+        """
+        Records a new state for path and appends it to the log.
+        Parameters:
+            path: Full path to the file
+            state: One of FileLedger.STATES
+        """
+        if state not in self.STATES:
+            raise ValueError("Unknown ledger state: %s" % state)
+        entry = self._entry(path, state)
+        with self.lock:
+            self.entries[path] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_lines += 1
+            if state == 'broken':
+                with open(self.broken_path, "a+") as b:
+                    b.write(path + "\n")
+            if self.log_lines > max(1000, 2 * len(self.entries)):
+                self._compact()
+
+    def compact(self):
+        """
+        Rewrites the log so it holds exactly one line per file.
+        """
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        self.log_lines = len(self.entries)
+
+
+class JobQueue(object):
+    """
+    A job queue shared by several listeners through an SQLite database on a
+    shared filesystem, so that each ETD is processed by exactly one node.
+    Nodes claim a job by taking a lease on it and keep renewing the lease
+    while they work; a job whose lease runs out (its node died) is claimed
+    again by another node.
+    It also stands in for the FileLedger in this mode: done and broken
+    outcomes are recorded here, and broken zips are listed in .broken.txt
+    next to the database. Removing a line from it queues that zip again.
+    """
+
+    STATES = ('seen', 'queued', 'processing', 'done', 'broken')
+
+    def __init__(self, path, node=None, lease_time=600):
+        """
+        Parameters:
+            path: The shared database file
+            node: Name of this node (defaults to hostname:pid)
+            lease_time: Seconds a claimed job stays leased without being renewed
+        """
+        self.path = path
+        self.node = node or "%s:%d" % (socket.gethostname(), os.getpid())
+        self.lease_time = lease_time
+        self.broken_path = os.path.join(os.path.dirname(os.path.abspath(path)), ".broken.txt")
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Paths this node holds leases on
+        self.active = set()
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                       "path TEXT PRIMARY KEY, folder TEXT, recipient TEXT, state TEXT NOT NULL, "
+                       "node TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, updated REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires)")
+
+    def _db(self):
+        # sqlite3 connections may only be used by the thread that opened them
+        db = getattr(self.local, 'db', None)
+        if db == None:
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            # Paths are byte strings, as os.listdir returns them
+            db.text_factory = str
+            self.local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Runs the enclosed block as one write transaction, holding the database
+        lock from the start so that nodes cannot claim the same job.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def __contains__(self, path):
+        return self._db().execute("SELECT 1 FROM jobs WHERE path = ?", (path,)).fetchone() != None
+
+    def paths(self, state):
+        """
+        Returns every path currently in the given state.
+        """
+        return [row[0] for row in self._db().execute("SELECT path FROM jobs WHERE state = ?", (state,))]
+
+    def enqueue(self, path, folder, recipient):
+        """
+        Queues a zip unless some node has already queued it.
+        Returns:
+            (bool) True if this call queued it.
+        """
+        with self._transaction() as db:
+            cursor = db.execute("INSERT OR IGNORE INTO jobs (path, folder, recipient, state, updated) "
+                                "VALUES (?, ?, ?, 'queued', ?)", (path, folder, recipient, time.time()))
+            return cursor.rowcount == 1
+
+    def claim(self):
+        """
+        Leases the oldest queued job, or one whose lease has run out.
+        Returns:
+            (folder, path, recipient), or None if there is nothing to do.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT path, folder, recipient FROM jobs WHERE state = 'queued' "
+                             "OR (state = 'processing' AND lease_expires < ?) ORDER BY rowid LIMIT 1", (now,)).fetchone()
+            if row == None:
+                return None
+            db.execute("UPDATE jobs SET state = 'processing', node = ?, lease_expires = ?, "
+                       "attempts = attempts + 1, updated = ? WHERE path = ?",
+                       (self.node, now + self.lease_time, now, row[0]))
+        with self.lock:
+            self.active.add(row[0])
+        return (row[1], row[0], row[2])
+
+    def renew(self):
+        """
+        Extends the leases on every job this node is working on.
+        """
+        with self.lock:
+            active = list(self.active)
+        if not active:
+            return
+        with self._transaction() as db:
+            for path in active:
+                db.execute("UPDATE jobs SET lease_expires = ? WHERE path = ? AND node = ? AND state = 'processing'",
+                           (time.time() + self.lease_time, path, self.node))
+
+    def set_state(self, path, state):
+        """
+        Records a new state for path, like FileLedger.set_state.
+        Outcomes of a job are only recorded if this node still holds its lease.
+        Parameters:
+            path: Full path to the file
+            state: One of JobQueue.STATES
+        """
+        if state not in self.STATES:
+            raise ValueError("Unknown ledger state: %s" % state)
+        with self._transaction() as db:
+            if state in ('done', 'broken'):
+                cursor = db.execute("UPDATE jobs SET state = ?, lease_expires = NULL, updated = ? "
+                                    "WHERE path = ? AND node = ?", (state, time.time(), path, self.node))
+                if cursor.rowcount == 0:
+                    print "Lost the lease on %s to another node; not recording it as %s" % (path, state)
+                elif state == 'broken':
+                    with open(self.broken_path, "a+") as b:
+                        b.write(path + "\n")
+            else:
+                db.execute("INSERT OR IGNORE INTO jobs (path, state, updated) VALUES (?, ?, ?)",
+                           (path, state, time.time()))
+        with self.lock:
+            self.active.discard(path)
+
+    def requeue_fixed(self):
+        """
+        Queues broken zips again once they have been removed from .broken.txt.
+        """
+        listed = set()
+        if os.path.exists(self.broken_path):
+            with open(self.broken_path) as b:
+                listed = set([line.strip() for line in b if line.strip()])
+        with self._transaction() as db:
+            for path in [row[0] for row in db.execute("SELECT path FROM jobs WHERE state = 'broken'")]:
+                if path not in listed:
+                    print "%s was removed from .broken.txt, queueing it again" % path
+                    db.execute("UPDATE jobs SET state = 'queued', node = NULL, updated = ? WHERE path = ?",
+                               (time.time(), path))
+
+
+class ClusterWorkers(object):
+    """
+    Worker threads that take their ETDs from a shared JobQueue instead of
+    from this listener alone, plus a thread that keeps their leases alive.
+    """
+
+    def __init__(self, size, queue, poll_interval=5):
+        """
+        Parameters:
+            size: Number of ETDs this node may process at the same time
+            queue: The shared JobQueue
+            poll_interval: Seconds an idle worker waits before looking for work again
+        """
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.threads = []
+        for i in range(size):
+            t = threading.Thread(target=self._work, name="cluster-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        t = threading.Thread(target=self._renew, name="lease-renewer")
+        t.daemon = True
+        t.start()
+
+    def _work(self):
+        while True:
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                print "Could not claim a job: %s" % e
+                job = None
+            if job == None:
+                time.sleep(self.poll_interval)
+                continue
+            folder, path, recipient = job
+            print "%s claimed %s" % (self.queue.node, path)
+            try:
+                process_etd(folder, path, recipient)
+            except Exception as e:
+                print "Worker failed on %s: %s" % (path, e)
+
+    def _renew(self):
+        while True:
+            time.sleep(self.queue.lease_time / 3.0)
+            try:
+                self.queue.renew()
+            except sqlite3.Error as e:
+                print "Could not renew leases: %s" % e
+
+
+class UploadStability(object):
+    """
+    Decides whether a file in an upload folder has finished arriving.
+    SFTP writes a file in place, so a zip can be listed long before its last
+    byte is written. A file is only handed on once:
+        - its size and mtime have not changed for settle_time seconds,
+        - a zip's central directory can be read, which is written last, and
+        - its marker file (e.g. etd.zip.done) exists, if marker_suffix is set.
+    Files that still are not complete after incomplete_timeout seconds are
+    handed on anyway, so that a truly broken zip is reported instead of
+    waiting forever.
+    """
+
+    def __init__(self, settle_time=10, check_zip=True, marker_suffix=None, incomplete_timeout=3600):
+        """
+        Parameters:
+            settle_time: Seconds a file must stay unchanged
+            check_zip: Whether to require a readable central directory in zips
+            marker_suffix: Suffix of the marker file uploaders create when done, or None
+            incomplete_timeout: Seconds after which an unchanged file is handed on regardless
+        """
+        self.settle_time = settle_time
+        self.check_zip = check_zip
+        self.marker_suffix = marker_suffix
+        self.incomplete_timeout = incomplete_timeout
+        # path -> ((size, mtime), time the file was first seen like that)
+        self.pending = dict()
+
+    def is_marker(self, path):
+        """
+        Returns True if path is a marker file rather than an upload.
+        """
+        return self.marker_suffix != None and path.endswith(self.marker_suffix)
+
+    def ready(self, path):
+        """
+        Returns True if path looks completely uploaded. Files that are not are
+        remembered so that next_deadline() can say when to look again.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.pending.pop(path, None)
+            return False
+        now = time.time()
+        signature = (st.st_size, st.st_mtime)
+        if path not in self.pending:
+            # The file has been unchanged since it was last written
+            self.pending[path] = (signature, min(now, st.st_mtime))
+        elif self.pending[path][0] != signature:
+            self.pending[path] = (signature, now)
+        unchanged_for = now - self.pending[path][1]
+
+        if unchanged_for < self.settle_time:
+            return False
+        if self.marker_suffix != None and not os.path.exists(path + self.marker_suffix):
+            return False
+        if self.check_zip and path.lower().endswith(".zip") and unchanged_for < self.incomplete_timeout:
+            try:
+                zipfile.ZipFile(path, 'r').close()
+            except (zipfile.BadZipfile, IOError, zipfile.LargeZipFile):
+                print "%s is not a complete zip yet, waiting" % path
+                return False
+        del self.pending[path]
+        return True
+
+    def next_deadline(self):
+        """
+        Returns:
+            Seconds until a pending file may have settled, or None if nothing is pending.
+        """
+        if not self.pending:
+            return None
+        now = time.time()
+        deadlines = []
+        for path, (signature, since) in self.pending.iteritems():
+            if now - since < self.settle_time:
+                deadlines.append(since + self.settle_time - now)
+            else:
+                # Settled but waiting for a marker or the rest of the zip
+                deadlines.append(self.settle_time)
+        return max(0, min(deadlines))
+
+    def forget_missing(self):
+        """
+        Drops pending files that have disappeared.
+        """
+        for path in [p for p in self.pending if not os.path.exists(p)]:
+            del self.pending[path]
+
+
+def poll_uploaddir(folder, seen_files, stability=None):
+    """
+    Checks for new files in the upload dir.
+    Parameters:
+        seen_files: A FileLedger, or any container of already seen filepaths
+        stability: An UploadStability that files must pass before they are returned, or None
+    """
+    # Only files that are not in the ledger yet are stat'ed
+    added = [f for f in listdir_fullpath(folder) if f not in seen_files and os.path.isfile(f)]
+    if stability != None:
+        added = [f for f in added if not stability.is_marker(f) and stability.ready(f)]
+    if added: 
+        print "Added: ", ", ".join (added)
+        return added
+    return None
+
+
+class InotifyWatcher(object):
+    """
+    Uses Linux inotify to wake the listener as soon as a file has finished
+    arriving in one of the upload folders, instead of polling on a timer.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    # Layout of struct inotify_event, not counting the name that follows it
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root):
+        """
+        Parameters:
+            root: The upload directory. Its subfolders are watched too.
+        Raises:
+            OSError if inotify is not available.
+        """
+        libc_name = ctypes_util.find_library("c")
+        if libc_name == None:
+            raise OSError(errno.ENOSYS, "libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify is not supported on this system")
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.root = root
+        self.folders = dict()
+        self._add_watch(root, self.IN_CREATE | self.IN_MOVED_TO | self.IN_ONLYDIR)
+        for folder in listdir_fullpath(root):
+            if os.path.isdir(folder):
+                self._add_watch(folder, self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+
+    def _add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s" % path)
+        self.folders[wd] = path
+
+    def wait(self, timeout):
+        """
+        Blocks until files arrive or timeout seconds pass.
+        Parameters:
+            timeout: Longest time to wait, in seconds.
+        Returns:
+            (set) Paths of the upload folders that changed, or None if every
+            folder should be rescanned (timeout, new folder or lost events).
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            # Interrupted by a signal such as SIGHUP; look at everything again
+            return None
+        if not readable:
+            return None
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        rescan = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + self.EVENT_HEADER.size:offset + self.EVENT_HEADER.size + length].rstrip("\0")
+            offset += self.EVENT_HEADER.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                rescan = True
+            elif mask & self.IN_IGNORED:
+                self.folders.pop(wd, None)
+            elif self.folders.get(wd) == self.root:
+                if mask & self.IN_ISDIR:
+                    # A new upload folder; watch it and look at what is already in it
+                    folder = os.path.join(self.root, name)
+                    try:
+                        self._add_watch(folder, self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+                    except OSError as e:
+                        print e
+                    rescan = True
+            elif wd in self.folders:
+                changed.add(self.folders[wd])
+        if rescan:
+            return None
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher():
+    """
+    Creates an InotifyWatcher for UPLOAD_DIR if WATCH_MODE allows it.
+    Returns:
+        The watcher, or None if the listener should poll.
+    """
+    if WATCH_MODE == 'poll':
+        return None
+    try:
+        return InotifyWatcher(UPLOAD_DIR)
+    except OSError as e:
+        if WATCH_MODE == 'inotify':
+            raise
+        print "inotify unavailable (%s), falling back to polling every %d seconds." % (e, SLEEP_TIME)
+        return None
+
+
+class ConfigError(Exception):
+    """
+    Raised when settings.conf cannot be used. The message lists every
+    problem found, one per line.
+    """
+    pass
+
+
+class Settings(object):
+    """
+    A checked, typed snapshot of settings.conf. Every option used to set up
+    the program is read and converted here, and all problems are collected
+    instead of stopping at the first one, so a bad file is rejected as a
+    whole before any global has been changed.
+    """
+
+    REQUIRED = [('time', 'sleep_time'), ('dirs', 'upload_dir'), ('dirs', 'dropbox_dir'),
+                ('xslt', 'xslt_path')]
+    # Options each [dropbox] and [smtp] transport needs, by transport
+    TRANSPORTS = {'dropbox': {'shell': ['dbuploader_path'], 'http': [], 'local': ['local_dir'], 'null': []},
+                  'smtp': {'smtp': ['smtp_server', 'smtp_user', 'smtp_password'], 'log': [], 'null': []}}
+
+    # Options that are only read at startup, because what is built from them
+    # holds connections, threads or open files. None stands for the whole section.
+    RESTART_OPTIONS = [('dirs', 'upload_dir'), ('dirs', 'dropbox_dir'), ('smtp', None), ('dropbox', None), ('workers', None),
+                       ('watcher', 'mode'), ('cache', None), ('aggregate', None), ('cluster', None)]
+    # Options in those sections that do take effect on reload
+    RELOADABLE = [('dropbox', 'max_parallel_uploads'), ('dropbox', 'upload_retries'),
+                  ('dropbox', 'retry_backoff')]
+
+    def __init__(self, path='settings.conf', overrides=None):
+        """
+        Parameters:
+            path: The settings file to read
+            overrides: (section, option, value) tuples that replace what the
+                       file says, e.g. from the command line
+        """
+        self.path = path
+        self.parser = ConfigParser.ConfigParser()
+        self.errors = []
+        try:
+            self.mtime = os.path.getmtime(path)
+        except OSError:
+            self.mtime = None
+        try:
+            if not self.parser.read(path):
+                self.errors.append("Cannot read %s" % path)
+        except ConfigParser.Error as e:
+            self.errors.append("Cannot parse %s: %s" % (path, e))
+        for section, option, value in overrides or []:
+            if not self.parser.has_section(section):
+                self.parser.add_section(section)
+            self.parser.set(section, option, value)
+
+        required = list(self.REQUIRED)
+        self.dropbox_transport = self.get('dropbox', 'transport', 'shell')
+        self.smtp_transport = self.get('smtp', 'transport', 'smtp')
+        for section, transport in [('dropbox', self.dropbox_transport), ('smtp', self.smtp_transport)]:
+            if transport not in self.TRANSPORTS[section]:
+                self.errors.append("Unknown transport in [%s]: %s" % (section, transport))
+            else:
+                required += [(section, option) for option in self.TRANSPORTS[section][transport]]
+        for section, option in required:
+            if self.get(section, option, None) == None:
+                self.errors.append("Missing option in [%s]: %s" % (section, option))
+
+        self.sleep_time = self.get_int('time', 'sleep_time', 0)
+        self.upload_dir = add_slash(self.get('dirs', 'upload_dir', '/'))
+        self.dropbox_dir = add_slash(self.get('dirs', 'dropbox_dir', '/'))
+        self.xslt_path = self.get('xslt', 'xslt_path', None)
+        self.smtp_server = self.get('smtp', 'smtp_server', None)
+        self.smtp_user = self.get('smtp', 'smtp_user', None)
+        self.smtp_password = self.get('smtp', 'smtp_password', None)
+        self.smtp_port = self.get_int('smtp', 'smtp_port', 465)
+        self.smtp_ssl = self.get_bool('smtp', 'smtp_ssl', True)
+        self.digest_interval = self.get_int('smtp', 'digest_interval', 0)
+        self.smtp_log_path = self.get('smtp', 'log_path', None)
+        self.dbuploader_path = self.get('dropbox', 'dbuploader_path', None)
+        self.dbuploader_config = self.get('dropbox', 'dbuploader_config', '~/.dropbox_uploader')
+        self.api_url = self.get('dropbox', 'api_url', 'https://api.dropbox.com')
+        self.content_url = self.get('dropbox', 'content_url', 'https://api-content.dropbox.com')
+        self.chunk_size = self.get_megabytes('dropbox', 'chunk_size', 4 * 1024 * 1024)
+        self.local_dir = self.get('dropbox', 'local_dir', None)
+        self.link_prefix = self.get('dropbox', 'link_prefix', None)
+        self.max_parallel_etds = max(1, self.get_int('workers', 'max_parallel_etds', 1))
+        self.max_parallel_uploads = max(1, self.get_int('dropbox', 'max_parallel_uploads', 1))
+        self.upload_retries = max(0, self.get_int('dropbox', 'upload_retries', 2))
+        self.retry_backoff = self.get_float('dropbox', 'retry_backoff', 1)
+        self.stream_zips = self.get_bool('zip', 'streaming', False)
+        self.debug_extract = self.get_bool('zip', 'debug_extract', False)
+        self.extract_workers = max(1, self.get_int('zip', 'extract_workers', 1))
+        self.verify_zips = self.get_bool('zip', 'verify', True)
+        self.stream_xml = self.get_bool('xml', 'streaming', False)
+        self.max_etd_bytes = self.get_megabytes('admission', 'max_etd_size', 0)
+        self.spill_threshold = self.get_megabytes('admission', 'extract_threshold', 0)
+        self.max_in_flight = self.get_megabytes('admission', 'max_in_flight', 0)
+        self.cluster_queue = self.get('cluster', 'queue', None)
+        self.node_name = self.get('cluster', 'node_name', None)
+        self.lease_time = self.get_int('cluster', 'lease_time', 600)
+        self.poll_interval = self.get_float('cluster', 'poll_interval', 5)
+        for section, option, value in [('dropbox', 'chunk_size', self.chunk_size), ('cluster', 'lease_time', self.lease_time),
+                                       ('cluster', 'poll_interval', self.poll_interval)]:
+            if value <= 0:
+                self.errors.append("%s in [%s] must be more than 0" % (option, section))
+        self.jobs_dir = ".jobs"
+        if self.cluster_queue != None:
+            # Kept with the queue so a node that takes over a job can resume it
+            self.jobs_dir = os.path.join(os.path.dirname(os.path.abspath(self.cluster_queue)), ".jobs")
+        if self.dropbox_transport in ('local', 'null'):
+            # A dry run must not leave progress behind that a real run would resume from
+            self.jobs_dir += "-" + self.dropbox_transport
+        self.watch_mode = self.get('watcher', 'mode', 'auto')
+        if self.watch_mode not in ('auto', 'inotify', 'poll'):
+            self.errors.append("Unknown mode in [watcher]: %s" % self.watch_mode)
+        self.rescan_interval = self.get_int('watcher', 'rescan_interval', 600)
+        # The cache would hand links from a dry run to later real uploads
+        self.cache_enabled = self.get_bool('cache', 'enabled', False) and self.dropbox_transport in ('shell', 'http')
+        self.cache_path = self.get('cache', 'path', '.upload_cache.json')
+        self.cache_max_entries = self.get_int('cache', 'max_entries', 10000)
+        self.cache_verify = self.get_bool('cache', 'verify', False)
+        self.metrics_textfile = self.get('metrics', 'textfile', None)
+        self.metrics_log = self.get('metrics', 'log', None)
+        self.slots = dict((name, self.get_int('limits', name + '_slots', 0))
+                          for name in ('disk', 'network', 'smtp'))
+        self.stability_enabled = self.get_bool('stability', 'enabled', True)
+        self.settle_time = self.get_float('stability', 'settle_time', 10)
+        self.check_zip = self.get_bool('stability', 'check_zip', True)
+        self.marker_suffix = self.get('stability', 'marker_suffix', None)
+        self.incomplete_timeout = self.get_float('stability', 'incomplete_timeout', 3600)
+        self.aggregate_enabled = self.get_bool('aggregate', 'enabled', False)
+        self.aggregate_max_documents = self.get_int('aggregate', 'max_documents', 50)
+        self.aggregate_max_age = self.get_int('aggregate', 'max_age', 3600)
+        if self.parser.has_section('priority'):
+            for name, _ in self.parser.items('priority', raw=True):
+                if self.get_float('priority', name, 1) <= 0:
+                    self.errors.append("Weight in [priority] must be more than 0: %s" % name)
+
+    def get(self, section, option, default):
+        """
+        Returns an optional value, or default if it is missing or empty.
+        """
+        if (not self.parser.has_option(section, option)) or (self.parser.get(section, option) == ''):
+            return default
+        return self.parser.get(section, option)
+
+    def _convert(self, section, option, default, convert, kind):
+        value = self.get(section, option, None)
+        if value == None:
+            return default
+        try:
+            return convert(value)
+        except ValueError:
+            self.errors.append("Invalid %s in [%s]: %s = %s" % (kind, section, option, value))
+            return default
+
+    def get_int(self, section, option, default):
+        return self._convert(section, option, default, int, "whole number")
+
+    def get_float(self, section, option, default):
+        return self._convert(section, option, default, float, "number")
+
+    def get_megabytes(self, section, option, default):
+        """
+        Returns an optional size given in MB, in bytes.
+        """
+        return self._convert(section, option, default, lambda value: int(float(value) * 1024 * 1024), "size")
+
+    def get_bool(self, section, option, default):
+        return self._convert(section, option, default,
+                             lambda value: self.parser.getboolean(section, option), "true/false value")
+
+    def _startup_value(self, section, option):
+        if option != None:
+            return self.get(section, option, None)
+        if not self.parser.has_section(section):
+            return []
+        return sorted((name, value) for name, value in self.parser.items(section, raw=True)
+                      if (section, name) not in self.RELOADABLE)
+
+    def restart_changes(self, other):
+        """
+        Returns the startup-only options that differ between these settings
+        and other, e.g. ["[smtp]", "[watcher] mode"].
+        """
+        changes = []
+        for section, option in self.RESTART_OPTIONS:
+            if self._startup_value(section, option) != other._startup_value(section, option):
+                changes.append("[%s] %s" % (section, option) if option != None else "[%s]" % section)
+        return changes
+
+    def check(self):
+        """
+        Raises ConfigError listing every problem, if there are any.
+        """
+        if self.errors:
+            raise ConfigError("\n".join(self.errors))
+
+
+def apply_settings(settings):
+    """
+    Sets the globals that may change while ETDs are being processed.
+    Used by load_config at startup and by reload_config. The metrics, the
+    byte budget and the files waiting to settle are updated in place, so
+    nothing they are tracking is lost.
+    Parameters:
+        settings: A Settings without errors
+    """
+    global config
+    global SETTINGS
+    global SLEEP_TIME
+    global XSLT_PATH
+    global MAX_PARALLEL_UPLOADS
+    global UPLOAD_RETRIES
+    global RETRY_BACKOFF
+    global STREAM_ZIPS
+    global DEBUG_EXTRACT
+    global EXTRACT_WORKERS
+    global VERIFY_ZIPS
+    global STREAM_XML
+    global MAX_ETD_BYTES
+    global SPILL_THRESHOLD
+    global BYTE_BUDGET
+    global RESCAN_INTERVAL
+    global LIMITS
+    global STABILITY
+
+    config = settings.parser
+    SETTINGS = settings
+    SLEEP_TIME = settings.sleep_time
+    XSLT_PATH = settings.xslt_path
+    MAX_PARALLEL_UPLOADS = settings.max_parallel_uploads
+    UPLOAD_RETRIES = settings.upload_retries
+    RETRY_BACKOFF = settings.retry_backoff
+    STREAM_ZIPS = settings.stream_zips
+    DEBUG_EXTRACT = settings.debug_extract
+    EXTRACT_WORKERS = settings.extract_workers
+    VERIFY_ZIPS = settings.verify_zips
+    STREAM_XML = settings.stream_xml
+    MAX_ETD_BYTES = settings.max_etd_bytes
+    SPILL_THRESHOLD = settings.spill_threshold
+    RESCAN_INTERVAL = settings.rescan_interval
+    METRICS.textfile = settings.metrics_textfile
+    METRICS.log_path = settings.metrics_log
+    # Slots already held are given back to the old semaphores
+    LIMITS = ResourceSlots(settings.slots)
+    if settings.max_in_flight <= 0:
+        BYTE_BUDGET = None
+    elif BYTE_BUDGET == None:
+        BYTE_BUDGET = ByteBudget(settings.max_in_flight)
+    else:
+        BYTE_BUDGET.set_limit(settings.max_in_flight)
+    if not settings.stability_enabled:
+        STABILITY = None
+    elif STABILITY == None:
+        STABILITY = UploadStability(settings.settle_time, settings.check_zip,
+                                    settings.marker_suffix, settings.incomplete_timeout)
+    else:
+        STABILITY.settle_time = settings.settle_time
+        STABILITY.check_zip = settings.check_zip
+        STABILITY.marker_suffix = settings.marker_suffix
+        STABILITY.incomplete_timeout = settings.incomplete_timeout
+
+
+def load_config(path='settings.conf', overrides=None):
+    """
+    Loads options from settings.conf into global variables and sets up the
+    uploader, notifier and the other services built from them.
+    Prints every problem and exits if the file cannot be used.
+    Parameters:
+        path: The settings file to read
+        overrides: (section, option, value) tuples that replace what the file says
+    """
+    global UPLOAD_DIR
+    global DB_DIR
+    global SMTP_USER
+    global SMTP_PASSWORD
+    global SMTP_SERVER
+    global NOTIFIER
+    global DBUPLOADER_PATH
+    global MAX_PARALLEL_ETDS
+    global UPLOADER
+    global WATCH_MODE
+    global AGGREGATOR
+    global UPLOAD_CACHE
+    global STABILITY
+    global METRICS
+    global JOBS_DIR
+    global CLUSTER_QUEUE
+    global BYTE_BUDGET
+
+    settings = Settings(path, overrides)
+    try:
+        settings.check()
+    except ConfigError as e:
+        print e
+        sys.exit()
+
+    METRICS = Metrics()
+    STABILITY = None
+    BYTE_BUDGET = None
+    apply_settings(settings)
+
+    UPLOAD_DIR = settings.upload_dir
+    # Uploads and the links in their output must all go to the same place
+    DB_DIR = settings.dropbox_dir
+    SMTP_SERVER = settings.smtp_server
+    SMTP_USER = settings.smtp_user
+    SMTP_PASSWORD = settings.smtp_password
+    if NOTIFIER != None:
+        NOTIFIER.close()
+    NOTIFIER = None
+    DBUPLOADER_PATH = settings.dbuploader_path
+    MAX_PARALLEL_ETDS = settings.max_parallel_etds
+    if UPLOADER != None:
+        UPLOADER.close()
+    UPLOADER = make_uploader(settings)
+    CLUSTER_QUEUE = settings.cluster_queue
+    JOBS_DIR = settings.jobs_dir
+    WATCH_MODE = settings.watch_mode
+    UPLOAD_CACHE = None
+    if settings.cache_enabled:
+        UPLOAD_CACHE = UploadCache(settings.cache_path, settings.cache_max_entries, settings.cache_verify)
+    AGGREGATOR = None
+    if settings.aggregate_enabled:
+        AGGREGATOR = Aggregator(settings.aggregate_max_documents, settings.aggregate_max_age)
+
+
+def reload_config(path='settings.conf'):
+    """
+    Rereads settings.conf while the listener is running, without stopping the
+    ETDs being processed. The new file is only used if it is valid as a whole;
+    otherwise the current settings stay in force. Changes to options that are
+    only read at startup are reported and need a restart.
+    Parameters:
+        path: The settings file to read
+    Returns:
+        (bool) True if the new settings are in use.
+    """
+    settings = Settings(path)
+    try:
+        settings.check()
+    except ConfigError as e:
+        print "Not reloading %s, keeping the current settings:" % path
+        print e
+        return False
+    changes = settings.restart_changes(SETTINGS)
+    apply_settings(settings)
+    print "Reloaded %s" % path
+    if changes:
+        print "Restart to apply the changes to: %s" % ", ".join(changes)
+    return True
+
+
+def request_reload(signum, frame):
+    """
+    SIGHUP handler; the listener reloads settings.conf on its next pass.
+    """
+    RELOAD_REQUESTED.set()
+
+
+def check_config(path='settings.conf'):
+    """
+    Checks settings.conf and the paths it names without starting anything,
+    for use by deployment scripts and health checks.
+    Returns:
+        (int) Exit status: 0 if the settings can be used, 1 otherwise.
+    """
+    settings = Settings(path)
+    errors = list(settings.errors)
+    if not errors:
+        if not os.path.isdir(settings.upload_dir):
+            errors.append("upload_dir in [dirs] is not a directory: %s" % settings.upload_dir)
+        if not os.path.isfile(settings.xslt_path):
+            errors.append("xslt_path in [xslt] does not exist: %s" % settings.xslt_path)
+    for error in errors:
+        print error
+    if errors:
+        return 1
+    print "%s is OK" % path
+    return 0
+
+
+def mark_state(path, state):
+    """
+    Records the state of a zip in the ledger, if one is in use.
+    Parameters:
+        path: Full path to the .zip file
+        state: One of FileLedger.STATES
+    """
+    if LEDGER != None:
+        LEDGER.set_state(path, state)
+        if state == 'broken':
+            print "Adding %s to .broken.txt. Please fix the issue, then remove the entry in .broken.txt!" % (path)
+
+
+def process_etd(folder, path, recipient):
+    """
+    Unzips and transforms a single uploaded ETD, recording the outcome in the ledger.
+    Parameters:
+        folder: Path to specific upload folder
+        path: Full path to .zip file
+        recipient: Address to send results to
+    Returns:
+        (bool) True if the ETD was processed successfully.
+    """
+    METRICS.start_etd(os.path.splitext(os.path.basename(path))[0])
+    working_dir = os.path.join(folder, os.path.splitext(os.path.basename(path))[0])
+    job = None
+    # Released to the same budget even if settings.conf is reloaded meanwhile
+    budget = BYTE_BUDGET
+    admitted = 0
+    try:
+        job = EtdJob(path, JOBS_DIR)
+        if job.resumed:
+            print "Resuming %s (%s)" % (path, job.describe())
+            if not job.reached('extracted') and os.path.isdir(working_dir):
+                # Extraction was cut short; start it again from scratch
+                shutil.rmtree(working_dir)
+            elif job.reached('extracted') and not os.path.isdir(working_dir):
+                # Extracted somewhere else, e.g. by an earlier process run
+                job.restart()
+        size, spilled = zip_contents(path)
+        if MAX_ETD_BYTES and size > MAX_ETD_BYTES:
+            filename = os.path.basename(path)
+            print "%s is too large to process (%.1f MB unpacked)" % (filename, size / 1048576.0)
+            email_failure(filename, "%s unpacks to %.1f MB, more than the %.1f MB allowed for one ETD by max_etd_size in [admission]."
+                          % (filename, size / 1048576.0, MAX_ETD_BYTES / 1048576.0), recipient)
+            raise MyException("ETD too large")
+        if budget != None:
+            budget.acquire(size)
+            admitted = size
+        if STREAM_ZIPS:
+            stream_etd(folder, path, recipient, job)
+        elif spilled:
+            unzipped_path = unzip(folder, path, recipient, job)
+            print "Uploading %d large files straight from the zip" % len(spilled)
+            with contextlib.closing(zipfile.ZipFile(path, 'r')) as archive:
+                transform_files(unzipped_path, recipient, archive, job, spilled)
+        else:
+            unzipped_path = unzip(folder, path, recipient, job)
+            transform_files(unzipped_path, recipient, job=job)
+        mark_state(path, 'done')
+        job.finish()
+        METRICS.finish_etd('done')
+        return True
+    except MyException as e:
+        # If we reach this point, one of the uploaded zips was not able to be processed.
+        # In this case we want to add it to .broken.txt so that the script can keep running while ignoring
+        # the file that caused the error.
+        print "There was a problem processing %s. An email has been sent detailing the issue." % (path)
+        if str(e) != "Unclean runthrough":
+            # Left behind, it would stop the zip once its line is removed from .broken.txt
+            shutil.rmtree(working_dir, True)
+        mark_state(path, 'broken')
+    except Exception as e:
+        # Anything unexpected must not take the worker thread down with it.
+        print "Unexpected error processing %s: %s" % (path, e)
+        shutil.rmtree(working_dir, True)
+        mark_state(path, 'broken')
+    finally:
+        if admitted:
+            budget.release(admitted)
+    if job != None:
+        job.finish()
+    METRICS.finish_etd('broken')
+    return False
+
+
+def resubmit_interrupted(pool):
+    """
+    Requeues zips that were still being processed when the listener last stopped.
+    Each one picks up from the last stage its EtdJob recorded.
+    Parameters:
+        pool: The EtdWorkerPool to submit them to
+    """
+    for path in LEDGER.paths('processing'):
+        folder = add_slash(os.path.dirname(path))
+        bname = os.path.basename(os.path.normpath(folder))
+        recipient = get_option('email', bname, None)
+        if recipient == None or not os.path.isfile(path):
+            continue
+        print "Resuming interrupted processing of %s" % path
+        pool.submit(folder, path, recipient)
+
+
+class FairQueue(Queue.Queue):
+    """
+    A queue of ETDs that shares the workers fairly between upload folders,
+    so that one institution dropping hundreds of ETDs at once does not hold
+    up everyone else. Folders are served in proportion to their weight in
+    [priority] (default 1): the folder that has had the least service for
+    its weight goes next, and a folder that was idle starts level with the
+    others rather than ahead of them. Within a folder, and between folders
+    that are level, the smallest zip goes first to keep the average wait short.
+    Items are (folder, path, recipient) as passed to EtdWorkerPool.submit;
+    None, the signal for a worker to stop, is only handed out once no ETDs
+    are waiting.
+    """
+
+    def __init__(self, weights=None):
+        """
+        Parameters:
+            weights: Weight by folder name, or None to use [priority] in settings.conf
+        """
+        self.weights = weights
+        Queue.Queue.__init__(self)
+
+    def _init(self, maxsize):
+        # folder name -> heap of (zip size, arrival number, item)
+        self.waiting = dict()
+        # folder name -> [virtual time, ETDs handed out]
+        self.folders = dict()
+        # Virtual time of the last ETD handed out
+        self.vtime = 0.0
+        self.arrivals = 0
+        self.count = 0
+        self.stops = 0
+
+    def _qsize(self, len=len):
+        return self.count + self.stops
+
+    def _put(self, item):
+        if item is None:
+            self.stops += 1
+            return
+        name = os.path.basename(os.path.normpath(item[0]))
+        try:
+            size = os.path.getsize(item[1])
+        except OSError:
+            size = 0
+        heap = self.waiting.setdefault(name, [])
+        folder = self.folders.setdefault(name, [0.0, 0])
+        if not heap:
+            folder[0] = max(folder[0], self.vtime)
+        heapq.heappush(heap, (size, self.arrivals, item))
+        self.arrivals += 1
+        self.count += 1
+
+    def _get(self):
+        if self.count == 0:
+            self.stops -= 1
+            return None
+        name = min((self.folders[n][0], heap[0][0], heap[0][1], n) for n, heap in self.waiting.items() if heap)[3]
+        _, _, item = heapq.heappop(self.waiting[name])
+        folder = self.folders[name]
+        self.vtime = folder[0]
+        folder[0] += 1.0 / self.weight(name)
+        folder[1] += 1
+        self.count -= 1
+        return item
+
+    def weight(self, name):
+        """
+        Returns the share of the workers given to folder name, relative to the others.
+        """
+        if self.weights != None:
+            return self.weights.get(name, 1.0)
+        return float(get_option('priority', name, 1))
+
+    def state(self):
+        """
+        Returns:
+            (list) (folder name, ETDs waiting, bytes waiting, weight, ETDs started)
+            for every folder seen so far, sorted by name.
+        """
+        with self.mutex:
+            return [(name, len(self.waiting[name]), sum(entry[0] for entry in self.waiting[name]),
+                     self.weight(name), started) for name, (_, started) in sorted(self.folders.items())]
+
+
+class EtdWorkerPool(object):
+    """
+    A fixed number of worker threads that process independent ETDs concurrently.
+    The work is dominated by subprocesses, file I/O and network waits, so threads
+    are enough to overlap it while keeping email and ledger state in one process.
+    """
+
+    def __init__(self, size):
+        """
+        Parameters:
+            size: Number of ETDs that may be processed at the same time.
+        """
+        self.jobs = FairQueue()
+        self.threads = []
+        self.lock = threading.Lock()
+        # (path, succeeded, seconds taken) for every finished ETD
+        self.results = []
+        for i in range(size):
+            t = threading.Thread(target=self._work, name="etd-worker-%d" % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            self._report()
+            try:
+                if job is None:
+                    return
+                start = time.time()
+                try:
+                    ok = process_etd(*job)
+                except Exception as e:
+                    # e.g. the ledger could not be written; the next ETD may still work
+                    print "Worker failed on %s: %s" % (job[1], e)
+                    ok = False
+                with self.lock:
+                    self.results.append((job[1], ok, time.time() - start))
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, folder, path, recipient):
+        """
+        Queues an ETD for processing.
+        Parameters:
+            folder: Path to specific upload folder
+            path: Full path to .zip file
+            recipient: Address to send results to
+        """
+        self.jobs.put((folder, path, recipient))
+        self._report()
+
+    def _report(self):
+        state = self.jobs.state()
+        METRICS.set_gauge('queue_depth', sum(waiting for _, waiting, _, _, _ in state))
+        METRICS.set_folders(state)
+
+    def describe(self):
+        """
+        Returns:
+            (String) Who is waiting, e.g. "inst1: 12 waiting (340.2 MB), inst2: 1 waiting (3.1 MB)"
+        """
+        return ", ".join("%s: %d waiting (%.1f MB)" % (name, waiting, nbytes / 1048576.0)
+                         for name, waiting, nbytes, _, _ in self.jobs.state() if waiting)
+
+    def join(self):
+        """
+        Waits for all queued ETDs to finish and stops the workers.
+        """
+        for _ in self.threads:
+            self.jobs.put(None)
+        self.jobs.join()
+
+
+def run_listener():
+    global LEDGER
+    if CLUSTER_QUEUE != None:
+        # Several nodes share the queue; each zip is queued once and claimed by one of them
+        LEDGER = JobQueue(CLUSTER_QUEUE, SETTINGS.node_name, SETTINGS.lease_time)
+        # Its threads claim and process the queued ETDs by themselves
+        ClusterWorkers(MAX_PARALLEL_ETDS, LEDGER, SETTINGS.poll_interval)
+    else:
+        LEDGER = FileLedger()
+        pool = EtdWorkerPool(MAX_PARALLEL_ETDS)
+        resubmit_interrupted(pool)
+    watcher = make_watcher()
+    # Folders reported by the watcher since the last pass; None means look at all of them
+    changed = None
+    if hasattr(signal, 'SIGHUP') and threading.current_thread().name == 'MainThread':
+        # Signal handlers can only be set from the main thread
+        signal.signal(signal.SIGHUP, request_reload)
+    config_mtime = SETTINGS.mtime
+    # Whether ETDs were added to the pool during this pass
+    queued = False
 
     # Main run loop
     while True:
+        # Pick up edits to settings.conf, or a SIGHUP asking for a reload
+        try:
+            mtime = os.path.getmtime(SETTINGS.path)
+        except OSError:
+            mtime = None
+        if RELOAD_REQUESTED.is_set() or mtime != config_mtime:
+            RELOAD_REQUESTED.clear()
+            config_mtime = mtime
+            reload_config(SETTINGS.path)
+
         # List of all subdirectories directly below the UPLOAD_DIR
         folders = [f for f in listdir_fullpath(UPLOAD_DIR) if os.path.isdir(f)]
+        if changed != None:
+            folders = [f for f in folders if f in changed]
         for folder in folders:
-            global RESULT_EMAIL
             bname = os.path.basename(os.path.normpath(folder))
             if (not config.has_option('email', bname)) or (config.get('email', bname) == ''):
                 print "No email confiugred for %s option in [email]" % bname
                 print "Skipping this folder until one is configured."
                 continue
-            RESULT_EMAIL = config.get('email', bname)
-            new = poll_uploaddir(folder, seen_files)
+            # Each job carries its own recipient so concurrent ETDs from
+            # different folders cannot overwrite each other's address.
+            recipient = config.get('email', bname)
+            new = poll_uploaddir(folder, LEDGER, STABILITY)
             if new != None:
                 # There were new files. Unzip and process them.
                 for new_f in new:
-                    seen_files += [str(os.path.join(folder, new_f))]
-                    seen_files_f.write(str(os.path.join(folder, new_f)) + "\n")
-
-                    if new_f.split(".")[1] == "zip":
-                        try:
-                            unzipped_path = unzip(folder, new_f)
-                            transform_files(unzipped_path)
-                        except MyException as e:
-                            # If we reach this point, one of the uploaded zips was not able to be processed.
-                            # In this case we want to add it to .broken.txt so that the script can keep running while ignoring
-                            # the file that caused the error.
-                            print "There was a problem processing %s. An email has been sent detailing the issue." % (new_f)
-                            print "Adding %s to .broken.txt. Please fix the issue, then remove the entry in .broken.txt!" % (new_f)
-                            with open(".broken.txt", "a+") as b:
-                                b.write(new_f + "\n")
+                    if new_f.split(".")[1] == "zip" and CLUSTER_QUEUE != None:
+                        LEDGER.enqueue(new_f, folder, recipient)
+                    elif new_f.split(".")[1] == "zip":
+                        LEDGER.set_state(new_f, 'processing')
+                        pool.submit(folder, new_f, recipient)
+                        queued = True
                     else:
+                        LEDGER.set_state(new_f, 'seen')
                         print "Non-zip file in upload directory!"
+        if queued:
+            print "Waiting ETDs: %s" % (pool.describe() or "none")
+            queued = False
+
+        if CLUSTER_QUEUE != None:
+            LEDGER.requeue_fixed()
+        METRICS.write_textfile()
+        timeout = RESCAN_INTERVAL
+        if AGGREGATOR != None:
+            AGGREGATOR.flush_due()
+            deadline = AGGREGATOR.next_deadline()
+            if deadline != None:
+                timeout = min(timeout, deadline + 1)
+        if STABILITY != None:
+            STABILITY.forget_missing()
+            deadline = STABILITY.next_deadline()
+            if deadline != None:
+                # Look again once files that are still arriving may have settled
+                timeout = min(timeout, deadline + 0.5)
+
+        if watcher != None:
+            # Sleep until something arrives, with an occasional full rescan as a safety net
+            changed = watcher.wait(timeout)
+        else:
+            time.sleep(SLEEP_TIME)
+
+
+def find_zips(paths):
+    """
+    Expands the paths given on the command line into a list of zip files.
+    Parameters:
+        paths: Zip files, or directories that are searched recursively for zips
+    """
+    zips = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, files in os.walk(path):
+                zips += sorted([os.path.join(dirpath, f) for f in files if f.lower().endswith(".zip")])
+        else:
+            zips += [path]
+    return [os.path.abspath(z) for z in zips]
+
+
+def run_batch(args):
+    """
+    Processes a fixed set of ETD zips once and prints a throughput summary.
+    Working directories are created below args.output_dir in a folder named
+    after the zip's parent folder. Without args.output_dir a fresh temporary
+    directory is used and removed afterwards, so working directories left next
+    to the zips by the listener or earlier runs do not get in the way.
+    Parameters:
+        args: Parsed command line arguments for the process command
+    Returns:
+        (int) Exit status: 0 if every ETD succeeded, 1 otherwise.
+    """
+    global LEDGER
+    if args.record:
+        LEDGER = FileLedger()
+
+    zips = find_zips(args.paths)
+    if args.output_dir:
+        work_dir = os.path.abspath(args.output_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="p2b_process_")
+        print "Working directories are in %s" % work_dir
+    pool = EtdWorkerPool(args.workers or MAX_PARALLEL_ETDS)
+    total_bytes = 0
+    skipped = 0
+    start = time.time()
+    for path in zips:
+        bname = os.path.basename(os.path.dirname(path))
+        recipient = args.email or get_option('email', bname, None)
+        if not os.path.isfile(path):
+            print "Skipping %s: no such file" % path
+            skipped += 1
+            continue
+        if recipient == None:
+            print "Skipping %s: no email configured for %s option in [email] and no --email given" % (path, bname)
+            skipped += 1
+            continue
+        folder = os.path.join(work_dir, bname) + "/"
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        total_bytes += os.path.getsize(path)
+        mark_state(path, 'processing')
+        pool.submit(folder, path, recipient)
+    pool.join()
+    if AGGREGATOR != None:
+        AGGREGATOR.flush_all()
+    get_notifier().flush()
+    METRICS.write_textfile()
+    if not args.output_dir:
+        shutil.rmtree(work_dir, True)
+    elapsed = max(time.time() - start, 1e-6)
+
+    failed = [path for path, ok, _ in pool.results if not ok]
+    done = len(pool.results) - len(failed)
+    print ""
+    print "Processed %d ETDs in %.1f seconds: %d succeeded, %d failed, %d skipped" % (len(pool.results), elapsed, done, len(failed), skipped)
+    print "Throughput: %.1f ETDs/min, %.2f MB/s" % (len(pool.results) * 60.0 / elapsed, total_bytes / 1048576.0 / elapsed)
+    for path in failed:
+        print "FAILED: %s" % path
+    if failed or skipped:
+        return 1
+    return 0
+
+
+def parse_args(argv):
+    """
+    Parses the command line. With no command the listener is started.
+    Parameters:
+        argv: Command line arguments, without the program name
+    """
+    parser = argparse.ArgumentParser(description="Converts uploaded ProQuest ETDs into a format suitable for upload to Bepress.")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("listen", help="watch the upload directory and process new ETDs (default)")
+    commands.add_parser("check", help="check settings.conf and exit")
+    process = commands.add_parser("process", help="process the given ETD zips once and exit")
+    process.add_argument("paths", nargs="+", metavar="zip-or-dir",
+                         help="zip files, or directories to search for zip files")
+    process.add_argument("-w", "--workers", type=int,
+                         help="number of ETDs processed at the same time (default: [workers] max_parallel_etds)")
+    process.add_argument("--email",
+                         help="send results here instead of the [email] address for each zip's folder")
+    process.add_argument("--output-dir",
+                         help="keep the working directories here (default: a temporary directory that is removed afterwards)")
+    process.add_argument("--record", action="store_true",
+                         help="record the results in the listener's ledger (.ledger.log and .broken.txt)")
+    process.add_argument("--sink", choices=["shell", "http", "local", "null"],
+                         help="where output goes, overriding [dropbox] transport: dropbox_uploader.sh, the Dropbox API, "
+                              "a local directory or nowhere")
+    process.add_argument("--sink-dir",
+                         help="directory the local sink writes to (implies --sink local)")
+    process.add_argument("--notify", choices=["smtp", "log", "null"],
+                         help="how results are reported, overriding [smtp] transport")
+    process.add_argument("--dry-run", action="store_true",
+                         help="transform only: discard the output and print the emails instead of sending them "
+                              "(--sink null --notify log unless given)")
+    if len(argv) == 0:
+        argv = ["listen"]
+    return parser.parse_args(argv)
+
 
-        time.sleep(SLEEP_TIME)
+def config_overrides(args):
+    """
+    Returns the settings given on the command line.
+    Parameters:
+        args: Parsed command line arguments
+    Returns:
+        (list) (section, option, value) tuples for load_config
+    """
+    overrides = []
+    if args.command != "process":
+        return overrides
+    sink = args.sink
+    notify = args.notify
+    if args.sink_dir:
+        sink = sink or 'local'
+        overrides.append(('dropbox', 'local_dir', args.sink_dir))
+    if args.dry_run:
+        sink = sink or 'null'
+        notify = notify or 'log'
+    if sink:
+        overrides.append(('dropbox', 'transport', sink))
+    if notify:
+        overrides.append(('smtp', 'transport', notify))
+    return overrides
 
 
 def main():
-    load_config()
+    args = parse_args(sys.argv[1:])
+    if args.command == "check":
+        sys.exit(check_config())
+    load_config(overrides=config_overrides(args))
+    if args.command == "process":
+        sys.exit(run_batch(args))
     run_listener()
 
 